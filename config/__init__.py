@@ -65,6 +65,13 @@ for mandatory_var in MANDATORY_VARS:
 
 # Environment variable type can be unpredictable, sanitize the numerical ones.
 settings.FILE_PROCESS_PAGE_SIZE = int(settings.FILE_PROCESS_PAGE_SIZE)
+settings.DATA_API_DOWNLOAD_THREADS = int(settings.DATA_API_DOWNLOAD_THREADS)
+settings.FOREST_DOWNLOAD_THREADS = int(settings.FOREST_DOWNLOAD_THREADS)
+settings.DATA_API_DOWNLOAD_BUFFER_MB = int(settings.DATA_API_DOWNLOAD_BUFFER_MB)
+settings.CHUNK_CACHE_MAX_MB = int(settings.CHUNK_CACHE_MAX_MB)
+settings.FOREST_MAX_CONCURRENT_TASKS = int(settings.FOREST_MAX_CONCURRENT_TASKS)
+settings.FOREST_NODE_MAX_LOAD = float(settings.FOREST_NODE_MAX_LOAD)
+settings.FOREST_NODE_MIN_FREE_DISK_MB = int(settings.FOREST_NODE_MIN_FREE_DISK_MB)
 
 # email addresses are parsed from a comma separated list, strip whitespace.
 if settings.SYSADMIN_EMAILS:
@@ -29,6 +29,8 @@ if DB_MODE == DB_MODE_SQLITE:
             },
         },
     }
+    # sqlite ignores the included (non-key) columns of covering indexes, that's fine.
+    SILENCED_SYSTEM_CHECKS = ["models.W040"]
 elif DB_MODE == DB_MODE_POSTGRES:
     CONN_HEALTH_CHECKS = True  # new in django 4.1, allows for health checks on the database connection
     DATABASES = {
@@ -61,7 +63,7 @@ if not SECURE_SSL_REDIRECT and DB_MODE == DB_MODE_POSTGRES and platform.system()
     DATABASES['default']['OPTIONS']['sslmode'] = 'disable'
 
 MIDDLEWARE = [
-    'middleware.downtime_middleware.DowntimeMiddleware',  # does a single database call
+    'middleware.downtime_middleware.DowntimeMiddleware',  # cached, occasionally does a database call
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -67,6 +67,58 @@ DOWNLOADABLE_APK_URL = getenv("DOWNLOADABLE_APK_URL", "https://beiwe-app-backups
 #   Expects an integer number.
 FILE_PROCESS_PAGE_SIZE = getenv("FILE_PROCESS_PAGE_SIZE", 100)
 
+# The number of files retrieved from S3 simultaneously by a single Data Access API download. Raising
+# this can speed up large downloads at the cost of more concurrent S3 requests and CPU time (for
+# decryption) on the webserver.
+#   Expects an integer number.
+DATA_API_DOWNLOAD_THREADS = getenv("DATA_API_DOWNLOAD_THREADS", 3)
+
+# The number of files retrieved from S3 simultaneously by a single Forest task when it downloads its
+# input data, on Forest servers. Files are decrypted straight to disk as they download, so raising
+# this mostly costs concurrent S3 requests and CPU time, not memory.
+#   Expects an integer number.
+FOREST_DOWNLOAD_THREADS = getenv("FOREST_DOWNLOAD_THREADS", 4)
+
+# The approximate maximum amount of retrieved-but-not-yet-sent file data, in megabytes, that a
+# single Data Access API download will hold in memory while it waits on a slow network connection.
+#   Expects an integer number.
+DATA_API_DOWNLOAD_BUFFER_MB = getenv("DATA_API_DOWNLOAD_BUFFER_MB", 64)
+
+# A folder on local disk for caching decrypted data files (ChunkRegistry files) retrieved from S3 by
+# Data Access API downloads and Forest tasks. Repeated downloads of the same files are served from
+# disk, saving S3 transfer costs and decryption CPU time. Cached files are invalidated when their
+# contents change. Leave empty to disable the cache (the default). Each server has its own cache, a
+# participant purge clears the cache of the server it runs on, every other server removes the purged
+# data within a few minutes of its next download, and hourly on data processing servers (see
+# scripts/sweep_chunk_cache.py).
+#   Expects a folder path.
+CHUNK_CACHE_FOLDER = getenv("CHUNK_CACHE_FOLDER", "")
+
+# The maximum size of the decrypted file cache, in megabytes, least recently used files are removed
+# first. Make sure there is enough free disk space on the server.
+#   Expects an integer number.
+CHUNK_CACHE_MAX_MB = getenv("CHUNK_CACHE_MAX_MB", 2048)
+
+#
+# Forest task dispatching
+#
+
+# The maximum number of Forest tasks running or waiting for a Forest worker at once, normally the
+# number of Forest worker servers. Tasks beyond this limit stay queued until a task finishes.
+# 0 means no limit.
+#   Expects an integer number.
+FOREST_MAX_CONCURRENT_TASKS = getenv("FOREST_MAX_CONCURRENT_TASKS", 0)
+
+# A Forest worker server only starts a task when its 1-minute load average per CPU core is at most
+# this value, otherwise the task is dispatched again later.
+#   Expects a decimal number.
+FOREST_NODE_MAX_LOAD = getenv("FOREST_NODE_MAX_LOAD", 2.0)
+
+# A Forest worker server only starts a task when its free disk space, minus the task's estimated
+# input data size, stays above this many megabytes.
+#   Expects an integer number.
+FOREST_NODE_MIN_FREE_DISK_MB = getenv("FOREST_NODE_MIN_FREE_DISK_MB", 1024)
+
 #
 # Push Notification directives
 #
@@ -82,6 +134,12 @@ PUSH_NOTIFICATION_ATTEMPT_COUNT = getenv("PUSH_NOTIFICATION_ATTEMPT_COUNT", 720)
 #   Expects (case-insensitive) "true" to block errors.
 BLOCK_QUOTA_EXCEEDED_ERROR = getenv('BLOCK_QUOTA_EXCEEDED_ERROR', 'false').lower() == 'true'
 
+# Sends survey and heartbeat push notifications in batches of up to 500 notifications from a few
+# celery tasks, instead of one celery task per notification. Firebase still receives one (concurrent)
+# request per notification, this reduces celery and database overhead, not Firebase requests.
+#   Expects (case-insensitive) "true" to enable.
+PUSH_NOTIFICATION_BATCH_SEND = getenv('PUSH_NOTIFICATION_BATCH_SEND', 'false').lower() == 'true'
+
 
 #
 # User Authentication and Permissions
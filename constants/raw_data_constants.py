@@ -3,5 +3,10 @@
 # ZipGenerator is used in the data access api, and in the download task data endpoint for forest.
 CHUNK_FIELDS = (
     "pk", "participant_id", "data_type", "chunk_path", "time_bin", "chunk_hash",
-    "participant__patient_id", "study_id", "survey_id", "survey__object_id"
-)
\ No newline at end of file
+    "participant__patient_id", "study_id", "survey_id", "survey__object_id", "file_size"
+)
+# Resumable download sessions (see DataDownloadSession) are split into segments of up to this many
+# (uncompressed) bytes or files, whichever comes first.
+DOWNLOAD_SESSION_SEGMENT_BYTES = 256 * 1024 * 1024
+DOWNLOAD_SESSION_SEGMENT_FILES = 5000
+DOWNLOAD_SESSION_DURATION_DAYS = 7
@@ -56,6 +56,19 @@ ACTIVE_PARTICIPANT_FIELDS = (
 )
 # Don't forget that you need to query the AppHeartbeat model to get the last time the app heartbeat.
 
+# the most recent of these timestamps is a participant's heartbeat_reference_time, the next heartbeat
+# push notification is due heartbeat_timer_minutes after it.
+HEARTBEAT_REFERENCE_FIELDS = (
+    'last_upload',
+    'last_get_latest_surveys',
+    'last_set_password',
+    'last_set_fcm_token',
+    'last_get_latest_device_settings',
+    'last_register_user',
+    "last_heartbeat_checkin",
+    "last_heartbeat_notification",
+)
+
 # used to determine whether a participant is considered "active"
 PARTICIPANT_STATUS_QUERY_FIELDS = (
     "id",  # the database id, use is clear in the code, not actually part of activeness
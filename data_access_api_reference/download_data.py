@@ -1,8 +1,9 @@
-import io
 import json
 import os
+import tempfile
 import zipfile
 
+from concurrent.futures import as_completed, ThreadPoolExecutor
 from os import path
 
 try:
@@ -43,6 +44,19 @@ GYRO = "gyro"
 MAGNETOMETER = "magnetometer"
 DEVICEMOTION = "devicemotion"
 REACHABILITY = "reachability"
+AMBIENT_AUDIO = "ambient_audio"
+
+ALL_DATA_STREAMS = [
+    ACCELEROMETER, AMBIENT_AUDIO, ANDROID_LOG_FILE, BLUETOOTH, CALL_LOG, DEVICEMOTION, GPS, GYRO,
+    IDENTIFIERS, IOS_LOG_FILE, MAGNETOMETER, POWER_STATE, PROXIMITY, REACHABILITY, SURVEY_ANSWERS,
+    SURVEY_TIMINGS, TEXTS_LOG, VOICE_RECORDING, WIFI,
+]
+
+# downloads are written to disk in pieces of this size
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# make_parallel_request saves the registry and sync cursors after this many completed downloads
+SAVE_PROGRESS_INTERVAL = 100
 
 RUNNING_IN_TEST_MODE = False
 SKIP_DOWNLOAD = False
@@ -67,7 +81,9 @@ def make_request(
     This function will download the data from the server, decompress it, and WRITE IT TO FILES IN
     YOUR CURRENT WORKING DIRECTORY. If the data in the current working directory includes a
     "registry.dat" file, the server will use the contents of it to only download files that are
-    new, potentially greatly speeding up your requests.
+    new, potentially greatly speeding up your requests.  After a download the server's sync cursor
+    is saved to a "sync_cursor" file, repeating the same request later sends that cursor instead
+    of the registry, and the server only has to look at files that changed since then.
 
     Study ID
     study_id is required for any query. The ID of a given study is displayed immediately under
@@ -107,23 +123,201 @@ def make_request(
     this function.
     """
 
+    values = build_query_values(
+        study_id, access_key, secret_key, user_ids, data_streams, time_start, time_end
+    )
+    old_registry, cursor_query = add_registry_or_sync_cursor(values)
+
+    print("sending request, receiving data, this could take some time.")
+    new_registry, headers = download_and_extract(API_URL_BASE + 'get-data/v1', values)
+    merge_registry(old_registry, new_registry)
+
+    if "Beiwe-Sync-Cursor" in headers:
+        save_sync_cursor(cursor_query, headers["Beiwe-Sync-Cursor"])
+    print("Operations complete.")
+    # Uncomment the following line to have the function return a list of newly updated files.
+    # return list(new_registry)
+
+
+def make_parallel_request(
+        study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY, user_ids=None, data_streams=None,
+        time_start=None, time_end=None, connections=4
+):
+    """
+    Takes the same parameters as make_request, and has the same behavior, but the query is split
+    into one request per participant and data stream, and several of those requests (the
+    connections parameter) are downloaded at the same time.  Each download is streamed to a
+    temporary file on disk and extracted when it finishes, so memory usage stays low even for very
+    large studies, but there must be free disk space for the largest downloads to be held twice.
+
+    Repeated runs only download new and updated files, the sync cursor for each participant and
+    data stream is saved in the "sync_cursor" file in your current working directory.  Progress is
+    saved every SAVE_PROGRESS_INTERVAL downloads, if a run is interrupted the participants and data
+    streams that were saved do not need to be downloaded again.
+    """
+    if not user_ids:
+        user_ids = get_participant_ids_request(study_id, access_key, secret_key)
+    if not data_streams:
+        data_streams = ALL_DATA_STREAMS
+
+    old_registry = load_master_registry()
+    sync_cursors = load_sync_cursors()
+    queries = [
+        build_query_values(
+            study_id, access_key, secret_key, [user_id], [data_stream], time_start, time_end
+        )
+        for user_id in user_ids for data_stream in data_streams
+    ]
+    print(
+        "downloading", len(queries), "participant and data stream combinations,", connections,
+        "at a time."
+    )
+
+    # Only the part of the registry relevant to a participant is sent with their queries. These
+    # copies are made here because the main thread updates old_registry while downloads run.
+    participant_registries = {
+        user_id: {key: value for key, value in old_registry.items() if "/%s/" % user_id in key}
+        for user_id in user_ids
+    }
+
+    def download_one(values):
+        participant_registry = participant_registries[json.loads(values['user_ids'])[0]]
+        cursor_query = add_registry_or_sync_cursor(values, participant_registry, sync_cursors)[1]
+        new_registry, headers = download_and_extract(API_URL_BASE + 'get-data/v1', values)
+        return cursor_query, new_registry, headers.get("Beiwe-Sync-Cursor", None)
+
+    # the registry and sync cursor files are only updated here, on the main thread.
+    new_sync_cursors = []
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        futures = [executor.submit(download_one, values) for values in queries]
+        try:
+            for i, future in enumerate(as_completed(futures), start=1):
+                cursor_query, new_registry, sync_cursor = future.result()
+                old_registry.update(new_registry)
+                if sync_cursor:
+                    new_sync_cursors.append((cursor_query, sync_cursor))
+                print("completed", i, "of", len(queries), "-", len(new_registry), "files")
+                if i % SAVE_PROGRESS_INTERVAL == 0:
+                    save_progress(old_registry, new_sync_cursors)
+        finally:
+            # the registry is saved before the sync cursors that depend on it.
+            save_progress(old_registry, new_sync_cursors)
+
+    print("Operations complete.")
+
+
+def make_resumable_request(
+        study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY, user_ids=None, data_streams=None,
+        time_start=None, time_end=None, connections=4
+):
+    """
+    Takes the same parameters as make_request, and has the same behavior, but the download is
+    split into segments, several of which (the connections parameter) are downloaded at the same
+    time.  If the download is interrupted, run this function again with the same parameters and it
+    will resume with the segments that were not completed.  Progress is saved in a
+    "download_session" file in your current working directory, it is removed when the download
+    completes.  Download sessions expire after 7 days.
+    """
+    values = build_query_values(
+        study_id, access_key, secret_key, user_ids, data_streams, time_start, time_end
+    )
+    old_registry, cursor_query = add_registry_or_sync_cursor(values)
+
+    # resume an existing session for the same query, otherwise create a new one.
+    session = None
+    if path.exists("download_session"):
+        with open("download_session") as f:
+            session = json.load(f)
+        if session["query"] != cursor_query:
+            print("Found a download session for a different query, starting a new download.")
+            session = None
+
+    if session is None:
+        print("creating download session.")
+        response = requests.post(API_URL_BASE + 'get-data-session/v1', data=values)
+        if response.status_code != 200:
+            raise requests.exceptions.HTTPError(response.status_code)
+        session = {"query": cursor_query, "manifest": response.json(), "completed": []}
+        save_download_session(session)
+
+    manifest = session["manifest"]
+    print(
+        "download session contains", manifest["total_files"], "files,", manifest["total_bytes"],
+        "bytes, in", len(manifest["segments"]), "segments."
+    )
+
+    remaining = [
+        segment["segment"] for segment in manifest["segments"]
+        if segment["segment"] not in session["completed"]
+    ]
+    # the registry and download session files are only updated here, on the main thread.
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        futures = {
+            executor.submit(download_segment, values, manifest["session_id"], segment): segment
+            for segment in remaining
+        }
+        for future in as_completed(futures):
+            merge_registry(old_registry, future.result())
+            session["completed"].append(futures[future])
+            save_download_session(session)
+            print(
+                "completed segment", futures[future] + 1, "-", len(session["completed"]), "of",
+                len(manifest["segments"]), "segments done."
+            )
+
+    save_sync_cursor(cursor_query, manifest["sync_cursor"])
+    os.remove("download_session")
+    print("Operations complete.")
+
+
+def download_segment(values, session_id, segment):
+    """ Downloads and unpacks one segment of a download session, returns its registry. """
+    segment_values = {
+        'access_key': values['access_key'],
+        'secret_key': values['secret_key'],
+        'session_id': session_id,
+        'segment': segment,
+    }
+    # the study key is either study_pk or study_id
+    for key in ("study_pk", "study_id"):
+        if key in values:
+            segment_values[key] = values[key]
+    return download_and_extract(API_URL_BASE + 'get-data-session-segment/v1', segment_values)[0]
+
+
+def download_and_extract(url, values):
+    """ Streams a zip file download to a temporary file on disk, then extracts it into the current
+    working directory.  Returns the registry of the download and the response headers. """
+    with requests.post(url, data=values, stream=True) as response:
+        if response.status_code != 200:
+            raise requests.exceptions.HTTPError(response.status_code)
+
+        if RUNNING_IN_TEST_MODE and SKIP_DOWNLOAD:
+            raise requests.exceptions.HTTPError(response.status_code)
+
+        with tempfile.TemporaryFile() as temp_file:
+            for data in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                temp_file.write(data)
+            temp_file.seek(0)
+
+            with zipfile.ZipFile(temp_file) as z:
+                # the registry is not extracted, several downloads may be running at once.
+                z.extractall(members=[name for name in z.namelist() if name != "registry"])
+                new_registry = json.loads(z.read("registry")) if "registry" in z.namelist() else {}
+        return new_registry, response.headers
+
+
+def build_query_values(study_id, access_key, secret_key, user_ids, data_streams, time_start, time_end):
+    """ Builds the post parameters of a data download query. """
     if access_key is None or secret_key is None:
         raise Exception("You must provide credentials to run this API call.")
 
-    url = API_URL_BASE + 'get-data/v1'
-    try:
-        int(study_id)
-        study_key = "study_pk"
-    except ValueError:
-        study_key = "study_id"
-
     values = {
         'access_key': access_key,
         'secret_key': secret_key,
-        study_key: study_id,
+        get_study_key(study_id): study_id,
     }
 
-
     if user_ids:
         values['user_ids'] = json.dumps(user_ids)
     if data_streams:
@@ -138,41 +332,104 @@ def make_request(
         # if isinstance(time_end, datetime):
         # time_end = time_end.strftime(API_TIME_FORMAT)
         values['time_end'] = time_end
+    return values
 
-    if path.exists("master_registry"):
-        with open("master_registry") as f:
-            old_registry = json.load(f)
-            f.close()
-            values["registry"] = json.dumps(old_registry)
-    else:
-        old_registry = {}
 
-    print("sending request, receiving data, this could take some time.")
-    response = requests.post(url, data=values)
+def get_study_key(study_id):
+    """ Studies can be identified by their integer primary key or their object id. """
+    try:
+        int(study_id)
+        return "study_pk"
+    except ValueError:
+        return "study_id"
 
-    if response.status_code != 200:
-        raise requests.exceptions.HTTPError(response.status_code)
 
-    if RUNNING_IN_TEST_MODE and SKIP_DOWNLOAD:
-        raise requests.exceptions.HTTPError(response.status_code)
+def add_registry_or_sync_cursor(values, old_registry=None, sync_cursors=None):
+    """ Adds the saved sync cursor for this query to the post parameters, or the registry if there
+    isn't one.  The registry and sync cursors are loaded from disk if they are not provided.
+    Returns the registry and the query used to identify the sync cursor. """
+    if old_registry is None:
+        old_registry = load_master_registry()
+    if sync_cursors is None:
+        sync_cursors = load_sync_cursors()
+
+    # the sync cursor is only valid for a repeat of the exact same query
+    cursor_query = {key: value for key, value in values.items() if key != "secret_key"}
+    sync_cursor = sync_cursors.get(json.dumps(cursor_query, sort_keys=True), None)
+
+    if sync_cursor:
+        values["updated_since"] = sync_cursor
+    elif old_registry:
+        values["registry"] = json.dumps(old_registry)
+    return old_registry, cursor_query
 
-    data = response.content
-    print("Data received.  Unpacking and overwriting any updated files into", path.abspath('.'))
 
-    z = zipfile.ZipFile(io.BytesIO(data))
-    z.extractall()
+def load_master_registry():
+    if path.exists("master_registry"):
+        with open("master_registry") as f:
+            return json.load(f)
+    return {}
 
-    with open("registry") as f:
-        new_registry = json.load(f)
-        f.close()
 
+def merge_registry(old_registry, new_registry):
+    """ Merges the registry of a download into the master registry. """
     old_registry.update(new_registry)
+    save_master_registry(old_registry)
+    return old_registry
+
+
+def save_master_registry(registry):
     with open("master_registry", "w") as f:
-        json.dump(old_registry, f)
-    os.remove("registry")
-    print("Operations complete.")
-    # Uncomment the following line to have the function return a list of newly updated files.
-    # return [name.filename for name in z.filelist if name.filename != "registry"]
+        json.dump(registry, f)
+
+
+def load_sync_cursors():
+    if path.exists("sync_cursor"):
+        with open("sync_cursor") as f:
+            return json.load(f)
+    return {}
+
+
+def save_sync_cursor(cursor_query, cursor):
+    """ Sync cursors are saved per query, keyed by the query parameters. """
+    save_sync_cursors([(cursor_query, cursor)])
+
+
+def save_sync_cursors(new_sync_cursors):
+    """ Saves a list of (query, sync cursor) pairs with a single write of the sync cursor file. """
+    sync_cursors = load_sync_cursors()
+    for cursor_query, cursor in new_sync_cursors:
+        sync_cursors[json.dumps(cursor_query, sort_keys=True)] = cursor
+    with open("sync_cursor", "w") as f:
+        json.dump(sync_cursors, f)
+
+
+def save_progress(registry, new_sync_cursors):
+    """ Saves the master registry, then the sync cursors that have not been saved yet, clears the
+    list of unsaved sync cursors. """
+    save_master_registry(registry)
+    if new_sync_cursors:
+        save_sync_cursors(new_sync_cursors)
+        new_sync_cursors.clear()
+
+
+def save_download_session(session):
+    with open("download_session", "w") as f:
+        json.dump(session, f)
+
+
+def get_participant_ids_request(study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY):
+    """ Provides a list of the participant ids in the given study. """
+    url = API_URL_BASE + 'get-participant-ids/v1'
+    values = {
+        'access_key': access_key,
+        'secret_key': secret_key,
+        get_study_key(study_id): study_id,
+    }
+    response = requests.post(url, data=values)
+    if response.status_code != 200:
+        raise requests.exceptions.HTTPError(response.status_code)
+    return response.json()
 
 
 def get_users_request(study_id, access_key=ACCESS_KEY, secret_key=SECRET_KEY):
@@ -1,11 +1,13 @@
 from __future__ import annotations
 
+import json
+import uuid
 from collections import Counter
 from datetime import datetime, timedelta
-from typing import Dict
+from typing import Dict, Tuple
 
 from django.db import models
-from django.db.models import QuerySet
+from django.db.models import Manager, QuerySet
 from django.utils import timezone
 
 from constants.common_constants import (API_TIME_FORMAT, CHUNKS_FOLDER,
@@ -14,7 +16,7 @@ from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM
 from constants.data_stream_constants import (CHUNKABLE_FILES, IDENTIFIERS,
     REVERSE_UPLOAD_FILE_TYPE_MAPPING)
 from constants.user_constants import OS_TYPE_CHOICES
-from database.models import TimestampedModel
+from database.models import JSONTextField, TimestampedModel, UtilityModel
 from database.user_models_participant import Participant
 from libs.s3 import s3_retrieve
 from libs.utils.security_utils import chunk_hash
@@ -22,7 +24,7 @@ from libs.utils.security_utils import chunk_hash
 
 # this is an import hack to improve IDE assistance
 try:
-    from database.models import Study, Survey
+    from database.models import Researcher, Study, Survey
 except ImportError:
     pass
 
@@ -67,6 +69,21 @@ class ChunkRegistry(TimestampedModel):
         db_index=True
     )
     
+    # On postgres this table can be partitioned by month of time_bin, see
+    # libs/chunk_registry_partitions.py. Include time_bin ranges in queries where possible.
+    
+    class Meta:
+        indexes = [
+            # Data downloads (get_chunks_time_range) filter on these columns, in this order, and the
+            # remaining CHUNK_FIELDS columns are included so that postgres can answer the query from
+            # the index alone. (Other databases ignore the include.)
+            models.Index(
+                fields=["study", "participant", "data_type", "time_bin"],
+                include=["id", "chunk_path", "chunk_hash", "survey", "file_size"],
+                name="chunk_registry_download_idx",
+            ),
+        ]
+    
     def s3_retrieve(self) -> bytes:
         return s3_retrieve(self.chunk_path, self.study.object_id, raw_path=True)
     
@@ -78,21 +95,25 @@ class ChunkRegistry(TimestampedModel):
             raise UnchunkableDataTypeError
         
         chunk_hash_str = chunk_hash(file_contents).decode()
-        time_bin = int(time_bin) * CHUNK_TIMESLICE_QUANTUM
-        time_bin = timezone.make_aware(datetime.utcfromtimestamp(time_bin), timezone.utc)
         
-        cls.objects.create(
+        return cls.objects.create(
             is_chunkable=True,
             chunk_path=chunk_path,
             chunk_hash=chunk_hash_str,
             data_type=data_type,
-            time_bin=time_bin,
+            time_bin=cls.time_slice_to_time_bin(time_bin),
             study_id=study_id,
             participant_id=participant_id,
             survey_id=survey_id,
             file_size=len(file_contents),
         )
     
+    @staticmethod
+    def time_slice_to_time_bin(time_slice: int) -> datetime:
+        """ Data processing works in integer hours since the epoch, time_bin is a datetime. """
+        time_slice = int(time_slice) * CHUNK_TIMESLICE_QUANTUM
+        return timezone.make_aware(datetime.utcfromtimestamp(time_slice), timezone.utc)
+    
     @classmethod
     def register_unchunked_data(cls, data_type, unix_timestamp, chunk_path, study_id, participant_id,
                                 file_contents, survey_id=None):
@@ -101,7 +122,7 @@ class ChunkRegistry(TimestampedModel):
         if data_type in CHUNKABLE_FILES:
             raise ChunkableDataTypeError
         
-        cls.objects.create(
+        return cls.objects.create(
             is_chunkable=False,
             chunk_path=chunk_path,
             chunk_hash='',
@@ -114,30 +135,43 @@ class ChunkRegistry(TimestampedModel):
         )
     
     @classmethod
-    def update_registered_unchunked_data(cls, data_type, chunk_path, file_contents):
+    def update_registered_unchunked_data(
+        cls, data_type, chunk_path, file_contents
+    ) -> Tuple[ChunkRegistry, int]:
         """ Updates the data in case a user uploads an unchunkable file more than once,
-        and updates the file size just in case it changed. """
+        and updates the file size just in case it changed. Returns the chunk and the change in its
+        file size. """
         if data_type in CHUNKABLE_FILES:
             raise ChunkableDataTypeError
         chunk = cls.objects.get(chunk_path=chunk_path)
+        old_file_size = chunk.file_size or 0
         chunk.file_size = len(file_contents)
         chunk.save()
+        return chunk, chunk.file_size - old_file_size
     
     @classmethod
     def get_chunks_time_range(
-        cls, study_id, user_ids=None, data_types=None, start=None, end=None) -> QuerySet[ChunkRegistry]:
+        cls, study_id, user_ids=None, data_types=None, start=None, end=None, updated_since=None
+    ) -> QuerySet[ChunkRegistry]:
         """This function uses Django query syntax to provide datetimes and have Django do the
         comparison operation, and the 'in' operator to have Django only match the user list
         provided. """
         query = {'study_id': study_id}
         if user_ids:
-            query['participant__patient_id__in'] = user_ids
+            # resolve patient ids to primary keys first so that the (huge) ChunkRegistry query does
+            # not need a join to filter, and can use the chunk_registry_download_idx index.
+            query['participant_id__in'] = list(
+                Participant.objects.filter(study_id=study_id, patient_id__in=user_ids)
+                .values_list("pk", flat=True)
+            )
         if data_types:
             query['data_type__in'] = data_types
         if start:
             query['time_bin__gte'] = start
         if end:
             query['time_bin__lte'] = end
+        if updated_since:
+            query['last_updated__gte'] = updated_since
         return cls.objects.filter(**query)
     
     @classmethod
@@ -284,3 +318,65 @@ class IOSDecryptionKey(TimestampedModel):
     file_name = models.CharField(max_length=80, blank=False, unique=True, db_index=True)
     base64_encryption_key = models.CharField(max_length=24, blank=False)
     participant: Participant = models.ForeignKey("Participant", on_delete=models.CASCADE)
+
+
+class DataDownloadSession(TimestampedModel):
+    """ A resumable data download. The query of a data access api request is recorded and its
+    results are split into numbered segments (ranges of ChunkRegistry pks), each segment can be
+    downloaded any number of times, in any order, in parallel. """
+    session_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    study: Study = models.ForeignKey(
+        "Study", on_delete=models.CASCADE, related_name="download_sessions"
+    )
+    researcher: Researcher = models.ForeignKey(
+        "Researcher", on_delete=models.CASCADE, related_name="download_sessions"
+    )
+    # the query, see ChunkRegistry.get_chunks_time_range. user_ids and data_types are json lists.
+    user_ids = JSONTextField(default="[]")
+    data_types = JSONTextField(default="[]")
+    time_start = models.DateTimeField(null=True, blank=True)
+    time_end = models.DateTimeField(null=True, blank=True)
+    updated_since = models.DateTimeField(null=True, blank=True)
+    # json of the registry entries that excluded chunks from the download, {chunk path: chunk hash}
+    registry = JSONTextField(default="{}")
+    total_files = models.PositiveIntegerField()
+    total_bytes = models.PositiveBigIntegerField()
+    # the sync cursor for the query that created the session (see raw_data_api.get_data)
+    sync_cursor = models.DateTimeField()
+    expires_on = models.DateTimeField(db_index=True)
+    
+    segments: Manager[DataDownloadSegment]
+    
+    def get_segment_chunks(self, segment: DataDownloadSegment) -> QuerySet[ChunkRegistry]:
+        """ The chunks matching the session's query in the pk range of the segment, this does not
+        apply the registry. """
+        return ChunkRegistry.get_chunks_time_range(
+            self.study_id,
+            user_ids=json.loads(self.user_ids),
+            data_types=json.loads(self.data_types),
+            start=self.time_start,
+            end=self.time_end,
+            updated_since=self.updated_since,
+        ).filter(pk__gte=segment.first_pk, pk__lte=segment.last_pk).order_by("pk")
+    
+    @classmethod
+    def delete_expired(cls):
+        cls.objects.filter(expires_on__lt=timezone.now()).delete()
+
+
+class DataDownloadSegment(UtilityModel):
+    """ A segment of a DataDownloadSession, the results of the session's query with pks from
+    first_pk through last_pk. """
+    session: DataDownloadSession = models.ForeignKey(
+        DataDownloadSession, on_delete=models.CASCADE, related_name="segments"
+    )
+    segment = models.PositiveIntegerField()
+    first_pk = models.BigIntegerField()
+    last_pk = models.BigIntegerField()
+    files = models.PositiveIntegerField()
+    bytes = models.PositiveBigIntegerField()
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["session", "segment"], name="unique_download_segment")
+        ]
@@ -2,19 +2,22 @@ from __future__ import annotations
 
 import pickle
 import uuid
-from datetime import timedelta
+from collections import defaultdict
+from datetime import date, timedelta
 from os.path import join as path_join
-from typing import Dict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
-from django.db import models
-from django.db.models import Manager
+from django.db import models, transaction
+from django.db.models import Manager, Max, Min, Q, QuerySet, Sum
+from django.utils import timezone
 
 from config.settings import DOMAIN_NAME
+from constants.common_constants import EARLIEST_POSSIBLE_DATA_DATETIME
 from constants.celery_constants import ForestTaskStatus
-from constants.forest_constants import (DEFAULT_FOREST_PARAMETERS, FOREST_PICKLING_ERROR,
-    ForestTree, NON_PICKLED_PARAMETERS, OAK_DATE_FORMAT_PARAMETER, PARAMETER_ALL_BV_SET,
-    PARAMETER_ALL_MEMORY_DICT, PARAMETER_CONFIG_PATH, PARAMETER_INTERVENTIONS_FILEPATH,
-    ROOT_FOREST_TASK_PATH, SYCAMORE_DATE_FORMAT)
+from constants.forest_constants import (DATA_QUANTITY_FIELD_NAMES, DEFAULT_FOREST_PARAMETERS,
+    FOREST_PICKLING_ERROR, ForestTree, NON_PICKLED_PARAMETERS, OAK_DATE_FORMAT_PARAMETER,
+    PARAMETER_ALL_BV_SET, PARAMETER_ALL_MEMORY_DICT, PARAMETER_CONFIG_PATH,
+    PARAMETER_INTERVENTIONS_FILEPATH, ROOT_FOREST_TASK_PATH, SYCAMORE_DATE_FORMAT)
 from database.common_models import TimestampedModel
 from database.user_models_participant import Participant
 from libs.utils.date_utils import datetime_to_list
@@ -42,12 +45,23 @@ class ForestTask(TimestampedModel):
     # all forest tasks run on a data range, (these are parameters entered at creation from the web)
     data_date_start = models.DateField()  # inclusive
     data_date_end = models.DateField()  # inclusive
+    # incremental tasks only (re)compute the dates in their range that have new or changed data, and
+    # Forest runs on the range of those dates, see get_stale_dates in celery_forest.py
+    incremental = models.BooleanField(default=False)
+    stale_date_count = models.IntegerField(blank=True, null=True)  # dates an incremental task computed
+    stale_date_start = models.DateField(blank=True, null=True)  # inclusive
+    stale_date_end = models.DateField(blank=True, null=True)  # inclusive
     
     # runtime records
     total_file_size = models.BigIntegerField(blank=True, null=True)  # input file size sum for accounting
     process_start_time = models.DateTimeField(null=True, blank=True)
     process_download_end_time = models.DateTimeField(null=True, blank=True)
     process_end_time = models.DateTimeField(null=True, blank=True)
+    # input download progress, updated periodically while the download runs
+    download_file_count = models.IntegerField(blank=True, null=True)
+    downloaded_file_count = models.IntegerField(blank=True, null=True)
+    downloaded_bytes = models.BigIntegerField(blank=True, null=True)  # decrypted size
+    download_cache_hits = models.IntegerField(blank=True, null=True)
     status = models.TextField(choices=ForestTaskStatus.choices())
     stacktrace = models.TextField(null=True, blank=True, default=None)
     # Whether or not there was any data output by Forest (None means construct_summary_statistics errored)
@@ -70,6 +84,16 @@ class ForestTask(TimestampedModel):
         # this is the Foreign key reference field name in SummaryStatisticDaily
         return self.forest_tree + "_task"
     
+    @property
+    def download_bytes_per_second(self) -> Optional[float]:
+        """ Throughput of the input download, so far if it is still running. (The download starts
+        right after process_start_time.) """
+        if not self.downloaded_bytes or not self.process_start_time:
+            return None
+        end = self.process_download_end_time or timezone.now()
+        seconds = (end - self.process_start_time).total_seconds()
+        return self.downloaded_bytes / seconds if seconds > 0 else None
+    
     @property
     def sentry_tags(self) -> Dict[str, str]:
         from libs.utils.http_utils import easy_url
@@ -85,6 +109,14 @@ class ForestTask(TimestampedModel):
             "task_page": url,
             # "pickled_parameters": self.pickled_parameters,
             "total_file_size": str(self.total_file_size),
+            "incremental": str(self.incremental),
+            "stale_date_count": str(self.stale_date_count),
+            "stale_date_start": self.stale_date_start.isoformat() if self.stale_date_start else "None",
+            "stale_date_end": self.stale_date_end.isoformat() if self.stale_date_end else "None",
+            "download_file_count": str(self.download_file_count),
+            "downloaded_file_count": str(self.downloaded_file_count),
+            "downloaded_bytes": str(self.downloaded_bytes),
+            "download_cache_hits": str(self.download_cache_hits),
             "data_date_start": self.data_date_start.isoformat() if self.data_date_start else "None",
             "data_date_end": self.data_date_end.isoformat() if self.data_date_end else "None",
             "process_start_time": self.process_start_time.isoformat() if self.process_start_time else "None",
@@ -167,27 +199,37 @@ class ForestTask(TimestampedModel):
         if self.forest_tree == ForestTree.sycamore:
             self.assemble_sycamore_folder_path_params(params)
     
+    @property
+    def run_date_start(self) -> date:
+        """ The first date Forest runs on, incremental tasks run on the range of their stale dates. """
+        return self.stale_date_start or self.data_date_start
+    
+    @property
+    def run_date_end(self) -> date:
+        return self.stale_date_end or self.data_date_end
+    
     # TODO: forest uses date components/strings because previously we did not pickle the parameters.
     def handle_tree_specific_date_params(self, params: dict):
         # We need to add a day, this model tracks time end inclusively, but Forest expects it
         # exclusively
+        run_date_start, run_date_end = self.run_date_start, self.run_date_end
         
         if self.forest_tree == ForestTree.sycamore:
             # sycamore expects "time_end" and "time_start" as strings in the format "YYYY-MM-DD"
             params.update({
-                "start_date": self.data_date_start.strftime(SYCAMORE_DATE_FORMAT),
-                "end_date": (self.data_date_end + timedelta(days=1)).strftime(SYCAMORE_DATE_FORMAT),
+                "start_date": run_date_start.strftime(SYCAMORE_DATE_FORMAT),
+                "end_date": (run_date_end + timedelta(days=1)).strftime(SYCAMORE_DATE_FORMAT),
             })
         elif self.forest_tree == ForestTree.oak:
             # oak expects "time_end" and "time_start" as strings in the format "YYYY-MM-DD HH_MM_SS"
             params.update({
-                "time_start": self.data_date_start.strftime(OAK_DATE_FORMAT_PARAMETER),
-                "time_end": (self.data_date_end + timedelta(days=1)).strftime(OAK_DATE_FORMAT_PARAMETER),
+                "time_start": run_date_start.strftime(OAK_DATE_FORMAT_PARAMETER),
+                "time_end": (run_date_end + timedelta(days=1)).strftime(OAK_DATE_FORMAT_PARAMETER),
             })
         else:
             # other trees expect lists of datetime parameters.
-            params.update({"time_start": datetime_to_list(self.data_date_start),
-                           "time_end": datetime_to_list(self.data_date_end + timedelta(days=1))})
+            params.update({"time_start": datetime_to_list(run_date_start),
+                           "time_end": datetime_to_list(run_date_end + timedelta(days=1))})
     
     def assemble_jasmine_dynamic_params(self, params: dict):
         """ real code is in libs/forest_utils.py """
@@ -279,6 +321,27 @@ class ForestTask(TimestampedModel):
         return path_join(self.s3_base_folder, 'all_memory_dict.pkl')
 
 
+class SummaryStatisticDailyQuerySet(QuerySet):
+    """ Queryset deletes and updates bypass SummaryStatisticDaily.save, they refresh the rollups of
+    the affected participants instead. """
+    
+    def delete(self):
+        participant_ids = list(self.values_list("participant_id", flat=True).distinct())
+        ret = super().delete()
+        if participant_ids:
+            DataQuantityRollup.refresh(participant_ids)
+        return ret
+    
+    def update(self, **kwargs):
+        if not any(field in DATA_QUANTITY_FIELD_NAMES or field == "date" for field in kwargs):
+            return super().update(**kwargs)
+        participant_ids = list(self.values_list("participant_id", flat=True).distinct())
+        ret = super().update(**kwargs)
+        if participant_ids:
+            DataQuantityRollup.refresh(participant_ids)
+        return ret
+
+
 class SummaryStatisticDaily(TimestampedModel):
     participant: Participant = models.ForeignKey(Participant, on_delete=models.CASCADE)
     date = models.DateField(db_index=True)
@@ -374,6 +437,78 @@ class SummaryStatisticDaily(TimestampedModel):
             models.UniqueConstraint(fields=['date', 'participant'], name="unique_summary_statistic")
         ]
     
+    objects = SummaryStatisticDailyQuerySet.as_manager()
+    
+    def save(self, *args, **kwargs):
+        # the rollups are updated with the change to this row's data quantity values.
+        fields = DATA_QUANTITY_FIELD_NAMES
+        if kwargs.get("update_fields") is not None:
+            fields = [field for field in fields if field in kwargs["update_fields"]]
+        old_values = {}
+        if self.pk is not None:
+            old_values = SummaryStatisticDaily.objects.filter(pk=self.pk) \
+                .values("date", *fields).first() or {}
+        
+        super().save(*args, **kwargs)
+        
+        changes = []
+        for field in fields:
+            old_value, new_value = old_values.get(field, None), getattr(self, field)
+            if old_values and old_values["date"] != self.date:
+                changes.append((old_values["date"], field, old_value, None))
+                old_value = None
+            changes.append((self.date, field, old_value, new_value))
+        DataQuantityRollup.apply_changes(self.participant_id, changes)
+    
+    @classmethod
+    def bulk_upsert(
+        cls, participant_id: int, values_by_date: Dict[date, Dict[str, Any]], batch_size: int = 2000
+    ):
+        """ Creates or updates the participant's SummaryStatisticDaily for each date with a bulk
+        INSERT ... ON CONFLICT (participant, date) DO UPDATE. Only the fields present in the values
+        are written, so the different writers (data quantity stats, each forest tree) never overwrite
+        each other's columns. New rows require a timezone. """
+        # every row in an upsert statement updates the same columns, group rows by their fields.
+        summaries_by_fields = defaultdict(list)
+        for day, values in values_by_date.items():
+            summaries_by_fields[tuple(sorted(values))].append(
+                cls(participant_id=participant_id, date=day, **values)
+            )
+        if not summaries_by_fields:
+            return
+        
+        data_quantity_fields = sorted({
+            field for fields in summaries_by_fields for field in fields
+            if field in DATA_QUANTITY_FIELD_NAMES
+        })
+        with transaction.atomic():
+            # the current data quantity values are needed to update the rollups.
+            old_values = {}
+            if data_quantity_fields:
+                old_values = {
+                    values.pop("date"): values for values in cls.objects.filter(
+                        participant_id=participant_id,
+                        date__gte=min(values_by_date),
+                        date__lte=max(values_by_date),
+                    ).values("date", *data_quantity_fields)
+                }
+            
+            for fields, summaries in summaries_by_fields.items():
+                cls.objects.bulk_create(
+                    summaries,
+                    batch_size=batch_size,
+                    update_conflicts=True,
+                    unique_fields=["participant", "date"],
+                    update_fields=[*fields, "last_updated"],
+                )
+            
+            if data_quantity_fields:
+                DataQuantityRollup.apply_changes(participant_id, (
+                    (day, field, old_values.get(day, {}).get(field, None), value)
+                    for day, values in values_by_date.items()
+                    for field, value in values.items() if field in DATA_QUANTITY_FIELD_NAMES
+                ))
+    
     @classmethod
     def beiwe_fields(cls):
         return [field.name for field in cls._meta.get_fields() if field.name.startswith("beiwe_")]
@@ -393,3 +528,127 @@ class SummaryStatisticDaily(TimestampedModel):
     @classmethod
     def oak_fields(cls):
         return [field.name for field in cls._meta.get_fields() if field.name.startswith("oak_")]
+
+
+class DataQuantityRollup(TimestampedModel):
+    """ Per participant, per data stream totals of the SummaryStatisticDaily data quantity fields,
+    so that dashboards don't have to aggregate over every participant-day. Updated with the changes
+    whenever those fields are written (SummaryStatisticDaily.save and bulk_upsert), and refreshed
+    after queryset deletes and updates. The first and last days are the days where the field is not
+    null, excluding junk dates before EARLIEST_POSSIBLE_DATA_DATETIME. """
+    study = models.ForeignKey(
+        'Study', on_delete=models.CASCADE, related_name="data_quantity_rollups", db_index=False
+    )
+    participant: Participant = models.ForeignKey(
+        Participant, on_delete=models.CASCADE, related_name="data_quantity_rollups"
+    )
+    field_name = models.CharField(max_length=64)  # a DATA_QUANTITY_FIELD_NAMES field name
+    first_day = models.DateField(null=True, blank=True)
+    last_day = models.DateField(null=True, blank=True)
+    total_bytes = models.PositiveBigIntegerField(default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["participant", "field_name"], name="unique_data_quantity_rollup"
+            )
+        ]
+        indexes = [models.Index(fields=["study", "field_name"], name="data_quantity_rollup_idx")]
+    
+    @classmethod
+    def apply_changes(
+        cls, participant_id: int, changes: Iterable[Tuple[date, str, Optional[int], Optional[int]]]
+    ):
+        """ Updates the participant's rollups with changes to SummaryStatisticDaily data quantity
+        values, as (date, field name, old value, new value), a value is None if there is no data.
+        Only a change that removes the data of a field's first or last day requires re-aggregating
+        that field. """
+        earliest_day = EARLIEST_POSSIBLE_DATA_DATETIME.date()
+        byte_deltas = defaultdict(int)
+        added_days = defaultdict(list)
+        removed_days = defaultdict(list)
+        for day, field, old_value, new_value in changes:
+            if old_value == new_value:
+                continue
+            byte_deltas[field] += (new_value or 0) - (old_value or 0)
+            if day >= earliest_day and old_value is None:
+                added_days[field].append(day)
+            elif day >= earliest_day and new_value is None:
+                removed_days[field].append(day)
+        if not byte_deltas:
+            return
+        
+        with transaction.atomic():
+            rollups = {
+                rollup.field_name: rollup for rollup in cls.objects.select_for_update()
+                .filter(participant_id=participant_id, field_name__in=list(byte_deltas))
+            }
+            study_id = None
+            refresh_fields = []
+            updated_rollups = []
+            for field, byte_delta in byte_deltas.items():
+                rollup = rollups.get(field, None)
+                if rollup is None:
+                    if study_id is None:
+                        study_id = Participant.objects.filter(pk=participant_id) \
+                            .values_list("study_id", flat=True).get()
+                    rollup = cls(study_id=study_id, participant_id=participant_id, field_name=field)
+                elif rollup.first_day in removed_days[field] or rollup.last_day in removed_days[field]:
+                    refresh_fields.append(field)
+                    continue
+                
+                rollup.total_bytes = max(rollup.total_bytes + byte_delta, 0)
+                days = [day for day in (rollup.first_day, rollup.last_day) if day is not None]
+                days.extend(added_days[field])
+                rollup.first_day = min(days, default=None)
+                rollup.last_day = max(days, default=None)
+                updated_rollups.append(rollup)
+            
+            cls.objects.bulk_create(
+                updated_rollups,
+                update_conflicts=True,
+                unique_fields=["participant", "field_name"],
+                update_fields=["first_day", "last_day", "total_bytes", "last_updated"],
+            )
+            if refresh_fields:
+                cls.refresh([participant_id], refresh_fields)
+    
+    @classmethod
+    def refresh(cls, participant_ids: List[int], fields: List[str] = DATA_QUANTITY_FIELD_NAMES):
+        """ Recalculates the rollups of the fields for the participants from scratch, this is one
+        aggregate query over the participants' SummaryStatisticDaily rows and one bulk upsert. """
+        aggregates = {}
+        for field in fields:
+            has_data = Q(**{f"{field}__isnull": False}, date__gte=EARLIEST_POSSIBLE_DATA_DATETIME)
+            aggregates[f"total_{field}"] = Sum(field)
+            aggregates[f"first_{field}"] = Min("date", filter=has_data)
+            aggregates[f"last_{field}"] = Max("date", filter=has_data)
+        
+        query = SummaryStatisticDaily.objects.filter(participant_id__in=participant_ids) \
+            .values("participant_id", "participant__study_id").order_by().annotate(**aggregates)
+        
+        rollups = []
+        for row in query:
+            for field in fields:
+                rollups.append(cls(
+                    study_id=row["participant__study_id"],
+                    participant_id=row["participant_id"],
+                    field_name=field,
+                    first_day=row[f"first_{field}"],
+                    last_day=row[f"last_{field}"],
+                    total_bytes=row[f"total_{field}"] or 0,
+                ))
+        cls.objects.bulk_create(
+            rollups,
+            batch_size=2000,
+            update_conflicts=True,
+            unique_fields=["participant", "field_name"],
+            update_fields=["first_day", "last_day", "total_bytes", "last_updated"],
+        )
+        
+        # participants with no SummaryStatisticDaily rows have no data
+        participants_with_data = {rollup.participant_id for rollup in rollups}
+        cls.objects.filter(
+            participant_id__in=[pk for pk in participant_ids if pk not in participants_with_data],
+            field_name__in=fields,
+        ).delete()
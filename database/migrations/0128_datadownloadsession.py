@@ -0,0 +1,35 @@
+# Generated by Django 4.2.15 on 2026-10-18 21:03
+
+import database.common_models
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0127_study_end_date_study_manually_stopped'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataDownloadSession',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('session_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('segments', database.common_models.JSONTextField()),
+                ('total_files', models.PositiveIntegerField()),
+                ('total_bytes', models.PositiveBigIntegerField()),
+                ('sync_cursor', models.DateTimeField()),
+                ('expires_on', models.DateTimeField(db_index=True)),
+                ('researcher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='download_sessions', to='database.researcher')),
+                ('study', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='download_sessions', to='database.study')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.15 on 2026-10-18 21:18
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class AddIndexConcurrentlyOnPostgres(AddIndexConcurrently):
+    """ The ChunkRegistry table is huge, a normal index creation would block writes (data
+    processing) for the duration. Other databases (sqlite, in tests) get a normal index. """
+    
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "postgresql":
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+    
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "postgresql":
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_backwards(self, app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+    atomic = False  # concurrent index creation cannot run inside a transaction
+
+    dependencies = [
+        ('database', '0128_datadownloadsession'),
+    ]
+
+    operations = [
+        AddIndexConcurrentlyOnPostgres(
+            model_name='chunkregistry',
+            index=models.Index(fields=['study', 'participant', 'data_type', 'time_bin'], include=('id', 'chunk_path', 'chunk_hash', 'survey', 'file_size'), name='chunk_registry_download_idx'),
+        ),
+    ]
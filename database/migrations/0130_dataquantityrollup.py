@@ -0,0 +1,78 @@
+# Generated by Django 4.2.15 on 2026-10-18 21:40
+
+from datetime import datetime
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Max, Min, Q, Sum
+from django.utils import timezone
+
+# (copied so that this migration does not depend on current code)
+DATA_QUANTITY_FIELD_NAMES = [
+    "beiwe_accelerometer_bytes", "beiwe_ambient_audio_bytes", "beiwe_app_log_bytes",
+    "beiwe_bluetooth_bytes", "beiwe_calls_bytes", "beiwe_devicemotion_bytes", "beiwe_gps_bytes",
+    "beiwe_gyro_bytes", "beiwe_identifiers_bytes", "beiwe_ios_log_bytes",
+    "beiwe_magnetometer_bytes", "beiwe_power_state_bytes", "beiwe_proximity_bytes",
+    "beiwe_reachability_bytes", "beiwe_survey_answers_bytes", "beiwe_survey_timings_bytes",
+    "beiwe_texts_bytes", "beiwe_audio_recordings_bytes", "beiwe_wifi_bytes",
+]
+EARLIEST_POSSIBLE_DATA_DATETIME = datetime(2014, 8, 1, tzinfo=timezone.utc)
+
+
+def populate_data_quantity_rollups(apps, schema_editor):
+    SummaryStatisticDaily = apps.get_model('database', 'SummaryStatisticDaily')
+    DataQuantityRollup = apps.get_model('database', 'DataQuantityRollup')
+    
+    aggregates = {}
+    for field in DATA_QUANTITY_FIELD_NAMES:
+        has_data = Q(**{f"{field}__isnull": False}, date__gte=EARLIEST_POSSIBLE_DATA_DATETIME)
+        aggregates[f"total_{field}"] = Sum(field)
+        aggregates[f"first_{field}"] = Min("date", filter=has_data)
+        aggregates[f"last_{field}"] = Max("date", filter=has_data)
+    
+    query = SummaryStatisticDaily.objects.values("participant_id", "participant__study_id") \
+        .order_by().annotate(**aggregates)
+    rollups = []
+    for row in query.iterator():
+        for field in DATA_QUANTITY_FIELD_NAMES:
+            rollups.append(DataQuantityRollup(
+                study_id=row["participant__study_id"],
+                participant_id=row["participant_id"],
+                field_name=field,
+                first_day=row[f"first_{field}"],
+                last_day=row[f"last_{field}"],
+                total_bytes=row[f"total_{field}"] or 0,
+            ))
+    DataQuantityRollup.objects.bulk_create(rollups, batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0129_chunkregistry_download_idx'),
+    ]
+    
+    operations = [
+        migrations.CreateModel(
+            name='DataQuantityRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('field_name', models.CharField(max_length=64)),
+                ('first_day', models.DateField(blank=True, null=True)),
+                ('last_day', models.DateField(blank=True, null=True)),
+                ('total_bytes', models.PositiveBigIntegerField(default=0)),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='data_quantity_rollups', to='database.participant')),
+                ('study', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='data_quantity_rollups', to='database.study')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['study', 'field_name'], name='data_quantity_rollup_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dataquantityrollup',
+            constraint=models.UniqueConstraint(fields=('participant', 'field_name'), name='unique_data_quantity_rollup'),
+        ),
+        migrations.RunPython(populate_data_quantity_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.15 on 2026-10-18 21:58
+
+from django.db import migrations, models
+
+# (copied so that this migration does not depend on current code)
+HEARTBEAT_REFERENCE_FIELDS = (
+    "last_upload",
+    "last_get_latest_surveys",
+    "last_set_password",
+    "last_set_fcm_token",
+    "last_get_latest_device_settings",
+    "last_register_user",
+    "last_heartbeat_checkin",
+    "last_heartbeat_notification",
+)
+
+
+def populate_heartbeat_reference_times(apps, schema_editor):
+    Participant = apps.get_model('database', 'Participant')
+    
+    participants = []
+    for participant_id, *timestamps in Participant.objects \
+            .values_list("id", *HEARTBEAT_REFERENCE_FIELDS).iterator():
+        if any(timestamps):
+            participants.append(Participant(
+                id=participant_id, heartbeat_reference_time=max(t for t in timestamps if t)
+            ))
+    Participant.objects.bulk_update(participants, ["heartbeat_reference_time"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0130_dataquantityrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participant',
+            name='heartbeat_reference_time',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(populate_heartbeat_reference_times, migrations.RunPython.noop),
+    ]
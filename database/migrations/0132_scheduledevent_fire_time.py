@@ -0,0 +1,55 @@
+# Generated by Django 4.2.15 on 2026-10-18 22:03
+
+from dateutil.tz import gettz, UTC
+from django.db import migrations, models
+
+
+# (copied so that this migration does not depend on current code)
+def calculate_fire_time(scheduled_time, study_tz_name, participant_tz_name, unknown_timezone):
+    participant_tz = gettz(study_tz_name) if unknown_timezone else gettz(participant_tz_name)
+    participant_tz = participant_tz or UTC
+    study_tz = gettz(study_tz_name) or UTC
+    canonical_time = scheduled_time.astimezone(study_tz)
+    return canonical_time.replace(tzinfo=participant_tz).astimezone(UTC)
+
+
+def populate_fire_times(apps, schema_editor):
+    ScheduledEvent = apps.get_model('database', 'ScheduledEvent')
+    
+    # deleted events are never sent, the fire time is set when they are saved.
+    scheduled_events = []
+    for event_id, scheduled_time, study_tz_name, participant_tz_name, unknown_timezone in \
+            ScheduledEvent.objects.filter(deleted=False).values_list(
+                "id",
+                "scheduled_time",
+                "participant__study__timezone_name",
+                "participant__timezone_name",
+                "participant__unknown_timezone",
+            ).iterator():
+        scheduled_events.append(ScheduledEvent(
+            id=event_id,
+            fire_time=calculate_fire_time(
+                scheduled_time, study_tz_name, participant_tz_name, unknown_timezone
+            ),
+        ))
+    ScheduledEvent.objects.bulk_update(scheduled_events, ["fire_time"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0131_participant_heartbeat_reference_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scheduledevent',
+            name='fire_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(populate_fire_times, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='scheduledevent',
+            index=models.Index(condition=models.Q(('deleted', False)), fields=['fire_time'], name='scheduled_event_due_idx'),
+        ),
+    ]
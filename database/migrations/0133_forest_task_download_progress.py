@@ -0,0 +1,33 @@
+# Generated by Django 4.2.15 on 2026-10-18 22:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0132_scheduledevent_fire_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foresttask',
+            name='download_cache_hits',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='foresttask',
+            name='download_file_count',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='foresttask',
+            name='downloaded_bytes',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='foresttask',
+            name='downloaded_file_count',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
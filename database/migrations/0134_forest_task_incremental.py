@@ -0,0 +1,23 @@
+# Generated by Django 4.2.15 on 2026-10-18 22:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0133_forest_task_download_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foresttask',
+            name='incremental',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='foresttask',
+            name='stale_date_count',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
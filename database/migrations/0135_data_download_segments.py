@@ -0,0 +1,72 @@
+# Generated by Django 4.2.15 on 2026-10-18 22:51
+
+import database.common_models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def delete_download_sessions(apps, schema_editor):
+    # existing sessions stored their segments in the removed field, they can't be resumed.
+    DataDownloadSession = apps.get_model('database', 'DataDownloadSession')
+    DataDownloadSession.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0134_forest_task_incremental'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_download_sessions, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='datadownloadsession',
+            name='segments',
+        ),
+        migrations.AddField(
+            model_name='datadownloadsession',
+            name='data_types',
+            field=database.common_models.JSONTextField(default='[]'),
+        ),
+        migrations.AddField(
+            model_name='datadownloadsession',
+            name='registry',
+            field=database.common_models.JSONTextField(default='{}'),
+        ),
+        migrations.AddField(
+            model_name='datadownloadsession',
+            name='time_end',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='datadownloadsession',
+            name='time_start',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='datadownloadsession',
+            name='updated_since',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='datadownloadsession',
+            name='user_ids',
+            field=database.common_models.JSONTextField(default='[]'),
+        ),
+        migrations.CreateModel(
+            name='DataDownloadSegment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('segment', models.PositiveIntegerField()),
+                ('first_pk', models.BigIntegerField()),
+                ('last_pk', models.BigIntegerField()),
+                ('files', models.PositiveIntegerField()),
+                ('bytes', models.PositiveBigIntegerField()),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segments', to='database.datadownloadsession')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='datadownloadsegment',
+            constraint=models.UniqueConstraint(fields=('session', 'segment'), name='unique_download_segment'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.15 on 2026-10-18 22:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0135_data_download_segments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foresttask',
+            name='stale_date_end',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='foresttask',
+            name='stale_date_start',
+            field=models.DateField(blank=True, null=True),
+        ),
+    ]
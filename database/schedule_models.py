@@ -1,11 +1,13 @@
 from __future__ import annotations
 
 from datetime import date, datetime, time, timedelta, tzinfo
-from typing import List, Tuple
+from typing import Dict, Iterable, List, Tuple
 
+from dateutil.tz import gettz, UTC
 from django.core.validators import MaxValueValidator
 from django.db import models
-from django.db.models import Manager
+from django.db.models import Manager, Q, QuerySet
+from django.utils import timezone
 from django.utils.timezone import make_aware
 
 from constants.schedule_constants import ScheduleTypes
@@ -23,6 +25,32 @@ except ImportError:
 class BadWeeklyCount(Exception): pass
 
 
+def sync_schedules(schedules: QuerySet, fields: Tuple[str, ...], desired: List[tuple], survey: Survey):
+    """ Makes a survey's schedules match the desired values of fields: schedules that are no longer
+    desired are deleted (cascading to their ScheduledEvents) and missing schedules are created.
+    Unchanged schedules, and their ScheduledEvents, are left alone. """
+    desired = set(desired)
+    kept = set()
+    obsolete_ids = []
+    for pk, *values in schedules.values_list("pk", *fields):
+        values = tuple(values)
+        if values in desired and values not in kept:
+            kept.add(values)
+        else:
+            obsolete_ids.append(pk)
+    
+    new_schedules = [
+        schedules.model(survey=survey, **dict(zip(fields, values))) for values in desired - kept
+    ]
+    # bulk_create skips the full_clean in save, validate the values (foreign keys are already valid).
+    for schedule in new_schedules:
+        schedule.clean_fields(exclude=["survey", "intervention"])
+    
+    if obsolete_ids:
+        schedules.filter(pk__in=obsolete_ids).delete()
+    schedules.model.objects.bulk_create(new_schedules)
+
+
 class AbsoluteSchedule(TimestampedModel):
     survey: Survey = models.ForeignKey('Survey', on_delete=models.CASCADE, related_name='absolute_schedules')
     date = models.DateField(null=False, blank=False)
@@ -45,24 +73,18 @@ class AbsoluteSchedule(TimestampedModel):
     
     @staticmethod
     def create_absolute_schedules(timings: List[List[int]], survey: Survey) -> bool:
-        """ Creates new AbsoluteSchedule objects from a frontend-style list of dates and times"""
-        survey.absolute_schedules.all().delete()
-        
+        """ Creates new AbsoluteSchedule objects from a frontend-style list of dates and times,
+        unchanged schedules are kept. """
         if survey.deleted or not timings:
+            survey.absolute_schedules.all().delete()
             return False
         
-        duplicated = False
-        for year, month, day, num_seconds in timings:
-            _, created = AbsoluteSchedule.objects.get_or_create(
-                survey=survey,
-                date=date(year=year, month=month, day=day),
-                hour=num_seconds // 3600,
-                minute=num_seconds % 3600 // 60
-            )
-            if not created:
-                duplicated = True
-        
-        return duplicated
+        desired = [
+            (date(year=year, month=month, day=day), num_seconds // 3600, num_seconds % 3600 // 60)
+            for year, month, day, num_seconds in timings
+        ]
+        sync_schedules(survey.absolute_schedules.all(), ("date", "hour", "minute"), desired, survey)
+        return len(set(desired)) != len(desired)
 
 
 class RelativeSchedule(TimestampedModel):
@@ -92,25 +114,27 @@ class RelativeSchedule(TimestampedModel):
     @staticmethod
     def create_relative_schedules(timings: List[List[int]], survey: Survey) -> bool:
         """ Creates new RelativeSchedule objects from a frontend-style list of interventions and times
-        If you modify this please update create_relative_schedules_by_name in libs.copy_study too. """
-        survey.relative_schedules.all().delete()
+        If you modify this please update create_relative_schedules_by_name in libs.copy_study too.
+        Unchanged schedules are kept. """
         if survey.deleted or not timings:
+            survey.relative_schedules.all().delete()
             return False
         
-        duplicated = False
-        for intervention_id, days_after, num_seconds in timings:
-            # using get_or_create to catch duplicate schedules
-            _, created = RelativeSchedule.objects.get_or_create(
-                survey=survey,
-                intervention=Intervention.objects.get(id=intervention_id),
-                days_after=days_after,
-                hour=num_seconds // 3600,
-                minute=num_seconds % 3600 // 60,
-            )
-            if not created:
-                duplicated = True
+        desired = [
+            (intervention_id, days_after, num_seconds // 3600, num_seconds % 3600 // 60)
+            for intervention_id, days_after, num_seconds in timings
+        ]
+        intervention_ids = {intervention_id for intervention_id, *_ in desired}
+        if Intervention.objects.filter(id__in=intervention_ids).count() != len(intervention_ids):
+            raise Intervention.DoesNotExist("Intervention matching query does not exist.")
         
-        return duplicated
+        sync_schedules(
+            survey.relative_schedules.all(),
+            ("intervention_id", "days_after", "hour", "minute"),
+            desired,
+            survey,
+        )
+        return len(set(desired)) != len(desired)
 
 
 class WeeklySchedule(TimestampedModel):
@@ -130,7 +154,8 @@ class WeeklySchedule(TimestampedModel):
     
     @staticmethod
     def create_weekly_schedules(timings: List[List[int]], survey: Survey) -> bool:
-        """ Creates new WeeklySchedule objects from a frontend-style list of seconds into the day. """
+        """ Creates new WeeklySchedule objects from a frontend-style list of seconds into the day,
+        unchanged schedules are kept. """
         
         if survey.deleted or not timings:
             survey.weekly_schedules.all().delete()
@@ -141,22 +166,16 @@ class WeeklySchedule(TimestampedModel):
             raise BadWeeklyCount(
                 f"Must have schedule for every day of the week, found {len(timings)} instead."
             )
-        survey.weekly_schedules.all().delete()
         
-        duplicated = False
-        for day in range(7):
-            for seconds in timings[day]:
-                # should be all ints, use integer division.
-                hour = seconds // 3600
-                minute = seconds % 3600 // 60
-                # using get_or_create to catch duplicate schedules
-                _, created = WeeklySchedule.objects.get_or_create(
-                    survey=survey, day_of_week=day, hour=hour, minute=minute
-                )
-                if not created:
-                    duplicated = True
-        
-        return duplicated
+        # should be all ints, use integer division.
+        desired = [
+            (day, seconds // 3600, seconds % 3600 // 60)
+            for day in range(7) for seconds in timings[day]
+        ]
+        sync_schedules(
+            survey.weekly_schedules.all(), ("day_of_week", "hour", "minute"), desired, survey
+        )
+        return len(set(desired)) != len(desired)
     
     @classmethod
     def export_survey_timings(cls, survey: Survey) -> List[List[int]]:
@@ -201,6 +220,15 @@ class ScheduledEvent(TimestampedModel):
     uuid = models.UUIDField(null=True, blank=True, db_index=True, unique=True)
     checkin_time = models.DateTimeField(null=True, blank=True, db_index=True)
     most_recent_event: ArchivedEvent = models.ForeignKey("ArchivedEvent", on_delete=models.DO_NOTHING, null=True, blank=True)
+    # the time (in UTC) that the push notification is due, the scheduled time shifted into the
+    # participant's timezone. Maintained on save, see populate_fire_times and update_fire_times.
+    fire_time = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        # push notification sending only ever looks at undeleted events that are due.
+        indexes = [
+            models.Index(fields=["fire_time"], condition=Q(deleted=False), name="scheduled_event_due_idx")
+        ]
     
     # due to import complexity (needs those classes) this is the best place to stick the lookup dict.
     SCHEDULE_CLASS_LOOKUP = {
@@ -217,8 +245,60 @@ class ScheduledEvent(TimestampedModel):
         # canonical form is the study timezone, that should match the time of day on the survey editor
         return self.scheduled_time.astimezone(self.survey.study.timezone)
     
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields", None)
+        if update_fields is None or "scheduled_time" in update_fields:
+            participant = self.participant
+            self.fire_time = calculate_fire_time(
+                self.scheduled_time,
+                self.survey.study.timezone_name,
+                participant.timezone_name,
+                participant.unknown_timezone,
+            )
+            if update_fields is not None:
+                kwargs["update_fields"] = [*update_fields, "fire_time"]
+        super().save(*args, **kwargs)
+    
+    @staticmethod
+    def populate_fire_times(scheduled_events: List[ScheduledEvent]):
+        """ Sets the fire time on unsaved ScheduledEvents, call before a bulk_create. One query. """
+        timezones = get_participant_timezones(
+            {scheduled_event.participant_id for scheduled_event in scheduled_events}
+        )
+        for scheduled_event in scheduled_events:
+            scheduled_event.fire_time = calculate_fire_time(
+                scheduled_event.scheduled_time, *timezones[scheduled_event.participant_id]
+            )
+    
+    @staticmethod
+    def update_fire_times(participant_ids: Iterable[int]) -> int:
+        """ Recalculates the fire times of the participants' undeleted ScheduledEvents, call after
+        changing a participant's timezone. Returns the number of events updated. """
+        timezones = get_participant_timezones(participant_ids)
+        scheduled_events = list(
+            ScheduledEvent.objects.filter(participant_id__in=timezones.keys(), deleted=False)
+            .only("id", "participant_id", "scheduled_time", "fire_time")
+        )
+        for scheduled_event in scheduled_events:
+            scheduled_event.fire_time = calculate_fire_time(
+                scheduled_event.scheduled_time, *timezones[scheduled_event.participant_id]
+            )
+        return ScheduledEvent.objects.bulk_update(scheduled_events, ["fire_time"])
+    
     def get_schedule_type(self):
-        return self.SCHEDULE_CLASS_LOOKUP[self.get_schedule().__class__]
+        # checks the foreign key ids so that no schedules are fetched from the database.
+        schedule_types = [
+            schedule_type for schedule_type, schedule_id in (
+                (ScheduleTypes.weekly, self.weekly_schedule_id),
+                (ScheduleTypes.relative, self.relative_schedule_id),
+                (ScheduleTypes.absolute, self.absolute_schedule_id),
+            ) if schedule_id is not None
+        ]
+        if len(schedule_types) > 1:
+            raise Exception(f"ScheduledEvent had {len(schedule_types)} associated schedules.")
+        if not schedule_types:
+            raise Exception("ScheduledEvent had no associated schedule")
+        return schedule_types[0]
     
     def get_schedule(self):
         number_schedules = sum((
@@ -241,26 +321,86 @@ class ScheduledEvent(TimestampedModel):
     
     def archive(self, self_delete: bool, status: str, created_on: datetime = None):
         """ Create an ArchivedEvent from a ScheduledEvent. """
-        # We need to handle the case of no-existing-survey-archive on the referenced survey,  Could
-        # be cleaner, but there is an interaction with a migration that will break; not worth it.
-        try:
-            survey_archive = self.survey.most_recent_archive()
-        except SurveyArchive.DoesNotExist:
-            self.survey.archive()
-            survey_archive = self.survey.most_recent_archive()
+        ScheduledEvent.bulk_archive([self], self_delete, status, created_on)
+    
+    @staticmethod
+    def bulk_archive(
+        scheduled_events: List[ScheduledEvent], self_delete: bool, status: str,
+        created_on: datetime = None
+    ):
+        """ Create ArchivedEvents for many ScheduledEvents, conditionally marks them as deleted. A
+        fixed number of queries regardless of the number of events. """
+        if not scheduled_events:
+            return
+        
+        survey_archive_ids = get_most_recent_survey_archive_ids(
+            {scheduled_event.survey_id for scheduled_event in scheduled_events}
+        )
+        archives = ArchivedEvent.objects.bulk_create(
+            ArchivedEvent(
+                survey_archive_id=survey_archive_ids[scheduled_event.survey_id],
+                participant_id=scheduled_event.participant_id,
+                schedule_type=scheduled_event.get_schedule_type(),
+                scheduled_time=scheduled_event.scheduled_time,
+                status=status,
+                uuid=scheduled_event.uuid or None,
+                **{"created_on": created_on} if created_on else {}  # :D
+            ) for scheduled_event in scheduled_events
+        )
         
-        # create archive, link archive, conditionally mark self as deleted
-        archive = ArchivedEvent(
-            survey_archive=survey_archive,
-            participant=self.participant,
-            schedule_type=self.get_schedule_type(),
-            scheduled_time=self.scheduled_time,
-            status=status,
-            uuid=self.uuid or None,
-            **{"created_on": created_on} if created_on else {}  # :D
+        # link archives, conditionally mark as deleted
+        now = timezone.now()
+        for scheduled_event, archive in zip(scheduled_events, archives):
+            scheduled_event.most_recent_event = archive
+            scheduled_event.deleted = self_delete
+            scheduled_event.last_updated = now
+        ScheduledEvent.objects.bulk_update(
+            scheduled_events, ["most_recent_event", "deleted", "last_updated"]
         )
-        archive.save()
-        self.update(most_recent_event=archive, deleted=self_delete)
+
+
+def calculate_fire_time(
+    scheduled_time: datetime, study_tz_name: str, participant_tz_name: str, unknown_timezone: bool
+) -> datetime:
+    """ ScheduledEvents are created in the study's timezone, and in the database they are normalized
+    to UTC. Convert it to the study timezone time - we'll call that canonical time - which will be
+    the time of day assigned on the survey page. Then time-shift that into the participant's
+    timezone, the result is the time that the notification is due. """
+    # The participant and study timezones REALLY SHOULD be valid timezone names. If they aren't
+    # valid then gettz's behavior is to return None; if gettz receives None or the empty string
+    # then it returns UTC. In order to at-least-be-consistent we will coerce no timezone to UTC.
+    # (At least gettz caches, so performance should be fine without adding complexity.)
+    participant_tz = gettz(study_tz_name) if unknown_timezone else gettz(participant_tz_name)
+    participant_tz = participant_tz or UTC
+    study_tz = gettz(study_tz_name) or UTC
+    canonical_time = scheduled_time.astimezone(study_tz)
+    return canonical_time.replace(tzinfo=participant_tz).astimezone(UTC)
+
+
+def get_participant_timezones(participant_ids: Iterable[int]) -> Dict[int, Tuple[str, str, bool]]:
+    """ Returns a mapping of participant id to the timezone arguments of calculate_fire_time. """
+    from database.user_models_participant import Participant
+    query = Participant.objects.filter(pk__in=participant_ids).values_list(
+        "pk", "study__timezone_name", "timezone_name", "unknown_timezone"
+    )
+    return {pk: (study_tz_name, tz_name, unknown) for pk, study_tz_name, tz_name, unknown in query}
+
+
+def get_most_recent_survey_archive_ids(survey_ids: set) -> Dict[int, int]:
+    """ Returns a mapping of survey id to the id of its most recent SurveyArchive. """
+    survey_archive_ids = {}
+    # ordered so that the most recent archive of each survey is the last one seen.
+    query = SurveyArchive.objects.filter(survey_id__in=survey_ids) \
+        .order_by("survey_id", "archive_start").values_list("survey_id", "id")
+    for survey_id, survey_archive_id in query:
+        survey_archive_ids[survey_id] = survey_archive_id
+    
+    # We need to handle the case of no-existing-survey-archive on the referenced survey,  Could
+    # be cleaner, but there is an interaction with a migration that will break; not worth it.
+    for survey in Survey.objects.filter(id__in=survey_ids - survey_archive_ids.keys()):
+        survey.archive()
+        survey_archive_ids[survey.id] = survey.most_recent_archive().id
+    return survey_archive_ids
 
 
 class ArchivedEvent(TimestampedModel):
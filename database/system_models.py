@@ -1,6 +1,8 @@
 from __future__ import annotations
 
 import traceback
+from time import monotonic
+from typing import Dict, Tuple
 
 from django.db import models
 
@@ -25,12 +27,40 @@ class GenericEvent(TimestampedModel):
         GenericEvent.objects.create(tag=tag, note=note, stacktrace="".join(tb))
 
 
+# Process-local cache of singleton instances, keyed by model class, values are a tuple of the
+# expiration time (time.monotonic) and the instance. Saves in this process clear the entry, saves in
+# other processes (e.g. other webservers) are picked up when the entry expires.
+SINGLETON_CACHE: Dict[type, Tuple[float, "SingletonModel"]] = {}
+SINGLETON_CACHE_SECONDS = 15
+
+
 class SingletonModel(TimestampedModel):
     """ A model that destructively maintains exactly one instance. Be very careful with these
     models. """
     class Meta:
         abstract = True
     
+    @classmethod
+    def get_cached_singleton_instance(cls):
+        """ Returns a recent copy of the singleton, only hitting the database if the process-local
+        copy is older than SINGLETON_CACHE_SECONDS.  Use this on hot paths (e.g. middleware) where
+        a short delay in picking up changes is acceptable.  Treat the return as read-only. """
+        now = monotonic()
+        expiry_and_instance = SINGLETON_CACHE.get(cls, None)
+        if expiry_and_instance is not None and expiry_and_instance[0] > now:
+            return expiry_and_instance[1]
+        instance = cls.get_singleton_instance()
+        SINGLETON_CACHE[cls] = (now + SINGLETON_CACHE_SECONDS, instance)
+        return instance
+    
+    @staticmethod
+    def clear_singleton_cache():
+        SINGLETON_CACHE.clear()
+    
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        SINGLETON_CACHE.pop(type(self), None)
+    
     @classmethod
     def get_singleton_instance(cls):  # oof, can't annotate this intelligently.
         """ An objectively dumb way of making sure we only ever have one of these. """
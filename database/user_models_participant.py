@@ -20,8 +20,8 @@ from config.settings import DOMAIN_NAME
 from constants.action_log_messages import HEARTBEAT_PUSH_NOTIFICATION_SENT
 from constants.common_constants import LEGIBLE_TIME_FORMAT, RUNNING_TESTS
 from constants.data_stream_constants import ALL_DATA_STREAMS, IDENTIFIERS
-from constants.user_constants import (ACTIVE_PARTICIPANT_FIELDS, ANDROID_API, IOS_API,
-    OS_TYPE_CHOICES)
+from constants.user_constants import (ACTIVE_PARTICIPANT_FIELDS, ANDROID_API,
+    HEARTBEAT_REFERENCE_FIELDS, IOS_API, OS_TYPE_CHOICES)
 from database.common_models import UtilityModel
 from database.models import TimestampedModel
 from database.study_models import Study
@@ -76,6 +76,9 @@ class Participant(AbstractPasswordUser):
     push_notification_unreachable_count = models.SmallIntegerField(default=0, null=False, blank=False)
     last_heartbeat_notification = models.DateTimeField(null=True, blank=True)
     last_heartbeat_checkin = models.DateTimeField(null=True, blank=True)
+    # the most recent of the HEARTBEAT_REFERENCE_FIELDS, maintained in save. The heartbeat push
+    # notification query is a range scan over this field.
+    heartbeat_reference_time = models.DateTimeField(null=True, blank=True, db_index=True)
     
     # TODO: clean out or maybe rename these fields to distinguish from last_updated? also wehave two survey checkin timestamps
     # new checkin logic
@@ -152,6 +155,17 @@ class Participant(AbstractPasswordUser):
     pushnotificationdisabledevent_set: Manager[PushNotificationDisabledEvent]
     summarystatisticdaily_set: Manager[SummaryStatisticDaily]
     
+    def save(self, *args, **kwargs):
+        # keep heartbeat_reference_time up to date, including when saving only some fields.
+        self.heartbeat_reference_time = max(
+            (getattr(self, field) for field in HEARTBEAT_REFERENCE_FIELDS if getattr(self, field)),
+            default=None,
+        )
+        update_fields = kwargs.get("update_fields", None)
+        if update_fields is not None and set(update_fields) & set(HEARTBEAT_REFERENCE_FIELDS):
+            kwargs["update_fields"] = [*update_fields, "heartbeat_reference_time"]
+        super().save(*args, **kwargs)
+    
     ################################################################################################
     ###################################### Timezones ###############################################
     ################################################################################################
@@ -168,6 +182,7 @@ class Participant(AbstractPasswordUser):
         if new_timezone_name is None or new_timezone_name == "":
             raise TypeError("None and the empty string actually coerce to the UTC timezone, which is weird and undesireable.")
         
+        old_timezone = (self.timezone_name, self.unknown_timezone)
         new_tz = gettz(new_timezone_name)
         if new_tz is None:
             # if study timezone is null or empty, use the default timezone.
@@ -178,6 +193,12 @@ class Participant(AbstractPasswordUser):
         else:
             # force setting unknown_timezone false if the value is valid
             self.update_only(unknown_timezone=False, timezone_name=new_timezone_name)
+        
+        # the fire times of scheduled events depend on the participant's timezone, this runs on
+        # every authenticated request so they are only recalculated when the timezone changed.
+        if old_timezone != (self.timezone_name, self.unknown_timezone):
+            from database.schedule_models import ScheduledEvent
+            ScheduledEvent.update_fire_times([self.pk])
     
     ################################################################################################
     ########################## Participant Creation and Passwords ##################################
@@ -50,6 +50,14 @@ TASK_SERIALIZER_FIELDS = [
     "stacktrace",
     "status",
     "total_file_size",
+    "download_file_count",
+    "downloaded_file_count",
+    "downloaded_bytes",
+    "download_cache_hits",
+    "incremental",
+    "stale_date_count",
+    "stale_date_start",
+    "stale_date_end",
     # to be popped
     "external_id",  # -> uuid in the urls
     "participant__patient_id",  # -> patient_id
@@ -187,6 +195,7 @@ def copy_forest_task(request: ResearcherRequest, study_id=None):
         forest_tree=task_to_copy.forest_tree,
         data_date_start=task_to_copy.data_date_start,
         data_date_end=task_to_copy.data_date_end,
+        incremental=task_to_copy.incremental,
         status=ForestTaskStatus.queued,
     )
     new_task.save()
@@ -229,6 +238,8 @@ def task_log(request: ResearcherRequest, study_id=None):
         dict_datetime_to_display(task_dict, "process_download_end_time", None)
         task_dict["data_date_end"] = task_dict["data_date_end"].isoformat() if task_dict["data_date_end"] else None
         task_dict["data_date_start"] = task_dict["data_date_start"].isoformat() if task_dict["data_date_start"] else None
+        task_dict["stale_date_end"] = task_dict["stale_date_end"].isoformat() if task_dict["stale_date_end"] else None
+        task_dict["stale_date_start"] = task_dict["stale_date_start"].isoformat() if task_dict["stale_date_start"] else None
         
         # urls
         task_dict["cancel_url"] = easy_url(
@@ -256,7 +267,7 @@ def task_log(request: ResearcherRequest, study_id=None):
         else:
             task_dict["params_dict"] = FOREST_TASKVIEW_PICKLING_EMPTY
         tasks.append(task_dict)
-    forest_info = ForestVersion.get_singleton_instance()
+    forest_info = ForestVersion.get_cached_singleton_instance()
     return render(
         request,
         "forest/task_log.html",
@@ -454,7 +465,7 @@ def render_create_tasks(request: ResearcherRequest, study: Study):
     )
     start_date = dates[0] if dates else study.created_on.date()
     end_date = dates[-1] if dates else timezone.now().date()
-    forest_info = ForestVersion.get_singleton_instance()
+    forest_info = ForestVersion.get_cached_singleton_instance()
     
     # start_date = dates[0] if dates and dates[0] >= EARLIEST_POSSIBLE_DATA_DATE else study.created_on.date()
     # end_date = dates[-1] if dates and dates[-1] <= timezone.now().date() else timezone.now().date()
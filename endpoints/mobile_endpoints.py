@@ -2,7 +2,7 @@ import calendar
 import json
 import plistlib
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Union
 
 from django.core.exceptions import ValidationError
@@ -24,19 +24,19 @@ from constants.message_strings import (DEVICE_CHECKED_IN, DEVICE_IDENTIFIERS_HEA
     INVALID_EXTENSION_ERROR, NO_FILE_ERROR, UNKNOWN_ERROR)
 from database.data_access_models import FileToProcess
 from database.schedule_models import ScheduledEvent
-from database.survey_models import Survey
 from database.system_models import FileAsText
 from database.user_models_participant import AppHeartbeats, Participant, ParticipantFCMHistory
 from libs.encryption import (DecryptionKeyInvalidError, DeviceDataDecryptor,
     IosDecryptionKeyDuplicateError, IosDecryptionKeyNotFoundError, RemoteDeleteFileScenario)
+from libs.endpoint_helpers.device_download_helpers import (get_study_device_settings,
+    get_surveys_for_device)
 from libs.endpoint_helpers.graph_data_helpers import get_survey_results
 from libs.endpoint_helpers.participant_file_upload_helpers import (
     upload_and_create_file_to_process_and_log, upload_problem_file)
 from libs.firebase_config import check_firebase_instance
-from libs.internal_types import ParticipantRequest, ScheduledEventQuerySet
+from libs.internal_types import ParticipantRequest
 from libs.s3 import get_client_public_key_string, s3_upload
-from libs.schedules import (decompose_datetime_to_timings, export_weekly_survey_timings,
-    repopulate_all_survey_scheduled_events)
+from libs.schedules import repopulate_all_survey_scheduled_events
 from libs.sentry import get_sentry_client, SentryTypes
 from libs.utils.http_utils import determine_os_api
 from middleware.abort_middleware import abort
@@ -271,7 +271,7 @@ def register_user(request: ParticipantRequest, OS_API=""):
     
     return_obj = {
         'client_public_key': get_client_public_key_string(patient_id, participant.study.object_id),
-        'device_settings': participant.study.device_settings.export(),
+        'device_settings': get_study_device_settings(participant.study_id),
         'ios_plist': firebase_plist_data,
         'android_firebase_json': firebase_json_data,
         'study_name': participant.study.name,
@@ -353,7 +353,7 @@ def get_latest_device_settings(request: ParticipantRequest, OS_API=""):
     Endpoint is used by the app to periodically check for changes to the device settings. """
     request.session_participant.update_only(last_get_latest_device_settings=timezone.now())
     # assemble the dictionary of device settings and the participant's experiment fields
-    settings_dictionary = request.session_participant.study.device_settings.export()
+    settings_dictionary = get_study_device_settings(request.session_participant.study_id)
     for field in Participant.EXPERIMENT_FIELDS:
         settings_dictionary[field] = getattr(request.session_participant, field)
     return HttpResponse(json.dumps(settings_dictionary))
@@ -379,71 +379,7 @@ def get_latest_surveys(request: ParticipantRequest, OS_API=""):
         schedule.update(checkin_time=now)
         schedule.archive(True, DEVICE_CHECKED_IN, now)
     
-    survey_json_list = []
-    survey: Survey
-    for survey in request.session_participant.study.surveys.filter(deleted=False):
-        # block the deprecated image surveys type.
-        if survey.survey_type == "image_survey":
-            continue
-        survey_json_list.append(format_survey_for_device(survey, request.session_participant))
-    
-    return HttpResponse(json.dumps(survey_json_list))
-
-# TODO: move this stuff elsewhere.
-
-
-def format_survey_for_device(survey: Survey, participant: Participant):
-    """ Returns a dict with the values of the survey fields for download to the app """
-    survey_dict = survey.as_unpacked_native_python(Survey.SURVEY_DEVICE_EXPORT_FIELDS)
-    # Make the dict look like the old Mongolia-style dict that the frontend is expecting
-    survey_dict['_id'] = survey_dict.pop('object_id')
-    
-    # weekly defines a list of 7 lists of ints or [[], [], [], [], [], [], []]
-    survey_timings = export_weekly_survey_timings(survey)
-    
-    # While it seems complex to force arbitrary non-repeating weekly-style schedules into a
-    # weekly-based representation time, it turns out we only need to observe some rules:
-    # 1) When "now" becomes the time for a survey notification to appear, it will appear.
-    # 2) When the survey time is removed from the weekly timings the notification will disappear.
-    # 3) Time is 1 week long; keep the examined period of time less than 7 days to avoid corner cases.
-    # So, bracket our view of absolute and relative surveys schedule events like this:
-    now = survey.study.now()  # TODO: get participant device timezone
-    now_date = now.date()
-    the_past = \
-        datetime.combine((now_date - timedelta(days=4)), datetime.min.time(), tzinfo=now.tzinfo)
-    the_future = \
-        datetime.combine((now_date + timedelta(days=3)), datetime.min.time(), tzinfo=now.tzinfo)
-    
-    # This query results in a moving window of that "snaps" based on the day at midnight. retains
-    # notifications for 4 days, and gives the app 3 days of failing to check in until it is out of
-    # sync with abosule and relative surveys.
-    # (filter with __lt for the_future since we are "zeroing" to midnight, __gte for the_past.)
-    query: ScheduledEventQuerySet = survey.scheduled_events.filter(
-        scheduled_time__gte=the_past,
-        scheduled_time__lt=the_future,
-        participant=participant,
-        # deleted=False,  # ALWAYS send it. Consider notifications broken.
-    ).exclude(weekly_schedule__isnull=False)  # skip where attached weekly schedules are not null
-    
-    for schedule in query:
-        # The date component is dropped, the representation is now 100% a weekly schedule
-        # the correct timezone is the "canonical form", e.g. in the study timezone (and then in
-        # survey timings form as offset from start of day)
-        day_index, seconds = decompose_datetime_to_timings(schedule.scheduled_time_in_canonical_form)
-        survey_timings[day_index].append(seconds)
-    
-    # sort, deduplicate all days lists
-    for i in range(len(survey_timings)):
-        survey_timings[i] = sorted(set(survey_timings[i]))
-    
-    # TODO: include schedule event uuids so that we can have full survey state tracking in a v2
-    #   endpoint where we actually send a real schedule with absolute representations of time
-    #   instead of the moving window hack.
-    
-    survey_dict['timings'] = survey_timings
-    survey_dict["name"] = survey.name
-    return survey_dict
-
+    return HttpResponse(json.dumps(get_surveys_for_device(request.session_participant)))
 
 ################################################################################
 ########################### NOTIFICATION FUNCTIONS #############################
@@ -1,27 +1,37 @@
 import json
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Generator, Iterable, List, Optional, Tuple
 
 import orjson
 from dateutil import tz
 from django.db import transaction
-from django.db.models import QuerySet
-from django.http.response import FileResponse
+from django.http.response import FileResponse, HttpResponse
 from django.utils import timezone
 from django.utils.timezone import make_aware
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import require_http_methods, require_POST
 
 from authentication.data_access_authentication import api_study_credential_check
 from constants.common_constants import API_TIME_FORMAT
 from constants.data_stream_constants import ALL_DATA_STREAMS
-from constants.raw_data_constants import CHUNK_FIELDS
-from database.data_access_models import ChunkRegistry
+from constants.raw_data_constants import (CHUNK_FIELDS, DOWNLOAD_SESSION_DURATION_DAYS,
+    DOWNLOAD_SESSION_SEGMENT_BYTES, DOWNLOAD_SESSION_SEGMENT_FILES)
+from database.data_access_models import ChunkRegistry, DataDownloadSegment, DataDownloadSession
 from database.profiling_models import DataAccessRecord
 from database.user_models_participant import Participant
 from libs.internal_types import ApiStudyResearcherRequest
-from libs.streaming_zip import ZipGenerator
+from libs.streaming_zip import (COMPRESSION_NONE, COMPRESSION_OPTIONS, COMPRESSION_ZSTD,
+    ZipGenerator)
 from middleware.abort_middleware import abort
 
 
+# The sync cursor for incremental downloads is a time, chunks updated at or after it are included in
+# the next download. The overlap ensures that chunks that were being updated in a transaction that
+# had not yet committed when the download started are not missed.
+SYNC_CURSOR_HEADER = "Beiwe-Sync-Cursor"
+SYNC_CURSOR_OVERLAP = timedelta(minutes=10)
+
+
 ENABLE_DATA_API_DEBUG = False
 
 def log(*args, **kwargs):
@@ -37,27 +47,21 @@ def get_data(request: ApiStudyResearcherRequest):
     JSON blobs: data streams, users - default to all
     Strings: date-start, date-end - format as "YYYY-MM-DDThh:mm:ss"
     optional: top-up = a file (registry.dat)
+    optional: updated_since = a sync cursor, as returned in the Beiwe-Sync-Cursor header of a
+        previous download with the same query parameters. Only files added or updated since then
+        are included, the registry does not need to be sent.
+    optional: compression = "none" (default), "deflate" (a compressed zip file), or "zstd" (a
+        zstd-compressed tar file)
     cases handled:
         missing credentials or study, invalid researcher or study, researcher does not have access
         researcher credentials are invalid
     Returns a zip file of all data files found by the query. """
-    query_args = {}
+    query_args, registry_dict, compression = parse_data_query(request)
+    
+    # The cursor has to be from before the query, anything updated during the download will be
+    # included in the next one.
+    sync_cursor = timezone.now() - SYNC_CURSOR_OVERLAP
     
-    try:
-        determine_data_streams_for_db_query(request, query_args)
-        determine_users_for_db_query(request, query_args)
-        determine_time_range_for_db_query(request, query_args)
-        registry_dict = parse_registry(request)
-    except Exception as e:
-        post = dict(request.POST)
-        post["access_key"] = post["secret_key"] = "sanitized"  # guaranteed to be present
-        DataAccessRecord.objects.create(
-            researcher=request.api_researcher,
-            username=request.api_researcher.username,
-            query_params=orjson.dumps(post).decode(),
-            error="did not pass query validation, " + str(e),
-        )
-        raise
     # Do query! (this is actually a generator, it can only be iterated over once)
     get_these_files = handle_database_query(
         request.api_study.pk, query_args, registry_dict=registry_dict
@@ -71,20 +75,126 @@ def get_data(request: ApiStudyResearcherRequest):
         registry_dict_size=len(registry_dict) if registry_dict else 0,
         username=request.api_researcher.username,
     )
+    return stream_data_download(request, get_these_files, compression, record, sync_cursor)
+
+
+@require_POST
+@api_study_credential_check()
+@transaction.non_atomic_requests
+def create_data_download_session(request: ApiStudyResearcherRequest):
+    """ Takes the same parameters as get_data (compression is ignored). Instead of the data, returns
+    a json manifest of a new resumable download session: the session id, and the number of files
+    and bytes in each of its numbered segments.  Segments are downloaded via
+    get_data_download_session_segment, in any order, any number of times, until the session
+    expires. Segments contain the current version of each file when they are downloaded. """
+    query_args, registry_dict, _ = parse_data_query(request)
+    sync_cursor = timezone.now() - SYNC_CURSOR_OVERLAP
+    # segments are ranges of pks, so the chunks are split in pk order.
+    chunks = ChunkRegistry.get_chunks_time_range(request.api_study.pk, **query_args) \
+        .order_by("pk").values("pk", "chunk_path", "chunk_hash", "file_size").iterator()
+    # only the registry entries that exclude a chunk are needed to serve the segments.
+    excluded_registry = {}
+    if registry_dict:
+        chunks = exclude_registered_chunks(chunks, registry_dict, excluded_registry)
+    segments = split_download_segments(chunks)
+    
+    DataDownloadSession.delete_expired()
+    session = DataDownloadSession.objects.create(
+        study=request.api_study,
+        researcher=request.api_researcher,
+        user_ids=json.dumps(query_args.get("user_ids", [])),
+        data_types=json.dumps(query_args.get("data_types", [])),
+        time_start=query_args.get("start", None),
+        time_end=query_args.get("end", None),
+        updated_since=query_args.get("updated_since", None),
+        registry=json.dumps(excluded_registry),
+        total_files=sum(segment.files for segment in segments),
+        total_bytes=sum(segment.bytes for segment in segments),
+        sync_cursor=sync_cursor,
+        expires_on=timezone.now() + timedelta(days=DOWNLOAD_SESSION_DURATION_DAYS),
+    )
+    for segment in segments:
+        segment.session = session
+    DataDownloadSegment.objects.bulk_create(segments)
     
-    streaming_zip_file = ZipGenerator(
-        get_these_files, construct_registry='web_form' not in request.POST
+    query_args["study_pk"] = request.api_study.pk
+    query_args["download_session"] = str(session.session_id)
+    DataAccessRecord.objects.create(
+        researcher=request.api_researcher,
+        query_params=orjson.dumps(query_args).decode(),
+        registry_dict_size=len(registry_dict) if registry_dict else 0,
+        username=request.api_researcher.username,
+        time_end=timezone.now(),
+    )
+    
+    manifest = {
+        "session_id": str(session.session_id),
+        "expires_on": session.expires_on.strftime(API_TIME_FORMAT),
+        "sync_cursor": sync_cursor.strftime(API_TIME_FORMAT),
+        "total_files": session.total_files,
+        "total_bytes": session.total_bytes,
+        "segments": [
+            {"segment": segment.segment, "files": segment.files, "bytes": segment.bytes}
+            for segment in segments
+        ],
+    }
+    return HttpResponse(orjson.dumps(manifest), status=200, content_type="application/json")
+
+
+@require_POST
+@api_study_credential_check()
+@transaction.non_atomic_requests
+def get_data_download_session_segment(request: ApiStudyResearcherRequest):
+    """ Required: access key, access secret, study_id, session_id, segment
+    optional: compression, as in get_data
+    Returns a zip file of the files in one segment of a download session, including a registry file
+    for those files. """
+    try:
+        session, segment = parse_download_session_segment(request)
+        compression = parse_compression(request)
+    except Exception as e:
+        record_failed_data_query(request, e)
+        raise
+    
+    get_these_files = session.get_segment_chunks(segment).values(*CHUNK_FIELDS).iterator()
+    registry_dict = json.loads(session.registry)
+    if registry_dict:
+        get_these_files = exclude_registered_chunks(get_these_files, registry_dict)
+    
+    record = DataAccessRecord.objects.create(
+        researcher=request.api_researcher,
+        query_params=orjson.dumps(
+            {"download_session": str(session.session_id), "segment": segment.segment}
+        ).decode(),
+        username=request.api_researcher.username,
     )
+    return stream_data_download(request, get_these_files, compression, record)
+
+
+def stream_data_download(
+    request: ApiStudyResearcherRequest,
+    get_these_files: Iterable[dict],
+    compression: str,
+    record: DataAccessRecord,
+    sync_cursor: datetime = None,
+) -> FileResponse:
+    """ Builds the streaming file response for a data download. """
+    streaming_zip_file = ZipGenerator.for_compression(
+        get_these_files, construct_registry='web_form' not in request.POST, compression=compression
+    )
+    is_zstd = compression == COMPRESSION_ZSTD
     try:
         streaming_response = FileResponse(
             streaming_zip_file,
-            content_type="application/zip",
+            content_type="application/zstd" if is_zstd else "application/zip",
             as_attachment='web_form' in request.POST,
-            filename="data.zip",
+            filename="data.tar.zst" if is_zstd else "data.zip",
         )
         # for unknown reasons this call never happens in django's responding process, and so the
         # headers, which includes the file name, are never set.
         streaming_response.set_headers(None)
+        if sync_cursor:
+            streaming_response[SYNC_CURSOR_HEADER] = sync_cursor.strftime(API_TIME_FORMAT)
         return streaming_response
     except Exception as e:
         record.update_only(internal_error=True, error=str(e), bytes=streaming_zip_file.total_bytes)
@@ -92,6 +202,85 @@ def get_data(request: ApiStudyResearcherRequest):
         record.update_only(time_end=timezone.now(), bytes=streaming_zip_file.total_bytes)
 
 
+def parse_data_query(request: ApiStudyResearcherRequest) -> Tuple[dict, Optional[dict], str]:
+    """ Parses and validates the query parameters of a data download, returns the query arguments,
+    the registry, and the compression option. """
+    query_args = {}
+    try:
+        determine_data_streams_for_db_query(request, query_args)
+        determine_users_for_db_query(request, query_args)
+        determine_time_range_for_db_query(request, query_args)
+        determine_updated_since_for_db_query(request, query_args)
+        registry_dict = parse_registry(request)
+        compression = parse_compression(request)
+    except Exception as e:
+        record_failed_data_query(request, e)
+        raise
+    return query_args, registry_dict, compression
+
+
+def record_failed_data_query(request: ApiStudyResearcherRequest, e: Exception):
+    post = dict(request.POST)
+    post["access_key"] = post["secret_key"] = "sanitized"  # guaranteed to be present
+    DataAccessRecord.objects.create(
+        researcher=request.api_researcher,
+        username=request.api_researcher.username,
+        query_params=orjson.dumps(post).decode(),
+        error="did not pass query validation, " + str(e),
+    )
+
+
+def split_download_segments(chunks: Iterable[dict]) -> List[DataDownloadSegment]:
+    """ Splits the chunks of a download, in pk order, into (unsaved) segments of consecutive chunks
+    by (approximate) size and file count. """
+    segments: List[DataDownloadSegment] = []
+    for chunk in chunks:
+        if not segments or segments[-1].files >= DOWNLOAD_SESSION_SEGMENT_FILES or \
+                segments[-1].bytes >= DOWNLOAD_SESSION_SEGMENT_BYTES:
+            segments.append(DataDownloadSegment(
+                segment=len(segments), first_pk=chunk["pk"], files=0, bytes=0
+            ))
+        segment = segments[-1]
+        segment.last_pk = chunk["pk"]
+        segment.files += 1
+        segment.bytes += chunk["file_size"] or 0
+    return segments
+
+
+def parse_download_session_segment(
+    request: ApiStudyResearcherRequest
+) -> Tuple[DataDownloadSession, DataDownloadSegment]:
+    """ Gets the (unexpired) download session of the researcher and study, and the segment.
+    Aborts with a 400 for a malformed session id or segment, 404 if they don't exist. """
+    try:
+        session_id = uuid.UUID(request.POST.get("session_id", ""))
+    except ValueError:
+        log("bad session id")
+        return abort(400, "bad session id")
+    
+    session = DataDownloadSession.objects.filter(
+        session_id=session_id,
+        study=request.api_study,
+        researcher=request.api_researcher,
+        expires_on__gte=timezone.now(),
+    ).first()
+    if session is None:
+        log("no such download session")
+        return abort(404, "bad session id")
+    
+    try:
+        segment_number = int(request.POST.get("segment", ""))
+    except ValueError:
+        log("bad segment")
+        return abort(400, "bad segment")
+    
+    segment = session.segments.filter(segment=segment_number).first()
+    if segment is None:
+        log("segment out of range")
+        return abort(404, "bad segment")
+    return session, segment
+
+
 def parse_registry(request: ApiStudyResearcherRequest):
     """ Parses the provided registry.dat file and returns a dictionary of chunk
     file names and hashes.  (The registry file is just a json dictionary containing
@@ -114,6 +303,15 @@ def parse_registry(request: ApiStudyResearcherRequest):
     return ret
 
 
+def parse_compression(request: ApiStudyResearcherRequest) -> str:
+    """ Compression is opt-in, the default is an uncompressed zip file. """
+    compression = request.POST.get("compression", None) or COMPRESSION_NONE
+    if compression not in COMPRESSION_OPTIONS:
+        log("bad compression")
+        return abort(400, "bad compression")
+    return compression
+
+
 def str_to_datetime(time_string):
     """ Translates a time string to a datetime object, raises a 400 if the format is wrong."""
     try:
@@ -178,26 +376,36 @@ def determine_time_range_for_db_query(request: ApiStudyResearcherRequest, query:
         query['end'] = str_to_datetime(request.POST['time_end'])
 
 
-def handle_database_query(study_id: int, query_dict: dict, registry_dict: dict = None) -> QuerySet:
-    """ Runs the database query and returns a QuerySet. """
+def determine_updated_since_for_db_query(request: ApiStudyResearcherRequest, query: dict):
+    """ Determines, from the html request, the sync cursor that should go into the database query.
+    Modifies the provided query object accordingly, there is no return value. """
+    if request.POST.get('updated_since', None):
+        query['updated_since'] = str_to_datetime(request.POST['updated_since'])
+
+
+def handle_database_query(
+    study_id: int, query_dict: dict, registry_dict: dict = None
+) -> Iterable[dict]:
+    """ Runs the database query and returns an iterator of chunk dicts. """
     
-    chunks = ChunkRegistry.get_chunks_time_range(study_id, **query_dict)
+    chunks = ChunkRegistry.get_chunks_time_range(study_id, **query_dict) \
+        .values(*CHUNK_FIELDS).iterator()
     # the simple case where there isn't a registry uploaded
     if not registry_dict:
-        return chunks.values(*CHUNK_FIELDS).iterator()
-    
-    # If there is a registry, we need to filter on the chunks
-    # Get all chunks whose path and hash are both in the registry
-    possible_registered_chunks = chunks \
-        .filter(chunk_path__in=registry_dict, chunk_hash__in=registry_dict.values()) \
-        .values('pk', 'chunk_path', 'chunk_hash')
-    
-    # determine those chunks that we do not want present in the download
-    # (get a list of pks that have hashes that don't match the database)
-    registered_chunk_pks = [
-        c['pk'] for c in possible_registered_chunks
-        if registry_dict[c['chunk_path']] == c['chunk_hash']
-    ]
-    
-    # add the exclude and return the queryset
-    return chunks.exclude(pk__in=registered_chunk_pks).values(*CHUNK_FIELDS).iterator()
+        return chunks
+    
+    # If there is a registry we filter the chunks as they stream out of the database. (Sending the
+    # registry to the database as IN lists results in enormous, slow queries for large registries.)
+    return exclude_registered_chunks(chunks, registry_dict)
+
+
+def exclude_registered_chunks(
+    chunks: Iterable[dict], registry_dict: Dict[str, str], excluded_registry: dict = None
+) -> Generator[dict, None, None]:
+    """ Skips chunks with a path and hash that match an entry in the registry. The matching registry
+    entries are added to excluded_registry, if provided. """
+    for chunk in chunks:
+        if registry_dict.get(chunk["chunk_path"], None) != chunk["chunk_hash"]:
+            yield chunk
+        elif excluded_registry is not None:
+            excluded_registry[chunk["chunk_path"]] = chunk["chunk_hash"]
@@ -1,4 +1,5 @@
 from os import urandom
+from typing import Generator, Iterable
 
 from Cryptodome.Cipher import AES
 
@@ -21,3 +22,26 @@ def decrypt_server(data: bytes, encryption_key: bytes) -> bytes:
     iv = data[:16]
     data = data[16:]  # gr arg, memcopy operation...
     return AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv).decrypt(data)
+
+
+def decrypt_server_stream(
+    data: Iterable[bytes], encryption_key: bytes
+) -> Generator[bytes, None, None]:
+    """ Decrypts config encrypted by the encrypt_for_server function piece by piece, so that large
+    files never have to be held in memory. The pieces can be any size. """
+    if not isinstance(encryption_key, bytes):
+        raise Exception(f"received non-bytes object {type(encryption_key)}")
+    iv = b""
+    cipher = None
+    for piece in data:
+        if cipher is None:
+            # the initialization vector may be split across pieces
+            iv += piece
+            if len(iv) < 16:
+                continue
+            cipher = AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv[:16])
+            piece = iv[16:]
+        if piece:
+            yield cipher.decrypt(piece)
+    if cipher is None:
+        raise ValueError(f"encrypted data is too short to contain an IV: {len(iv)} bytes")
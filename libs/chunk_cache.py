@@ -0,0 +1,252 @@
+import hashlib
+import os
+import shutil
+from datetime import datetime
+from os.path import join as path_join
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import Iterable, List, Optional, Tuple
+
+from config.settings import CHUNK_CACHE_FOLDER, CHUNK_CACHE_MAX_MB
+
+
+# An on-disk least-recently-used cache of decrypted ChunkRegistry files, see the CHUNK_CACHE_FOLDER
+# setting. Cached files are keyed by chunk path and chunk hash, so when a chunk is rewritten its hash
+# changes and the old cache entry is never read again, the cache can never serve stale data.  The
+# folder may be shared by several processes, all operations are safe to run concurrently.
+#
+# Layout: CHUNK_CACHE_FOLDER/<hash of chunk path>/<hash of chunk hash>
+#         CHUNK_CACHE_FOLDER/<hash of chunk path>/.chunk_path  - the chunk path, for purges
+#         CHUNK_CACHE_FOLDER/.last_sweep                       - see sweep_purged_cached_chunks
+# File modification times are the "last used" times, reads touch the file.
+#
+# Every server has its own cache, a participant purge only clears the cache of the server it runs on.
+# The other servers remove the purged participant's files in sweep_purged_cached_chunks (in
+# libs/participant_purge.py), which they run periodically.
+
+CHUNK_PATH_FILE = ".chunk_path"
+LAST_SWEEP_FILE = ".last_sweep"
+
+# we clear out down to this fraction of the maximum size when it is exceeded
+EVICTION_TARGET_FRACTION = 0.9
+
+# approximate size of the cache as seen by this process, None means unknown
+_cache_size: Optional[int] = None
+_cache_size_lock = Lock()
+
+
+def chunk_cache_enabled() -> bool:
+    return bool(CHUNK_CACHE_FOLDER)
+
+
+def _chunk_folder(chunk_path: str) -> str:
+    return path_join(CHUNK_CACHE_FOLDER, hashlib.sha256(chunk_path.encode()).hexdigest())
+
+
+def _write_file_atomically(file_path: str, contents: bytes):
+    with NamedTemporaryFile(dir=os.path.dirname(file_path), delete=False, prefix=".tmp") as f:
+        f.write(contents)
+    os.replace(f.name, file_path)
+
+
+def _write_chunk_path_file(folder: str, chunk_path: str):
+    """ Records the chunk path of a cache folder, the folder name is a hash. """
+    file_path = path_join(folder, CHUNK_PATH_FILE)
+    if not os.path.exists(file_path):
+        _write_file_atomically(file_path, chunk_path.encode())
+
+
+def _cache_file_path(chunk_path: str, chunk_hash: str) -> str:
+    # chunk hashes are base64, which is not filesystem safe.
+    return path_join(_chunk_folder(chunk_path), hashlib.sha256(chunk_hash.encode()).hexdigest())
+
+
+def get_cached_chunk(chunk_path: str, chunk_hash: str) -> Optional[bytes]:
+    """ Returns the cached contents of the chunk, or None if it is not present. """
+    if not chunk_cache_enabled() or not chunk_hash:
+        return None
+    
+    file_path = _cache_file_path(chunk_path, chunk_hash)
+    try:
+        with open(file_path, "rb") as f:
+            contents = f.read()
+        os.utime(file_path)
+    except FileNotFoundError:  # includes a race with eviction
+        return None
+    return contents
+
+
+def cache_chunk(chunk_path: str, chunk_hash: str, contents: bytes):
+    """ Writes the contents of a chunk to the cache, evicting old entries if the cache is full. """
+    if not chunk_cache_enabled() or not chunk_hash:
+        return
+    
+    folder = _chunk_folder(chunk_path)
+    os.makedirs(folder, exist_ok=True)
+    _write_chunk_path_file(folder, chunk_path)
+    # write to a temporary file and rename it into place so that readers never see a partial file.
+    with NamedTemporaryFile(dir=folder, delete=False, prefix=".tmp") as f:
+        f.write(contents)
+    _commit_cache_file(f.name, chunk_path, chunk_hash, len(contents))
+
+
+def copy_cached_chunk(chunk_path: str, chunk_hash: str, destination: str) -> bool:
+    """ Copies the cached chunk to a new file at the destination path without reading it into
+    memory, returns whether the chunk was present. """
+    if not chunk_cache_enabled() or not chunk_hash:
+        return False
+    
+    file_path = _cache_file_path(chunk_path, chunk_hash)
+    try:
+        source = open(file_path, "rb")
+    except FileNotFoundError:  # includes a race with eviction
+        return False
+    with source, open(destination, "xb") as f:
+        shutil.copyfileobj(source, f)
+    try:
+        os.utime(file_path)
+    except FileNotFoundError:
+        pass
+    return True
+
+
+def cache_chunk_file(chunk_path: str, chunk_hash: str, source: str):
+    """ As cache_chunk, but copies the contents from the file at the source path. """
+    if not chunk_cache_enabled() or not chunk_hash:
+        return
+    
+    folder = _chunk_folder(chunk_path)
+    os.makedirs(folder, exist_ok=True)
+    _write_chunk_path_file(folder, chunk_path)
+    with open(source, "rb") as source_file, \
+            NamedTemporaryFile(dir=folder, delete=False, prefix=".tmp") as f:
+        shutil.copyfileobj(source_file, f)
+        size = f.tell()
+    _commit_cache_file(f.name, chunk_path, chunk_hash, size)
+
+
+def _commit_cache_file(temp_file_path: str, chunk_path: str, chunk_hash: str, size: int):
+    """ Renames a fully written temporary file into place, evicts old entries if the cache is full. """
+    os.replace(temp_file_path, _cache_file_path(chunk_path, chunk_hash))
+    if _add_to_cache_size(size) > CHUNK_CACHE_MAX_MB * 1024 * 1024:
+        evict_chunks()
+
+
+def discard_cached_chunk(chunk_path: str):
+    """ Removes all cached versions of a chunk. Call when a chunk is rewritten, this is not required
+    for correctness (the chunk hash changes), it just frees up the space immediately. """
+    if not chunk_cache_enabled():
+        return
+    
+    _discard_folder(_chunk_folder(chunk_path))
+
+
+def discard_cached_chunks_by_prefix(prefixes: Iterable[str]) -> int:
+    """ Removes all cached versions of every chunk whose chunk path starts with one of the prefixes,
+    returns the number of chunks removed. Files cached without a record of their chunk path (by older
+    code) can't be checked, they are removed too. """
+    if not chunk_cache_enabled():
+        return 0
+    
+    prefixes = tuple(prefixes)
+    discarded = 0
+    for folder in os.scandir(CHUNK_CACHE_FOLDER):
+        if not folder.is_dir():
+            continue
+        try:
+            with open(path_join(folder.path, CHUNK_PATH_FILE), "rb") as f:
+                chunk_path = f.read().decode()
+        except FileNotFoundError:
+            chunk_path = None
+        if chunk_path is None or chunk_path.startswith(prefixes):
+            discarded += _discard_folder(folder.path)
+    return discarded
+
+
+def _discard_folder(folder: str) -> int:
+    """ Removes the files of a cache folder, files that are still being written are left alone.
+    Returns the number of cached files removed. """
+    try:
+        entries = list(os.scandir(folder))
+    except FileNotFoundError:
+        return 0
+    removed = 0
+    for entry in entries:
+        if entry.name.startswith(".tmp"):
+            continue
+        try:
+            size = entry.stat().st_size
+            os.remove(entry.path)
+        except FileNotFoundError:
+            continue
+        if entry.name != CHUNK_PATH_FILE:
+            _add_to_cache_size(-size)
+            removed += 1
+    return removed
+
+
+def get_last_sweep_time() -> Optional[datetime]:
+    """ Returns the time of the last completed sweep_purged_cached_chunks on this cache. """
+    try:
+        with open(path_join(CHUNK_CACHE_FOLDER, LAST_SWEEP_FILE), "rb") as f:
+            return datetime.fromisoformat(f.read().decode())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def set_last_sweep_time(last_sweep_time: datetime):
+    _write_file_atomically(
+        path_join(CHUNK_CACHE_FOLDER, LAST_SWEEP_FILE), last_sweep_time.isoformat().encode()
+    )
+
+
+def evict_chunks():
+    """ Removes the least recently used files until the cache is under the target size. """
+    global _cache_size
+    
+    entries = _scan_cache()
+    total_size = sum(size for _, size, _ in entries)
+    target_size = CHUNK_CACHE_MAX_MB * 1024 * 1024 * EVICTION_TARGET_FRACTION
+    entries.sort()
+    for _, size, file_path in entries:
+        if total_size <= target_size:
+            break
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+    
+    with _cache_size_lock:
+        _cache_size = total_size
+
+
+def _add_to_cache_size(size: int) -> int:
+    """ Updates and returns the approximate cache size. Other processes write to the cache too, on
+    first use (and on every eviction) the real size is calculated. """
+    global _cache_size
+    with _cache_size_lock:
+        if _cache_size is None:
+            # the change is already on disk
+            _cache_size = sum(size for _, size, _ in _scan_cache())
+        else:
+            _cache_size += size
+        return _cache_size
+
+
+def _scan_cache() -> List[Tuple[float, int, str]]:
+    """ Returns the (modification time, size, path) of every file in the cache. """
+    entries = []
+    for folder in os.scandir(CHUNK_CACHE_FOLDER):
+        if not folder.is_dir():
+            continue
+        try:
+            for entry in os.scandir(folder.path):
+                # .tmp files are still being written, .chunk_path is not a cached file.
+                if entry.name.startswith("."):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError:  # a race with another process
+            pass
+    return entries
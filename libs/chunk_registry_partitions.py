@@ -0,0 +1,336 @@
+import re
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from dateutil.parser import isoparse
+from django.db import connection, transaction
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from database.data_access_models import ChunkRegistry
+
+
+# The ChunkRegistry table grows without bound. On postgres it can be converted (once, manually, see
+# scripts/partition_chunk_registry.py) into a table partitioned by month of time_bin:
+#
+#   database_chunkregistry                  - the partitioned parent table, all queries target it.
+#     database_chunkregistry_legacy         - the original table, every time_bin before conversion.
+#     database_chunkregistry_y2024m07 ...   - one partition per month after the conversion.
+#     database_chunkregistry_default        - anything else, e.g. timestamps far in the future.
+#
+# Queries with a time_bin range (data downloads, forest, data quantity) only touch the partitions
+# for those months, indexes stay small, and deleting a month of data only touches one partition.
+# Postgres requires that unique constraints on a partitioned table include the partition key, so the
+# primary key becomes (id, time_bin) and chunk_path is unique per (chunk_path, time_bin); a
+# chunk_path always encodes its time_bin so this is equivalent. Lookups by chunk_path alone still
+# work, they check the (small) chunk_path index of every partition.
+#
+# Partitions are created ahead of time by the daily create_chunk_registry_partitions script, which
+# does nothing on a database that has not been converted (including sqlite).
+#
+# Notes for future migrations on a converted database: CREATE INDEX CONCURRENTLY is not supported on
+# partitioned tables, use a normal AddIndex (or create the index on each partition concurrently and
+# then attach them) instead.
+
+PARENT_TABLE = ChunkRegistry._meta.db_table
+LEGACY_PARTITION = PARENT_TABLE + "_legacy"
+DEFAULT_PARTITION = PARENT_TABLE + "_default"
+HOLDING_TABLE = PARENT_TABLE + "_future_rows"
+BOUND_CONSTRAINT = LEGACY_PARTITION + "_bound"
+PARTITION_MONTHS_AHEAD = 3
+
+
+def month_start(dt: datetime) -> datetime:
+    """ Returns the start of the month (in UTC) containing the datetime. """
+    return dt.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(dt: datetime) -> datetime:
+    """ Returns the start of the month (in UTC) after the month containing the datetime. """
+    dt = month_start(dt)
+    if dt.month == 12:
+        return dt.replace(year=dt.year + 1, month=1)
+    return dt.replace(month=dt.month + 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f"{PARENT_TABLE}_y{month.year}m{month.month:02}"
+
+
+def partition_upper_bound(bounds: List[Tuple[str, str]]) -> Optional[datetime]:
+    """ Returns the highest upper bound of the partitions' bound expressions (as returned by
+    get_partition_bounds), e.g. "FOR VALUES FROM (MINVALUE) TO ('2024-08-01 00:00:00+00')". The
+    default partition has no bound. """
+    upper_bounds = []
+    for _, bound_expression in bounds:
+        match = re.search(r"\bTO \('([^']+)'\)", bound_expression)
+        if match:
+            upper_bounds.append(isoparse(match.group(1)))
+    return max(upper_bounds, default=None)
+
+
+def months_to_partition(
+    now: datetime, upper_bound: Optional[datetime], months_ahead: int = PARTITION_MONTHS_AHEAD
+) -> List[datetime]:
+    """ Returns the starts of the months from this month through months_ahead months from now that
+    need a partition, months below the upper bound of the existing partitions are already covered
+    (the legacy partition covers everything before the month after the conversion). """
+    month = month_start(now)
+    last_month = month
+    for _ in range(months_ahead):
+        last_month = next_month(last_month)
+    if upper_bound is not None:
+        month = max(month, month_start(upper_bound))
+    
+    months = []
+    while month <= last_month:
+        months.append(month)
+        month = next_month(month)
+    return months
+
+
+def delete_chunk_registries_by_month(query: QuerySet[ChunkRegistry]) -> int:
+    """ Deletes the ChunkRegistries in the query one month of time_bins at a time. Each delete is a
+    short statement that (on a partitioned table) only touches one partition, instead of a single
+    enormous delete that holds locks and bloats every index of the table. """
+    deleted = 0
+    # ChunkRegistry has no reverse relations so each delete is a single DELETE statement.
+    for month in list(query.datetimes("time_bin", "month", tzinfo=timezone.utc)):
+        deleted += query.filter(time_bin__gte=month, time_bin__lt=next_month(month)).delete()[0]
+    return deleted
+
+
+#
+## Postgres partition management
+#
+
+
+def chunk_registry_is_partitioned() -> bool:
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table JOIN pg_class ON pg_class.oid = partrelid "
+            "WHERE relname = %s", [PARENT_TABLE],
+        )
+        return cursor.fetchone() is not None
+
+
+def get_partition_bounds() -> List[Tuple[str, str]]:
+    """ Returns the (partition name, partition bound expression) of every partition. """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = inhparent "
+            "JOIN pg_class child ON child.oid = inhrelid "
+            "WHERE parent.relname = %s ORDER BY child.relname", [PARENT_TABLE],
+        )
+        return cursor.fetchall()
+
+
+def create_future_partitions(months_ahead: int = PARTITION_MONTHS_AHEAD) -> List[str]:
+    """ Creates the monthly partitions from this month (or the upper bound of the existing
+    partitions) through months_ahead months from now, returns the names of the partitions that were
+    created. """
+    if not chunk_registry_is_partitioned():
+        return []
+    
+    bounds = get_partition_bounds()
+    existing = {name for name, _ in bounds}
+    created = []
+    for month in months_to_partition(timezone.now(), partition_upper_bound(bounds), months_ahead):
+        name = partition_name(month)
+        if name not in existing:
+            create_partition(name, month, next_month(month))
+            created.append(name)
+    return created
+
+
+def create_partition(name: str, start: datetime, end: datetime):
+    """ Creates a partition for the range of time_bins. Creating a partition fails if the default
+    partition contains rows in its range, so those rows are moved into the new partition. """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE TEMPORARY TABLE chunk_registry_moved_rows ON COMMIT DROP AS '
+            f'SELECT * FROM "{DEFAULT_PARTITION}" WHERE time_bin >= %s AND time_bin < %s',
+            [start, end],
+        )
+        cursor.execute(
+            f'DELETE FROM "{DEFAULT_PARTITION}" WHERE time_bin >= %s AND time_bin < %s',
+            [start, end],
+        )
+        cursor.execute(
+            f'CREATE TABLE "{name}" PARTITION OF "{PARENT_TABLE}" FOR VALUES FROM (%s) TO (%s)',
+            [start, end],
+        )
+        cursor.execute(f'INSERT INTO "{PARENT_TABLE}" SELECT * FROM chunk_registry_moved_rows')
+
+
+def table_exists(cursor, table_name: str) -> bool:
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [table_name])
+    return cursor.fetchone()[0]
+
+
+def restore_future_rows(cursor):
+    """ Reinserts the rows set aside by partition_chunk_registry, drops the holding table. """
+    if not table_exists(cursor, HOLDING_TABLE):
+        return
+    with transaction.atomic():
+        cursor.execute(f'INSERT INTO "{PARENT_TABLE}" SELECT * FROM "{HOLDING_TABLE}"')
+        cursor.execute(f'DROP TABLE "{HOLDING_TABLE}"')
+
+
+def hold_future_rows(cursor, boundary: datetime):
+    """ Moves rows with time_bins at or after the boundary from the ChunkRegistry table to the
+    holding table. Must run inside a transaction that has locked the ChunkRegistry table. """
+    cursor.execute(
+        f'INSERT INTO "{HOLDING_TABLE}" SELECT * FROM "{PARENT_TABLE}" WHERE time_bin >= %s',
+        [boundary],
+    )
+    cursor.execute(f'DELETE FROM "{PARENT_TABLE}" WHERE time_bin >= %s', [boundary])
+
+
+def create_index_concurrently(cursor, index_name: str, columns: str):
+    """ Creates a unique index on the ChunkRegistry table without blocking writes. A failed
+    concurrent build leaves an invalid index behind, it is dropped and rebuilt. """
+    cursor.execute(
+        "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", [index_name]
+    )
+    invalid = cursor.fetchone()
+    if invalid and invalid[0]:
+        cursor.execute(f'DROP INDEX CONCURRENTLY "{index_name}"')
+    cursor.execute(
+        f'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS "{index_name}" '
+        f'ON "{PARENT_TABLE}" ({columns})'
+    )
+
+
+def partition_chunk_registry():
+    """ Converts the ChunkRegistry table into a table partitioned by month of time_bin, the original
+    table becomes the legacy partition. The slow steps (index builds, constraint validation) do not
+    block reads or writes, the swap itself holds a lock on the table for a few seconds. If the
+    conversion fails or is interrupted it can be run again, it resumes where it stopped. """
+    if connection.vendor != "postgresql":
+        raise Exception("ChunkRegistry partitioning is only supported on postgres.")
+    
+    with connection.cursor() as cursor:
+        if chunk_registry_is_partitioned():
+            # an earlier run may have been interrupted after the swap.
+            restore_future_rows(cursor)
+            return
+        try:
+            swap_in_partitioned_table(cursor)
+        except BaseException:
+            # Undo the parts that affect a live server: the bound constraint rejects new rows with
+            # future time_bins, and the held rows are missing from the table.
+            if not chunk_registry_is_partitioned():
+                cursor.execute(
+                    f'ALTER TABLE "{PARENT_TABLE}" DROP CONSTRAINT IF EXISTS "{BOUND_CONSTRAINT}"'
+                )
+            restore_future_rows(cursor)
+            raise
+        restore_future_rows(cursor)
+    
+    create_future_partitions()
+
+
+def swap_in_partitioned_table(cursor):
+    """ The steps of partition_chunk_registry, every step can be repeated after a failure. """
+    boundary = next_month(timezone.now())
+    
+    # the partitioned table's unique constraints must include time_bin, build matching indexes.
+    create_index_concurrently(cursor, f"{LEGACY_PARTITION}_id_time_bin", "id, time_bin")
+    create_index_concurrently(
+        cursor, f"{LEGACY_PARTITION}_chunk_path_time_bin", "chunk_path, time_bin"
+    )
+    
+    # Rows with time_bins after the legacy partition's range (broken device clocks) are set aside
+    # and reinserted after the conversion. A check constraint matching the legacy partition bounds
+    # means attaching it does not have to scan the table, it is added under the same lock so no
+    # row can arrive in between. From here until the swap new rows with future time_bins fail.
+    with transaction.atomic():
+        cursor.execute(f'LOCK TABLE "{PARENT_TABLE}" IN SHARE ROW EXCLUSIVE MODE')
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS "{HOLDING_TABLE}" '
+            f'(LIKE "{PARENT_TABLE}" INCLUDING DEFAULTS)'
+        )
+        hold_future_rows(cursor, boundary)
+        cursor.execute(
+            f'ALTER TABLE "{PARENT_TABLE}" DROP CONSTRAINT IF EXISTS "{BOUND_CONSTRAINT}"'
+        )
+        cursor.execute(
+            f'ALTER TABLE "{PARENT_TABLE}" ADD CONSTRAINT "{BOUND_CONSTRAINT}" '
+            f'CHECK (time_bin < %s) NOT VALID', [boundary],
+        )
+    cursor.execute(f'ALTER TABLE "{PARENT_TABLE}" VALIDATE CONSTRAINT "{BOUND_CONSTRAINT}"')
+    
+    # the existing non-unique indexes and foreign keys are recreated on the partitioned table
+    cursor.execute(
+        "SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index "
+        "WHERE indrelid = %s::regclass AND NOT indisunique", [PARENT_TABLE],
+    )
+    indexes = cursor.fetchall()
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype = 'f'", [PARENT_TABLE],
+    )
+    foreign_keys = cursor.fetchall()
+    cursor.execute(
+        "SELECT attidentity FROM pg_attribute WHERE attrelid = %s::regclass AND attname = 'id'",
+        [PARENT_TABLE],
+    )
+    id_is_identity = cursor.fetchone()[0] != ""
+    
+    with transaction.atomic():
+        cursor.execute(f'LOCK TABLE "{PARENT_TABLE}" IN ACCESS EXCLUSIVE MODE')
+        # rows can't have arrived since the constraint was validated, but the attach must not fail
+        # here, so any row past the boundary is moved aside again under the lock.
+        hold_future_rows(cursor, boundary)
+        cursor.execute(f'ALTER TABLE "{PARENT_TABLE}" RENAME TO "{LEGACY_PARTITION}"')
+        # index names are unique per schema, the original names go to the partitioned table so
+        # that future migrations find them.
+        for index_name, _ in indexes:
+            legacy_index_name = f"{index_name[:50]}_legacy{len(index_name)}"
+            cursor.execute(f'ALTER INDEX "{index_name}" RENAME TO "{legacy_index_name}"')
+        
+        cursor.execute(
+            f'CREATE TABLE "{PARENT_TABLE}" (LIKE "{LEGACY_PARTITION}" INCLUDING DEFAULTS) '
+            f'PARTITION BY RANGE (time_bin)'
+        )
+        cursor.execute(f'ALTER TABLE "{PARENT_TABLE}" ADD PRIMARY KEY (id, time_bin)')
+        cursor.execute(
+            f'ALTER TABLE "{PARENT_TABLE}" ADD CONSTRAINT '
+            f'"{PARENT_TABLE}_chunk_path_time_bin_uniq" UNIQUE (chunk_path, time_bin)'
+        )
+        for _, index_definition in indexes:
+            cursor.execute(index_definition)  # the definitions refer to the table by name
+        for constraint_name, constraint_definition in foreign_keys:
+            cursor.execute(
+                f'ALTER TABLE "{PARENT_TABLE}" ADD CONSTRAINT "{constraint_name}" '
+                f'{constraint_definition}'
+            )
+        
+        # ids come from a new sequence owned by the partitioned table
+        id_sequence = PARENT_TABLE + "_partitioned_id_seq"
+        cursor.execute(f'CREATE SEQUENCE "{id_sequence}" OWNED BY "{PARENT_TABLE}".id')
+        cursor.execute(
+            f'SELECT setval(%s, greatest((SELECT max(id) FROM "{LEGACY_PARTITION}"), '
+            f'(SELECT max(id) FROM "{HOLDING_TABLE}"), 1))', [id_sequence],
+        )
+        cursor.execute(
+            f'ALTER TABLE "{PARENT_TABLE}" ALTER COLUMN id SET DEFAULT nextval(%s)',
+            [id_sequence],
+        )
+        if id_is_identity:
+            cursor.execute(f'ALTER TABLE "{LEGACY_PARTITION}" ALTER COLUMN id DROP IDENTITY')
+        
+        cursor.execute(
+            f'ALTER TABLE "{PARENT_TABLE}" ATTACH PARTITION "{LEGACY_PARTITION}" '
+            f'FOR VALUES FROM (MINVALUE) TO (%s)', [boundary],
+        )
+        cursor.execute(
+            f'CREATE TABLE "{DEFAULT_PARTITION}" PARTITION OF "{PARENT_TABLE}" DEFAULT'
+        )
+        cursor.execute(
+            f'ALTER TABLE "{LEGACY_PARTITION}" DROP CONSTRAINT "{BOUND_CONSTRAINT}"'
+        )
@@ -29,6 +29,7 @@ class CreateTasksForm(forms.Form):
     date_end = forms.DateField()
     participant_patient_ids = CommaSeparatedListCharField()  # not actually a comma separated field?
     trees = CommaSeparatedListChoiceField(choices=ForestTree.choices())
+    incremental = forms.BooleanField(required=False)
     
     def __init__(self, *args, **kwargs):
         # we provide a study parameter, somewhat like a ModelForm
@@ -81,6 +82,7 @@ class CreateTasksForm(forms.Form):
                         forest_tree=tree,
                         data_date_start=self.cleaned_data["date_start"],
                         data_date_end=self.cleaned_data["date_end"],
+                        incremental=self.cleaned_data["incremental"],
                         status=ForestTaskStatus.queued,
                     )
                 )
@@ -7,11 +7,11 @@ from typing import Any, DefaultDict, Dict, List, Optional, Tuple, Union
 
 from django.db.models import Max, Min, Q
 
-from constants.common_constants import API_DATE_FORMAT, EARLIEST_POSSIBLE_DATA_DATETIME
+from constants.common_constants import API_DATE_FORMAT
 from constants.data_stream_constants import ALL_DATA_STREAMS
 from constants.forest_constants import DATA_QUANTITY_FIELD_MAP, DATA_QUANTITY_FIELD_NAMES
 from database.dashboard_models import DashboardColorSetting, DashboardGradient, DashboardInflection
-from database.forest_models import SummaryStatisticDaily
+from database.forest_models import DataQuantityRollup, SummaryStatisticDaily
 from database.study_models import Study
 from database.user_models_participant import Participant
 from libs.internal_types import ParticipantQuerySet, ResearcherRequest
@@ -30,22 +30,52 @@ def parse_data_streams(
     unique_dates = []
     byte_streams = {}
     if first_day is not None:
-        stream_data, _, _ = dashboard_data_query(participant_objects, data_stream=data_stream)
         unique_dates, _, _ = get_unique_dates(start, end, first_day, last_day)
+        patient_ids, byte_matrix = build_dashboard_byte_matrix(
+            participant_objects, data_stream, unique_dates
+        )
+        # the template iterates over patient ids and their rows of the matrix
+        byte_streams = dict(zip(patient_ids, byte_matrix))
         
-        # get the byte streams per date for each patient for a specific data stream for those dates
-        for participant in participant_objects:
-            byte_streams[participant.patient_id] = [
-                get_bytes_date_match(stream_data[participant.patient_id], date)
-                for date in unique_dates
-            ]
-        
-        # check if there is data to display
-        data_exists = len([data for patient in byte_streams for data in byte_streams[patient] if data is not None]) > 0
+        # check if there is data to display, there is a cell for every participant on every date
+        data_exists = len(unique_dates) > 0 and len(byte_streams) > 0
     
     return data_exists, first_day, last_day, unique_dates, byte_streams
 
 
+def build_dashboard_byte_matrix(
+    participants: ParticipantQuerySet, data_stream: str, unique_dates: List[date]
+) -> Tuple[List[str], List[List[int]]]:
+    """ Builds the data stream dashboard grid, a dense matrix of byte counts indexed by (participant
+    index, day index), from a single query over the displayed days. Returns the patient ids in the
+    order of the participants query and the matrix, cells with no data are 0. """
+    participant_ids, patient_ids = [], []
+    for participant_id, patient_id in participants.values_list("id", "patient_id"):
+        participant_ids.append(participant_id)
+        patient_ids.append(patient_id)
+    
+    matrix = [[0] * len(unique_dates) for _ in patient_ids]
+    if not unique_dates or not patient_ids:
+        return patient_ids, matrix
+    
+    participant_index = {participant_id: i for i, participant_id in enumerate(participant_ids)}
+    day_index = {day: i for i, day in enumerate(unique_dates)}
+    field_name = DATA_QUANTITY_FIELD_MAP[data_stream]
+    
+    # (participant, date) is unique on SummaryStatisticDaily, each row is exactly one cell.
+    query = SummaryStatisticDaily.objects.filter(
+        participant_id__in=participant_ids,
+        date__gte=min(unique_dates),
+        date__lte=max(unique_dates),
+        **{field_name + "__isnull": False},
+    ).values_list("participant_id", "date", field_name)
+    for participant_id, day, byte_count in query:
+        if day in day_index:
+            matrix[participant_index[participant_id]][day_index[day]] = byte_count
+    
+    return patient_ids, matrix
+
+
 # FIXME document EXACTLY what this return looks like
 def get_unique_dates(
     start_date: Optional[date],
@@ -151,15 +181,6 @@ def get_bytes_data_stream_match(chunks: List[Dict[str, datetime]], a_date: date,
     )
 
 
-# FIXME: we don't need this anymore after purging chunksregistry
-def get_bytes_date_match(stream_data: List[Dict[str, datetime]], a_date: date) -> Optional[int]:
-    """ Returns byte values for the declared stream based on a date. """
-    return sum(
-        data_point.get("bytes", 0) or 0 for data_point in stream_data
-        if (data_point["date"]) == a_date
-    )
-
-
 # operator.or_ is the same as |, the bitwise or operator, reduce applies it to all the Q objects.
 # The Q objects look like `Q(beiwe_accelerometer_bytes__isnull=False)`
 # eg. filter on all streams where any data quantity field is not null
@@ -175,44 +196,19 @@ def get_first_and_last_days_of_data(
     study: Study, data_stream: Optional[str] = None, participant: Optional[Participant] = None
 ) -> Tuple[Optional[date], Optional[date]]:
     """ Gets the first and last days in the study, filters some junk data.
-    This code used to operate on the ChunkRegisty model, that got quite slow on large servers, 
-    it has been rewritted to use the SummaryStatisticDaily. This data should be the same. """
+    This code used to operate on the ChunkRegisty model, and then on SummaryStatisticDaily, it now
+    uses the DataQuantityRollup, which has one row per participant per data stream. """
     
     if participant is None:
-        kwargs = {"participant__study_id": study.id}
+        query = DataQuantityRollup.objects.filter(study_id=study.id)
     else:
-        kwargs = {"participant_id": participant.id}
+        query = DataQuantityRollup.objects.filter(participant_id=participant.id)
     
-    filter_args = []
     if data_stream:
-        data_stream = DATA_QUANTITY_FIELD_MAP[data_stream]
-        kwargs[data_stream + "__isnull"] = False  # when it is one data stream use a simple filter
-    else:
-        # when it is all data streams we populate this with a complex filter
-        filter_args = [FILTER_ALL_STREAMS_WHERE_ANY_DATA_QUANTITY_FIELD_IS_NOT_NULL]
-    
-    
-    # Performance notes on this query after a bunch of testing:
-    # - There is a .union method, you do `q1[:1].union(q2[:1]).values_list("date", flat=True)`
-    #     but it is simply slower than every other method.
-    # - The really hard testing was done on ChunkRegistry, SummaryStatisticDaily is filtering
-    #     a more complex query on the all data stream case, but it is much faster, it is:
-    #        number_of_participants*number_of_days e.g.: 100 * 365 = 36,500
-    #     vs
-    #        number_of_participants*number_of_hours*number_of_streams: 100 * (24*365) * 19 = 16,644,000
-    #     which is a 456x reduction in record count, plus we had to deal with a timezone conversion.
-    # - !!!!! When these numbers (again, as ChunkRegistry) get very large it became faster to
-    #     PULL IN ALL THE VALUES and get the min and max in Python.  I don't know why.
+        query = query.filter(field_name=DATA_QUANTITY_FIELD_MAP[data_stream])
     
     # (min, max, Min, Max, MIN, MAX - this namespace is getting crowded)
-    MIN, MAX = (
-        SummaryStatisticDaily.objects.filter(*filter_args, **kwargs)
-        .exclude(date__lt=EARLIEST_POSSIBLE_DATA_DATETIME)
-        # .order_by("date")  # have not tested whether this affects speed
-        .aggregate(min=Min("date"), max=Max("date"))
-        # at this point it is now a dict like {'min': datetime, 'max': datetime}, order is guaranteed
-        .values()
-    )
+    MIN, MAX = query.aggregate(min=Min("first_day"), max=Max("last_day")).values()
     
     # if either one is missing we just return None, None
     if MIN is None or MAX is None:
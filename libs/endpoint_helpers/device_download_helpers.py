@@ -0,0 +1,178 @@
+from collections import defaultdict
+from datetime import datetime, timedelta, tzinfo
+from typing import Any, DefaultDict, Dict, List, Tuple
+
+from django.db.models import Count, Max
+
+from constants.schedule_constants import EMPTY_WEEKLY_SURVEY_TIMINGS
+from database.schedule_models import ScheduledEvent, WeeklySchedule
+from database.study_models import DeviceSettings
+from database.survey_models import Survey
+from database.user_models_participant import Participant
+from libs.schedules import decompose_datetime_to_timings
+
+
+# The survey and device settings components of the get_latest_surveys and
+# get_latest_device_settings endpoints are identical for every participant in a study, and those
+# endpoints are polled by every device. We cache those study-level payloads per-process, keyed by
+# study id, and validate the cached payload against a single cheap "version" query on every request.
+# Versions are derived from last_updated timestamps, so any save (on any server) invalidates them.
+
+# a cached survey payload is a list of (survey id, device-formatted survey dict, weekly timings)
+SurveyPayload = Tuple[int, Dict[str, Any], List[List[int]]]
+
+# study id: (version, payload)
+STUDY_SURVEYS_CACHE: Dict[int, Tuple[tuple, List[SurveyPayload]]] = {}
+STUDY_DEVICE_SETTINGS_CACHE: Dict[int, Tuple[datetime, Dict[str, Any]]] = {}
+
+
+def clear_device_download_caches():
+    STUDY_SURVEYS_CACHE.clear()
+    STUDY_DEVICE_SETTINGS_CACHE.clear()
+
+
+#
+## Device Settings
+#
+
+
+def get_study_device_settings(study_id: int) -> Dict[str, Any]:
+    """ Returns a new dictionary of the exported device settings for the study. """
+    version = DeviceSettings.objects.filter(study_id=study_id) \
+        .values_list("last_updated", flat=True).get()
+    
+    cached = STUDY_DEVICE_SETTINGS_CACHE.get(study_id, None)
+    if cached is None or cached[0] != version:
+        cached = (version, DeviceSettings.objects.get(study_id=study_id).export())
+        STUDY_DEVICE_SETTINGS_CACHE[study_id] = cached
+    
+    # callers add participant-specific fields, don't let them mutate the cached dictionary.
+    return dict(cached[1])
+
+
+#
+## Surveys
+#
+
+
+def get_study_surveys_version(study_id: int) -> tuple:
+    """ Surveys are saved at the end of every edit (which updates last_updated), weekly schedules
+    are recreated on edit, and the count catches new surveys. Deleted surveys are included because
+    deleting a survey is a save. """
+    return tuple(
+        Survey.objects.filter(study_id=study_id).aggregate(
+            count=Count("id", distinct=True),
+            survey_last_updated=Max("last_updated"),
+            weekly_last_updated=Max("weekly_schedules__last_updated"),
+        ).values()
+    )
+
+
+def get_study_survey_payloads(study_id: int) -> List[SurveyPayload]:
+    """ Returns the (cached) study-level components of the survey download, treat as read-only. """
+    version = get_study_surveys_version(study_id)
+    cached = STUDY_SURVEYS_CACHE.get(study_id, None)
+    if cached is None or cached[0] != version:
+        cached = (version, build_study_survey_payloads(study_id))
+        STUDY_SURVEYS_CACHE[study_id] = cached
+    return cached[1]
+
+
+def build_study_survey_payloads(study_id: int) -> List[SurveyPayload]:
+    """ Formats every undeleted survey on a study for download to a device, and gets all of their
+    weekly timings in a single query. """
+    # block the deprecated image surveys type.
+    surveys = Survey.objects.filter(study_id=study_id, deleted=False) \
+        .exclude(survey_type="image_survey").order_by("id")
+    
+    # this weird sort order results in correctly ordered output. (see export_weekly_survey_timings)
+    fields_ordered = ("hour", "minute", "day_of_week")
+    weekly_timings = {survey.id: EMPTY_WEEKLY_SURVEY_TIMINGS() for survey in surveys}
+    schedule_components = WeeklySchedule.objects.filter(survey_id__in=weekly_timings.keys()) \
+        .order_by(*fields_ordered).values_list("survey_id", *fields_ordered)
+    for survey_id, hour, minute, day in schedule_components:
+        weekly_timings[survey_id][day].append((hour * 60 * 60) + (minute * 60))
+    
+    payloads = []
+    for survey in surveys:
+        survey_dict = survey.as_unpacked_native_python(Survey.SURVEY_DEVICE_EXPORT_FIELDS)
+        # Make the dict look like the old Mongolia-style dict that the frontend is expecting
+        survey_dict['_id'] = survey_dict.pop('object_id')
+        payloads.append((survey.id, survey_dict, weekly_timings[survey.id]))
+    return payloads
+
+
+def get_surveys_for_device(participant: Participant) -> List[Dict[str, Any]]:
+    """ Returns the list of survey dicts for download to the app, only the absolute and relative
+    schedule components are calculated per-participant, and that is a single query regardless of
+    the number of surveys on the study. """
+    survey_payloads = get_study_survey_payloads(participant.study_id)
+    now = participant.study.now()  # TODO: get participant device timezone
+    scheduled_times = get_windowed_scheduled_times(
+        participant, now, [survey_id for survey_id, _, _ in survey_payloads]
+    )
+    return [
+        format_survey_for_device(survey_dict, weekly_timings, scheduled_times[survey_id], now.tzinfo)
+        for survey_id, survey_dict, weekly_timings in survey_payloads
+    ]
+
+
+def get_windowed_scheduled_times(
+    participant: Participant, now: datetime, survey_ids: List[int]
+) -> DefaultDict[int, List[datetime]]:
+    """ Gets the absolute and relative scheduled times for all of a participant's surveys that fall
+    inside the app's window of time, grouped by survey id. """
+    # While it seems complex to force arbitrary non-repeating weekly-style schedules into a
+    # weekly-based representation time, it turns out we only need to observe some rules:
+    # 1) When "now" becomes the time for a survey notification to appear, it will appear.
+    # 2) When the survey time is removed from the weekly timings the notification will disappear.
+    # 3) Time is 1 week long; keep the examined period of time less than 7 days to avoid corner cases.
+    # So, bracket our view of absolute and relative surveys schedule events like this:
+    now_date = now.date()
+    the_past = \
+        datetime.combine((now_date - timedelta(days=4)), datetime.min.time(), tzinfo=now.tzinfo)
+    the_future = \
+        datetime.combine((now_date + timedelta(days=3)), datetime.min.time(), tzinfo=now.tzinfo)
+    
+    # This query results in a moving window of that "snaps" based on the day at midnight. retains
+    # notifications for 4 days, and gives the app 3 days of failing to check in until it is out of
+    # sync with abosule and relative surveys.
+    # (filter with __lt for the_future since we are "zeroing" to midnight, __gte for the_past.)
+    query = ScheduledEvent.objects.filter(
+        survey_id__in=survey_ids,
+        scheduled_time__gte=the_past,
+        scheduled_time__lt=the_future,
+        participant=participant,
+        # deleted=False,  # ALWAYS send it. Consider notifications broken.
+    ).exclude(weekly_schedule__isnull=False)  # skip where attached weekly schedules are not null
+    
+    scheduled_times = defaultdict(list)
+    for survey_id, scheduled_time in query.values_list("survey_id", "scheduled_time"):
+        scheduled_times[survey_id].append(scheduled_time)
+    return scheduled_times
+
+
+def format_survey_for_device(
+    survey_dict: Dict[str, Any], weekly_timings: List[List[int]],
+    scheduled_times: List[datetime], study_timezone: tzinfo
+) -> Dict[str, Any]:
+    """ Returns a dict with the values of the survey fields for download to the app """
+    # weekly defines a list of 7 lists of ints or [[], [], [], [], [], [], []], copy it.
+    survey_timings = [list(day) for day in weekly_timings]
+    
+    for scheduled_time in scheduled_times:
+        # The date component is dropped, the representation is now 100% a weekly schedule
+        # the correct timezone is the "canonical form", e.g. in the study timezone (and then in
+        # survey timings form as offset from start of day)
+        day_index, seconds = decompose_datetime_to_timings(scheduled_time.astimezone(study_timezone))
+        survey_timings[day_index].append(seconds)
+    
+    # sort, deduplicate all days lists
+    for i in range(len(survey_timings)):
+        survey_timings[i] = sorted(set(survey_timings[i]))
+    
+    # TODO: include schedule event uuids so that we can have full survey state tracking in a v2
+    #   endpoint where we actually send a real schedule with absolute representations of time
+    #   instead of the moving window hack.
+    
+    return {**survey_dict, 'timings': survey_timings}
@@ -1,10 +1,10 @@
 from collections import defaultdict
 from typing import Dict, Generator, List, Union
 
-from django.db.models import F, Func, Sum
+from django.db.models import Func
 
 from constants.forest_constants import DATA_QUANTITY_FIELD_NAMES
-from database.forest_models import SummaryStatisticDaily
+from database.forest_models import DataQuantityRollup
 from database.study_models import Study
 
 
@@ -62,35 +62,21 @@ def insert_missing_empty_participants(study: Study, participant_data: Dict[str,
 
 
 def query_for_summed_data_summaries(study: Study) -> List[Dict[str, Union[int, str]]]:
-    """ For every field name in DATA_QUANTITY_FIELD_NAMES, generate an annotated field that sums all
-    values of that field for each participant. """
+    """ Gets the total of every field in DATA_QUANTITY_FIELD_NAMES for each participant, these are
+    maintained in the DataQuantityRollup table so this is a lookup of one row per participant per
+    field instead of a sum over every participant-day. Participants with no data quantity rows are
+    missing, populate those later for completeness. """
+    participant_summation = defaultdict(dict)
+    query = DataQuantityRollup.objects \
+        .filter(study=study, field_name__in=DATA_QUANTITY_FIELD_NAMES) \
+        .order_by("participant__patient_id") \
+        .values_list("participant__patient_id", "field_name", "total_bytes")
+    for patient_id, field_name, total_bytes in query:
+        participant_summation[patient_id][f"{field_name.replace('beiwe_', '')}_total"] = total_bytes
     
-    # The reason this query magically works is due to a difference between these
-    # two ways to add an annotation to a query:
-    #   1) query_annotation_params[summation_field_name] = Func(field_name, function='SUM')
-    #   2) query_annotation_params[summation_field_name] = Sum(field_name)
-    # The first one must be used from a participant.summarystatisticdaily_set query, otherwise
-    # you get a SQL "column "database_participant.patient_id" must appear in the GROUP BY clause
-    #   or be used in an aggregate function" error.
-    # The second one is used in the query below, but there will be duplicate grouped rows for each
-    #   participant that you have to sum together afterwards in python.
-    # Also, this query will miss participants that have no data quantity fields, so you have to
-    #   populate those later for completeness.
-    
-    query_annotation_params = {"patient_id": F("participant__patient_id")}
-    for field_name in DATA_QUANTITY_FIELD_NAMES:
-        summation_field_name = f"{field_name.replace('beiwe_', '')}_total"
-        query_annotation_params[summation_field_name] = Sum(field_name)
-    
-    # single query for sum of all data quantity fields
-    participant_summation: Dict[str, int] = list(
-        SummaryStatisticDaily.objects
-        .filter(participant__study=study)
-        .order_by("participant__patient_id")
-        .annotate(**query_annotation_params)
-        .values(*query_annotation_params.keys())
-    )
-    return participant_summation
+    return [
+        {"patient_id": patient_id, **totals} for patient_id, totals in participant_summation.items()
+    ]
 
 
 def reference_summarize_data_summaries(study: Study) -> Generator[Dict[str, int], None, None]:
@@ -1,9 +1,11 @@
+from datetime import datetime
 from typing import Tuple
 
 from django.utils import timezone
 
 from constants.data_processing_constants import CHUNK_EXISTS_CASE
 from database.data_access_models import ChunkRegistry
+from libs.chunk_cache import discard_cached_chunk
 from libs.file_processing.utility_functions_simple import decompress
 from libs.s3 import s3_upload
 from libs.utils.security_utils import chunk_hash
@@ -13,8 +15,9 @@ from libs.utils.security_utils import chunk_hash
 # GLOBAL_TIMESTAMP = datetime.now().isoformat()
 
 
-def batch_upload(upload: Tuple[ChunkRegistry or dict, str, bytes, str]):
-    """ Used for mapping an s3_upload function.  the tuple is unpacked, can only have one parameter. """
+def batch_upload(upload: Tuple[ChunkRegistry or dict, str, bytes, str]) -> Tuple[datetime, str, int]:
+    """ Used for mapping an s3_upload function.  the tuple is unpacked, can only have one parameter.
+    Returns the time bin, data type, and change in size of the chunk, for data quantity stats. """
     chunk, chunk_path, new_contents, study_object_id = upload
     del upload
     # there is an external reference to the original new_contents object so there's no way to 
@@ -36,10 +39,16 @@ def batch_upload(upload: Tuple[ChunkRegistry or dict, str, bytes, str]):
     # otherwise we are creating a new one.
     if chunk == CHUNK_EXISTS_CASE:
         # If the contents are being appended to an existing ChunkRegistry object
-        ChunkRegistry.objects.filter(chunk_path=chunk_path).update(
+        time_bin, data_type, old_file_size = ChunkRegistry.objects.filter(chunk_path=chunk_path) \
+            .values_list("time_bin", "data_type", "file_size").get()
+        ChunkRegistry.objects.filter(chunk_path=chunk_path, time_bin=time_bin).update(
             file_size=len(new_contents),
             chunk_hash=chunk_hash(new_contents).decode(),
             last_updated=timezone.now()
         )
+        # the new hash means cached copies of the old contents will never be used again
+        discard_cached_chunk(chunk_path)
+        return time_bin, data_type, len(new_contents) - (old_file_size or 0)
     else:
-        ChunkRegistry.register_chunked_data(**chunk, file_contents=new_contents)
\ No newline at end of file
+        chunk_registry = ChunkRegistry.register_chunked_data(**chunk, file_contents=new_contents)
+        return chunk_registry.time_bin, chunk_registry.data_type, chunk_registry.file_size
\ No newline at end of file
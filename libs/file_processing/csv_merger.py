@@ -88,8 +88,11 @@ class CsvMerger:
             updated_header = convert_unix_to_human_readable_timestamps(original_header, data_rows_list)
             chunk_path = construct_s3_chunk_path(study_object_id, patient_id, data_stream, time_bin)
             
-            # two core cases
-            if ChunkRegistry.objects.filter(chunk_path=chunk_path).exists():
+            # two core cases - (the time_bin means a partitioned table only checks one partition)
+            chunk_exists = ChunkRegistry.objects.filter(
+                chunk_path=chunk_path, time_bin=ChunkRegistry.time_slice_to_time_bin(time_bin)
+            ).exists()
+            if chunk_exists:
                 self.chunk_exists_case(
                     chunk_path, study_object_id, updated_header, data_rows_list, data_stream
                 )
@@ -1,6 +1,6 @@
 from collections import defaultdict
 from datetime import datetime, tzinfo
-from typing import Callable, Dict, Optional
+from typing import Callable, Dict, Optional, Tuple
 
 from dateutil.tz import UTC
 from django.db.models.query import QuerySet
@@ -59,14 +59,15 @@ def calculate_data_quantity_stats(
         earliest_time_bin_number: Optional[int] = None,
         latest_time_bin_number: Optional[int] = None,
 ):
-    """ Update the SummaryStatisticDaily  stats for a participant, using ChunkRegistry data
+    """ Update the SummaryStatisticDaily  stats for a participant, using ChunkRegistry data. This
+    recalculates the totals from scratch, data processing uses apply_data_quantity_deltas instead.
     earliest_time_bin_number -- expressed in hours since 1/1/1970
     latest_time_bin_number -- expressed in hours since 1/1/1970 """
     
     # (related model, study, is cached)
     study_timezone: tzinfo = participant.study.timezone
     query = ChunkRegistry.objects.filter(participant=participant)
-
+    
     # Filter by date range
     if earliest_time_bin_number is not None:
         query = query.filter(
@@ -77,16 +78,45 @@ def calculate_data_quantity_stats(
             time_bin__lt=timeslice_to_end_of_day(latest_time_bin_number, study_timezone)
         )
     
-    # For each date, create a DataQuantity object
+    # For each date, create or update a SummaryStatisticDaily
+    values_by_date = {}
     for day, day_data in populate_data_quantity(query, study_timezone).items():
-        data_quantity = {
-            "participant": participant,
-            "date": day,
-            "defaults": {
-                "timezone": get_timezone_shortcode(day, participant.study.timezone)
-            }
-        }
+        values_by_date[day] = {"timezone": get_timezone_shortcode(day, study_timezone)}
         for data_type, total_bytes in day_data.items():
             if data_type in ALL_DATA_STREAMS:
-                data_quantity["defaults"][f"beiwe_{data_type}_bytes"] = total_bytes
-        SummaryStatisticDaily.objects.update_or_create(**data_quantity)
+                values_by_date[day][f"beiwe_{data_type}_bytes"] = total_bytes
+    SummaryStatisticDaily.bulk_upsert(participant.pk, values_by_date)
+
+
+def apply_data_quantity_deltas(participant: Participant, deltas: Dict[Tuple[datetime, str], int]):
+    """ Adds changes in bytes, keyed by (time bin, data type), to the participant's daily data
+    quantities. Data processing knows the change in size of every chunk it writes, so instead of
+    re-summing every ChunkRegistry in the affected days this is one query for the current values of
+    the affected days and one bulk upsert. """
+    study_timezone: tzinfo = participant.study.timezone
+    daily_deltas = defaultdict(lambda: defaultdict(int))
+    for (time_bin, data_type), delta in deltas.items():
+        if data_type in ALL_DATA_STREAMS:
+            day = time_bin.astimezone(study_timezone).date()
+            daily_deltas[day][f"beiwe_{data_type}_bytes"] += delta
+    if not daily_deltas:
+        return
+    
+    fields = sorted({field for day_deltas in daily_deltas.values() for field in day_deltas})
+    current_values = {
+        values.pop("date"): values for values in SummaryStatisticDaily.objects.filter(
+            participant=participant, date__in=list(daily_deltas)
+        ).values("date", *fields)
+    }
+    
+    values_by_date = {}
+    for day, day_deltas in daily_deltas.items():
+        # all rows get the same fields so that this is a single upsert, untouched fields keep their
+        # current values.
+        values = current_values.get(day, {})
+        for field, delta in day_deltas.items():
+            values[field] = max((values.get(field) or 0) + delta, 0)
+        values_by_date[day] = {field: values.get(field) for field in fields}
+        values_by_date[day]["timezone"] = get_timezone_shortcode(day, study_timezone)
+    
+    SummaryStatisticDaily.bulk_upsert(participant.pk, values_by_date)
@@ -1,6 +1,6 @@
 import time
 from collections import defaultdict
-from datetime import timedelta
+from datetime import datetime, timedelta
 from typing import DefaultDict, Dict, Generator, List, Set, Tuple
 
 from cronutils.error_handler import ErrorHandler
@@ -14,7 +14,7 @@ from database.data_access_models import ChunkRegistry, FileToProcess
 from database.user_models_participant import Participant
 from libs.file_processing.batched_network_operations import batch_upload
 from libs.file_processing.csv_merger import CsvMerger
-from libs.file_processing.data_qty_stats import calculate_data_quantity_stats
+from libs.file_processing.data_qty_stats import apply_data_quantity_deltas
 from libs.file_processing.file_for_processing import FileForProcessing
 from libs.file_processing.utility_functions_simple import (BadTimecodeError, binify_from_timecode,
     clean_java_timecode, resolve_survey_id_from_file_name)
@@ -65,6 +65,9 @@ class FileProcessingTracker():
         
         # we don't actually use this...
         self.buggy_files = set()
+        
+        # changes in bytes of the chunks written in this page, keyed by (time bin, data type)
+        self.data_quantity_deltas: DefaultDict[Tuple[datetime, str], int] = defaultdict(int)
     
     #
     ## Outer Loop
@@ -116,14 +119,16 @@ class FileProcessingTracker():
         
         # there are several failure modes and success modes, information for what to do with different
         # files percolates back to here.  Delete various database objects accordingly.
-        ftps_to_remove, bad_files, earliest_time_bin, latest_time_bin = self.upload_binified_data()
+        try:
+            ftps_to_remove, bad_files, _, _ = self.upload_binified_data()
+        finally:
+            # a failed upload raises, the chunks that were written still count. An error here is
+            # reported on its own so that it does not replace the upload error.
+            with self.error_handler:
+                self.update_data_quantity_stats()
         self.buggy_files.update(bad_files)
         print(f"Successully processed {len(ftps_to_remove)} files, there have been a total of {len(self.buggy_files)} failed files.")
         
-        # Update the data quantity stats (if it actually processed any files)
-        if len(files_to_process) > 0:
-            calculate_data_quantity_stats(self.participant, earliest_time_bin, latest_time_bin)
-        
         # Actually delete the processed FTPs from the database now that we are done.
         FileToProcess.objects.filter(pk__in=ftps_to_remove).delete()
         
@@ -164,7 +169,13 @@ class FileProcessingTracker():
             except IndexError:
                 break
             # if the upload fails we simply error out and try again later. Failure is an option.
-            batch_upload(upload_params_tuple)
+            time_bin, data_type, delta = batch_upload(upload_params_tuple)
+            self.data_quantity_deltas[(time_bin, data_type)] += delta
+    
+    def update_data_quantity_stats(self):
+        """ Applies the changes in bytes of this page's chunks to the data quantity stats. """
+        apply_data_quantity_deltas(self.participant, self.data_quantity_deltas)
+        self.data_quantity_deltas = defaultdict(int)
     
     #
     ## Chunkable File Processing
@@ -257,7 +268,7 @@ class FileProcessingTracker():
         # Since we aren't binning the data by hour, just create a ChunkRegistry that
         # points to the already existing S3 file.
         try:
-            ChunkRegistry.register_unchunked_data(
+            chunk = ChunkRegistry.register_unchunked_data(
                 file_for_processing.data_type,
                 timestamp,
                 file_for_processing.file_to_process.s3_file_path,
@@ -265,6 +276,7 @@ class FileProcessingTracker():
                 file_for_processing.file_to_process.participant.pk,
                 file_for_processing.file_contents,
             )
+            self.data_quantity_deltas[(chunk.time_bin, chunk.data_type)] += chunk.file_size
             file_for_processing.file_to_process.delete()
         except ValidationError as ve:
             if len(ve.messages) != 1:
@@ -275,11 +287,12 @@ class FileProcessingTracker():
             # we detect this specific case and update the registry with the new file size
             # (hopefully it doesn't actually change)
             if 'Chunk registry with this Chunk path already exists.' in ve.messages:
-                ChunkRegistry.update_registered_unchunked_data(
+                chunk, delta = ChunkRegistry.update_registered_unchunked_data(
                     file_for_processing.data_type,
                     file_for_processing.file_to_process.s3_file_path,
                     file_for_processing.file_contents,
                 )
+                self.data_quantity_deltas[(chunk.time_bin, chunk.data_type)] += delta
                 file_for_processing.file_to_process.delete()
             else:
                 # any other errors, add
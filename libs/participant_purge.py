@@ -1,4 +1,6 @@
 import itertools
+from datetime import timedelta
+from time import monotonic
 from typing import List, Tuple
 
 from django.utils import timezone
@@ -6,12 +8,19 @@ from django.utils import timezone
 from constants import action_log_messages
 from constants.common_constants import CHUNKS_FOLDER, PROBLEM_UPLOADS
 from database.user_models_participant import Participant, ParticipantDeletionEvent
+from libs.chunk_cache import (chunk_cache_enabled, discard_cached_chunk,
+    discard_cached_chunks_by_prefix, get_last_sweep_time, set_last_sweep_time)
+from libs.chunk_registry_partitions import delete_chunk_registries_by_month
 from libs.s3 import s3_delete_many_versioned, s3_list_files, s3_list_versions
 from libs.utils.security_utils import generate_easy_alphanumeric_string
 
 
 DELETION_PAGE_SIZE = 250
 
+# how often code that reads from the chunk cache checks for purged participants, in seconds.
+CACHE_SWEEP_INTERVAL = 5 * 60
+_next_cache_sweep = 0.0
+
 
 def add_participant_for_deletion(participant: Participant):
     """ Adds a participant to the deletion queue. """
@@ -52,8 +61,10 @@ def run_next_queued_participant_data_deletion():
     delete_participant_data(deletion_event)
     # A meta test that checks that a test for every single related field is present will fail
     # whenever a new relation is added. You have to manually make that test.
-    deletion_event.participant.chunk_registries.all().delete()
+    discard_cached_chunks(deletion_event.participant)
+    delete_chunk_registries_by_month(deletion_event.participant.chunk_registries.all())
     deletion_event.participant.summarystatisticdaily_set.all().delete()
+    deletion_event.participant.data_quantity_rollups.all().delete()
     deletion_event.participant.lineencryptionerror_set.all().delete()
     deletion_event.participant.iosdecryptionkey_set.all().delete()
     deletion_event.participant.foresttask_set.all().delete()
@@ -77,6 +88,51 @@ def run_next_queued_participant_data_deletion():
     deletion_event.participant.log(action_log_messages.PARTICIPANT_DELETION_EVENT_DONE)
 
 
+def discard_cached_chunks(participant: Participant):
+    """ Removes the participant's decrypted data from the local chunk cache. """
+    if not chunk_cache_enabled():
+        return
+    for chunk_path in participant.chunk_registries.values_list("chunk_path", flat=True).iterator():
+        discard_cached_chunk(chunk_path)
+
+
+def sweep_purged_cached_chunks():
+    """ Removes the decrypted data of purged participants from this server's chunk cache. A purge
+    only clears the cache of the server it runs on, every server with a chunk cache runs this
+    periodically. Deletion events are updated throughout a purge (and chunks of a participant being
+    purged can be cached until their ChunkRegistries are deleted), so every event that was updated
+    since the last sweep is swept again. """
+    if not chunk_cache_enabled():
+        return
+    
+    now = timezone.now()
+    last_sweep_time = get_last_sweep_time()
+    deletion_events = ParticipantDeletionEvent.objects.all()
+    if last_sweep_time is not None:
+        # a minute of overlap covers clock differences between servers.
+        deletion_events = deletion_events.filter(
+            last_updated__gte=last_sweep_time - timedelta(minutes=1)
+        )
+    
+    prefixes = []
+    for deletion_event in deletion_events.select_related("participant__study"):
+        _, base, chunks_prefix, _ = get_all_file_path_prefixes(deletion_event.participant)
+        prefixes.extend((base, chunks_prefix))  # audio files are not in the chunks folder.
+    if prefixes:
+        discard_cached_chunks_by_prefix(prefixes)
+    set_last_sweep_time(now)
+
+
+def sweep_purged_cached_chunks_if_due():
+    """ Runs sweep_purged_cached_chunks at most every CACHE_SWEEP_INTERVAL seconds per process, call
+    before reading from the chunk cache. """
+    global _next_cache_sweep
+    if not chunk_cache_enabled() or monotonic() < _next_cache_sweep:
+        return
+    _next_cache_sweep = monotonic() + CACHE_SWEEP_INTERVAL
+    sweep_purged_cached_chunks()
+
+
 def delete_participant_data(deletion_event: ParticipantDeletionEvent):
     """ Deletes all files on S3 for a participant. """
     for page_of_files in all_participant_file_paths(deletion_event.participant):
@@ -108,6 +164,8 @@ def confirm_deleted(deletion_event: ParticipantDeletionEvent):
         raise AssertionError("still have database entries for chunk_registries")
     if deletion_event.participant.summarystatisticdaily_set.exists():
         raise AssertionError("still have database entries for summarystatisticdaily")
+    if deletion_event.participant.data_quantity_rollups.exists():
+        raise AssertionError("still have database entries for data_quantity_rollups")
     if deletion_event.participant.lineencryptionerror_set.exists():
         raise AssertionError("still have database entries for lineencryptionerror")
     if deletion_event.participant.iosdecryptionkey_set.exists():
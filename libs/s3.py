@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import Generator, List, Optional, Tuple
+from typing import BinaryIO, Generator, List, Optional, Tuple
 
 import boto3
 from botocore.client import BaseClient, Paginator
@@ -10,7 +10,7 @@ from Cryptodome.PublicKey import RSA
 from config.settings import (BEIWE_SERVER_AWS_ACCESS_KEY_ID, BEIWE_SERVER_AWS_SECRET_ACCESS_KEY,
     S3_BUCKET, S3_REGION_NAME)
 from constants.common_constants import CHUNKS_FOLDER
-from libs.aes import decrypt_server, encrypt_for_server
+from libs.aes import decrypt_server, decrypt_server_stream, encrypt_for_server
 from libs.rsa import generate_key_pairing, get_RSA_cipher, prepare_X509_key_for_java
 
 
@@ -27,6 +27,10 @@ class NoSuchKeyException(Exception): pass
 class S3DeleteException(Exception): pass
 
 
+# the size of the pieces that streaming retrievals read from S3 and decrypt
+S3_STREAM_CHUNK_SIZE = 1024 * 1024
+
+
 conn: BaseClient = boto3.client(
     's3',
     aws_access_key_id=BEIWE_SERVER_AWS_ACCESS_KEY_ID,
@@ -105,6 +109,21 @@ def s3_retrieve(key_path: str, obj: str, raw_path: bool = False, number_retries=
     return decrypt_server(encrypted_data, smart_get_study_encryption_key(obj))
 
 
+def s3_retrieve_to_file(
+    key_path: str, encryption_key: bytes, file_obj: BinaryIO, number_retries=3
+) -> int:
+    """ Retrieves an S3 file (key_path is the full path) and decrypts it into a file object as it
+    downloads, instead of holding the whole file in memory. The encryption key is passed in so that
+    callers retrieving many files of one study look it up once. Returns the number of bytes written. """
+    assert S3_BUCKET is not Exception, "libs.s3.s3_retrieve_to_file called inside test"
+    body = _do_retrieve(S3_BUCKET, key_path, number_retries=number_retries)['Body']
+    bytes_written = 0
+    for plaintext in decrypt_server_stream(body.iter_chunks(S3_STREAM_CHUNK_SIZE), encryption_key):
+        file_obj.write(plaintext)
+        bytes_written += len(plaintext)
+    return bytes_written
+
+
 def s3_retrieve_plaintext(key_path: str, number_retries=3) -> bytes:
     """ Retrieves a file as-is as bytes. """
     return _do_retrieve(S3_BUCKET, key_path, number_retries=number_retries)['Body'].read()
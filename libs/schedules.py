@@ -1,6 +1,8 @@
 # trunk-ignore(ruff/E701)
 from datetime import date, datetime, timedelta
-from typing import List, Tuple
+from typing import List, Set, Tuple
+
+from django.db.models import QuerySet
 
 from constants.schedule_constants import EMPTY_WEEKLY_SURVEY_TIMINGS
 from database.schedule_models import AbsoluteSchedule, ArchivedEvent, ScheduledEvent, WeeklySchedule
@@ -14,6 +16,10 @@ class NoSchedulesException(Exception): pass
 class UnknownScheduleScenario(Exception): pass
 
 
+# the number of ScheduledEvents created or deleted per query when updating survey schedules.
+SCHEDULE_SYNC_BATCH_SIZE = 1000
+
+
 # Weekly timings lists code
 def get_start_and_end_of_java_timings_week(now: datetime) -> Tuple[datetime, datetime]:
     """ study timezone aware week start and end """
@@ -55,6 +61,50 @@ def set_next_weekly(participant: Participant, survey: Survey) -> Tuple[Scheduled
         raise UnknownScheduleScenario("unknown condition reached")
 
 
+def bulk_set_next_weekly(participant_ids_and_surveys: List[Tuple[int, Survey]]) -> int:
+    """ The bulk version of set_next_weekly, creates the next weekly ScheduledEvent for each
+    (participant id, survey) unless it already exists. The next event is calculated once per survey,
+    existing events are found in one query and the missing ones are created in one query. Returns
+    the number of events created. """
+    next_events = {}
+    for _, survey in participant_ids_and_surveys:
+        if survey.id not in next_events:
+            next_events[survey.id] = get_next_weekly_event_and_schedule(survey)
+    
+    participant_and_survey_ids = {
+        (participant_id, survey.id) for participant_id, survey in participant_ids_and_surveys
+    }
+    # matches the get_or_create in set_next_weekly, deleted events count as existing.
+    existing_events = set(
+        ScheduledEvent.objects.filter(
+            survey_id__in=next_events.keys(),
+            participant_id__in={participant_id for participant_id, _ in participant_and_survey_ids},
+            weekly_schedule_id__in={schedule.id for _, schedule in next_events.values()},
+            relative_schedule=None,
+            absolute_schedule=None,
+            scheduled_time__in={schedule_date for schedule_date, _ in next_events.values()},
+        ).values_list("participant_id", "survey_id", "weekly_schedule_id", "scheduled_time")
+    )
+    
+    new_events = []
+    for participant_id, survey_id in participant_and_survey_ids:
+        schedule_date, schedule = next_events[survey_id]
+        if (participant_id, survey_id, schedule.id, schedule_date) not in existing_events:
+            new_events.append(
+                ScheduledEvent(
+                    survey_id=survey_id,
+                    participant_id=participant_id,
+                    weekly_schedule=schedule,
+                    relative_schedule=None,
+                    absolute_schedule=None,
+                    scheduled_time=schedule_date,
+                )
+            )
+    ScheduledEvent.populate_fire_times(new_events)
+    ScheduledEvent.objects.bulk_create(new_events)
+    return len(new_events)
+
+
 def repopulate_all_survey_scheduled_events(study: Study, participant: Participant = None):
     """ Runs all the survey scheduled event generations on the provided entities. """
     for survey in study.surveys.all():
@@ -70,82 +120,114 @@ def repopulate_all_survey_scheduled_events(study: Study, participant: Participan
         repopulate_relative_survey_schedule_events(survey, participant)
 
 
-#TODO: this will need to be rewritten to examine existing weekly schedules
+def sync_scheduled_events(
+    existing_events: QuerySet[ScheduledEvent], schedule_field: str,
+    desired_events: List[ScheduledEvent]
+) -> Tuple[int, int]:
+    """ Makes existing_events match desired_events, events are identified by their participant,
+    schedule and scheduled time. Existing events that are still desired are left alone (along with
+    their uuid, checkin and deleted status), the rest are deleted, and the missing desired events
+    are created; in batches. Returns the number of events created and deleted. """
+    existing = {}
+    obsolete_ids = []
+    for pk, participant_id, schedule_id, scheduled_time in existing_events.values_list(
+        "pk", "participant_id", schedule_field + "_id", "scheduled_time"
+    ):
+        key = (participant_id, schedule_id, scheduled_time)
+        if key in existing:
+            obsolete_ids.append(pk)  # duplicate
+        else:
+            existing[key] = pk
+    
+    new_events = []
+    for event in desired_events:
+        key = (event.participant_id, getattr(event, schedule_field + "_id"), event.scheduled_time)
+        # datetimes with different timezones but the same instant compare and hash equal.
+        if existing.pop(key, None) is None:
+            new_events.append(event)
+    obsolete_ids.extend(existing.values())  # whatever is left over is no longer desired
+    
+    for i in range(0, len(obsolete_ids), SCHEDULE_SYNC_BATCH_SIZE):
+        ScheduledEvent.objects.filter(pk__in=obsolete_ids[i:i + SCHEDULE_SYNC_BATCH_SIZE]).delete()
+    ScheduledEvent.populate_fire_times(new_events)
+    ScheduledEvent.objects.bulk_create(new_events, batch_size=SCHEDULE_SYNC_BATCH_SIZE)
+    return len(new_events), len(obsolete_ids)
+
+
+def get_sent_events(
+    survey: Survey, scheduled_times: Set[datetime], participant_ids: List[int]
+) -> Set[Tuple[int, datetime]]:
+    """ Returns the (participant id, scheduled time) of ArchivedEvents on the survey, events for
+    already sent notifications must not be recreated. """
+    if not scheduled_times or not participant_ids:
+        return set()
+    query = ArchivedEvent.objects.filter(
+        survey_archive__survey_id=survey.id, scheduled_time__in=scheduled_times
+    )
+    if len(participant_ids) == 1:
+        query = query.filter(participant_id=participant_ids[0])
+    return set(query.values_list("participant_id", "scheduled_time"))
+
+
 def repopulate_weekly_survey_schedule_events(survey: Survey, single_participant: Participant = None) -> None:
-    """ Clear existing schedules, get participants, bulk create schedules Weekly events are
-    calculated in a way that we don't bother checking for survey archives, because they only exist
-    in the future. """
+    """ Updates the weekly ScheduledEvents of a survey so that every (undeleted) participant has an
+    event for the next weekly schedule time. Weekly events are calculated in a way that we don't
+    bother checking for survey archives, because they only exist in the future. """
     events = survey.scheduled_events.filter(relative_schedule=None, absolute_schedule=None)
     if single_participant:
         events = events.filter(participant=single_participant)
-        participant_ids = [single_participant.pk]
+        participant_ids = [] if single_participant.deleted else [single_participant.pk]
     else:
         participant_ids = survey.study.participants.exclude(deleted=True).values_list("pk", flat=True)
     
-    events.delete()
-    if single_participant and single_participant.deleted:
-        return
-    
     try:
         # get_next_weekly_event forces tz-aware schedule_date datetime object
         schedule_date, schedule = get_next_weekly_event_and_schedule(survey)
     except NoSchedulesException:
-        return
+        participant_ids = []
     
-    ScheduledEvent.objects.bulk_create(
-        [
-            ScheduledEvent(
-                survey=survey,
-                participant_id=participant_id,
-                weekly_schedule=schedule,
-                relative_schedule=None,
-                absolute_schedule=None,
-                scheduled_time=schedule_date,
-            ) for participant_id in participant_ids
-        ]
-    )
+    desired_events = [
+        ScheduledEvent(
+            survey=survey,
+            participant_id=participant_id,
+            weekly_schedule=schedule,
+            relative_schedule=None,
+            absolute_schedule=None,
+            scheduled_time=schedule_date,
+        ) for participant_id in participant_ids
+    ]
+    sync_scheduled_events(events, "weekly_schedule", desired_events)
 
 
-#TODO: this will need to be rewritten to examine existing absolute schedules
 def repopulate_absolute_survey_schedule_events(survey: Survey, single_participant: Participant = None) -> None:
-    """ Creates new ScheduledEvents for the survey's AbsoluteSchedules while deleting the old
-    ScheduledEvents related to the survey """
+    """ Updates the survey's ScheduledEvents for its AbsoluteSchedules, creating missing events and
+    deleting outdated ones. """
     # if the event is from an absolute schedule, relative and weekly schedules will be None
     events = survey.scheduled_events.filter(relative_schedule=None, weekly_schedule=None)
     if single_participant:
         events = events.filter(participant=single_participant)
-    events.delete()
+        participant_ids = [] if single_participant.deleted else [single_participant.pk]
+    else:
+        participant_ids = list(
+            survey.study.participants.exclude(deleted=True).values_list("pk", flat=True)
+        )
     
-    if single_participant and single_participant.deleted:
-        return
+    absolute_schedules = [
+        (abs_sched, abs_sched.event_time) for abs_sched in survey.absolute_schedules.all()
+    ]
+    # don't create events for already sent notifications
+    sent_events = get_sent_events(
+        survey, {scheduled_time for _, scheduled_time in absolute_schedules}, participant_ids
+    )
     
-    new_events = []
+    desired_events = []
     abs_sched: AbsoluteSchedule
-    # for each absolute schedule on the survey create a new scheduled event for each participant.
-    for abs_sched in survey.absolute_schedules.all():
-        scheduled_time = abs_sched.event_time
-        # if one participant
-        if single_participant:
-            archive_exists = ArchivedEvent.objects.filter(
-                survey_archive__survey=survey,
-                scheduled_time=scheduled_time,
-                participant_id=single_participant.pk
-            ).exists()
-            relevant_participants = [] if archive_exists else [single_participant.pk]
-        
-        # if many participants
-        else:
-            # don't create events for already sent notifications, or deleted participants
-            irrelevant_participants = ArchivedEvent.objects.filter(
-                survey_archive__survey=survey, scheduled_time=scheduled_time,
-            ).values_list("participant_id", flat=True)
-            relevant_participants = survey.study.participants.exclude(
-                pk__in=irrelevant_participants, deleted=True
-            ).values_list("pk", flat=True)
-        
-        # populate the new events
-        for participant_id in relevant_participants:
-            new_events.append(ScheduledEvent(
+    # for each absolute schedule on the survey there is a scheduled event for each participant.
+    for abs_sched, scheduled_time in absolute_schedules:
+        for participant_id in participant_ids:
+            if (participant_id, scheduled_time) in sent_events:
+                continue
+            desired_events.append(ScheduledEvent(
                 survey=survey,
                 weekly_schedule=None,
                 relative_schedule=None,
@@ -153,66 +235,63 @@ def repopulate_absolute_survey_schedule_events(survey: Survey, single_participan
                 scheduled_time=scheduled_time,
                 participant_id=participant_id
             ))
-    # save to database
-    ScheduledEvent.objects.bulk_create(new_events)
+    sync_scheduled_events(events, "absolute_schedule", desired_events)
 
 
 def repopulate_relative_survey_schedule_events(survey: Survey, single_participant: Participant = None) -> None:
-    """ Creates new ScheduledEvents for the survey's RelativeSchedules while deleting the old
-    ScheduledEvents related to the survey. """
-    # Clear out existing events.
+    """ Updates the survey's ScheduledEvents for its RelativeSchedules, creating missing events and
+    deleting outdated ones. """
     events = survey.scheduled_events.filter(absolute_schedule=None, weekly_schedule=None)
     if single_participant:
         events = events.filter(participant=single_participant)
-    events.delete()
-    
-    if single_participant and single_participant.deleted:
-        return
     
     # This is per schedule, and a participant can't have more than one intervention date per
     # intervention per schedule.  It is also per survey and all we really care about is
     # whether an event ever triggered on that survey.
-    new_events = []
+    desired_events = []
     study_timezone = survey.study.timezone  # might as well cache this...
-    for relative_schedule in survey.relative_schedules.all():
-        # Only interventions that have been marked (have a date), for participants that are not
-        # deleted, restrict on the single user case, get data points.
-        intervention_dates_query = relative_schedule.intervention.intervention_dates.filter(
-            date__isnull=False,
-            participant__deleted=False  # do not refactor to .exclude!
-            # Subtle [Django?] Bug that I don't understand: you can't exclude null database values?
-            #   intervention_dates_query.exclude(date__isnull=True, ...)
-            #  The above query.exclude returns instances where date is None, same for `date=None`
-        )
-        if single_participant:
-            intervention_dates_query = intervention_dates_query.filter(participant=single_participant)
-        intervention_dates_query = intervention_dates_query.values_list("participant_id", "date")
-        
-        for participant_id, intervention_date in intervention_dates_query:
-            # + below is correct, 'days_after' is negative or 0 for days before and day of.
-            # bug: somehow got a Nonetype error even though intervention_date cannot be None... how?
-            # "unsupported operand type(s) for +: 'NoneType' and 'datetime.timedelta'"
-            # (the order of items in the error statements reflects the code, so intervention_date was None.)
-            scheduled_date = intervention_date + timedelta(days=relative_schedule.days_after)
-            schedule_time = relative_schedule.scheduled_time(scheduled_date, study_timezone)
-            # skip if already sent (archived event matching participant, survey, and schedule time)
-            if ArchivedEvent.objects.filter(
-                participant_id=participant_id,
-                survey_archive__survey_id=survey.id,
-                scheduled_time=schedule_time,
-            ).exists():
-                continue
+    if not (single_participant and single_participant.deleted):
+        for relative_schedule in survey.relative_schedules.all():
+            # Only interventions that have been marked (have a date), for participants that are not
+            # deleted, restrict on the single user case, get data points.
+            intervention_dates_query = relative_schedule.intervention.intervention_dates.filter(
+                date__isnull=False,
+                participant__deleted=False  # do not refactor to .exclude!
+                # Subtle [Django?] Bug that I don't understand: you can't exclude null database values?
+                #   intervention_dates_query.exclude(date__isnull=True, ...)
+                #  The above query.exclude returns instances where date is None, same for `date=None`
+            )
+            if single_participant:
+                intervention_dates_query = intervention_dates_query.filter(participant=single_participant)
+            intervention_dates_query = intervention_dates_query.values_list("participant_id", "date")
             
-            new_events.append(ScheduledEvent(
-                survey=survey,
-                participant_id=participant_id,
-                weekly_schedule=None,
-                relative_schedule=relative_schedule,
-                absolute_schedule=None,
-                scheduled_time=schedule_time,
-            ))
+            for participant_id, intervention_date in intervention_dates_query:
+                # + below is correct, 'days_after' is negative or 0 for days before and day of.
+                # bug: somehow got a Nonetype error even though intervention_date cannot be None... how?
+                # "unsupported operand type(s) for +: 'NoneType' and 'datetime.timedelta'"
+                # (the order of items in the error statements reflects the code, so intervention_date was None.)
+                scheduled_date = intervention_date + timedelta(days=relative_schedule.days_after)
+                schedule_time = relative_schedule.scheduled_time(scheduled_date, study_timezone)
+                desired_events.append(ScheduledEvent(
+                    survey=survey,
+                    participant_id=participant_id,
+                    weekly_schedule=None,
+                    relative_schedule=relative_schedule,
+                    absolute_schedule=None,
+                    scheduled_time=schedule_time,
+                ))
     
-    ScheduledEvent.objects.bulk_create(new_events)
+    # skip if already sent (archived event matching participant, survey, and schedule time)
+    sent_events = get_sent_events(
+        survey,
+        {event.scheduled_time for event in desired_events},
+        list({event.participant_id for event in desired_events}),
+    )
+    desired_events = [
+        event for event in desired_events
+        if (event.participant_id, event.scheduled_time) not in sent_events
+    ]
+    sync_scheduled_events(events, "relative_schedule", desired_events)
 
 
 def get_next_weekly_event_and_schedule(survey: Survey) -> Tuple[datetime, WeeklySchedule]:
@@ -1,11 +1,19 @@
 import json
-from multiprocessing.pool import ThreadPool
-from typing import Generator, Iterable, Tuple
-from zipfile import ZIP_STORED, ZipFile
+import tarfile
+from collections import deque
+from multiprocessing.pool import AsyncResult, ThreadPool
+from time import perf_counter, time
+from typing import Callable, Deque, Dict, Generator, Iterable, Optional, Tuple, Union
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
 
+import zstd
+
+from config.settings import DATA_API_DOWNLOAD_BUFFER_MB, DATA_API_DOWNLOAD_THREADS
 from constants.data_stream_constants import (SURVEY_ANSWERS, SURVEY_TIMINGS,
     VOICE_RECORDING)
 from database.study_models import Study
+from libs.chunk_cache import cache_chunk, get_cached_chunk
+from libs.participant_purge import sweep_purged_cached_chunks_if_due
 from libs.s3 import s3_retrieve
 from libs.streaming_io import StreamingBytesIO
 
@@ -13,6 +21,16 @@ from libs.streaming_io import StreamingBytesIO
 class DummyError(Exception): pass
 
 
+# Opt-in compression options for data downloads.
+COMPRESSION_NONE = "none"        # zip file, entries are stored (the default)
+COMPRESSION_DEFLATE = "deflate"  # zip file, entries are deflated
+COMPRESSION_ZSTD = "zstd"        # tar file compressed with zstd (a .tar.zst file)
+COMPRESSION_OPTIONS = (COMPRESSION_NONE, COMPRESSION_DEFLATE, COMPRESSION_ZSTD)
+
+ZSTD_COMPRESSION_LEVEL = 3  # zstd's default level, plenty fast to keep up with a network connection
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
 def determine_file_name(chunk):
     """ Generates the correct file name to provide the file with in the zip file.
         (This also includes the folder location files in the zip.) """
@@ -45,41 +63,170 @@ def determine_file_name(chunk):
                             str(chunk["time_bin"]).replace(":", "_"), extension)
 
 
-def batch_retrieve_s3(chunk: dict) -> Tuple[dict, bytes]:
-    """ Data is returned in the form (chunk_object, file_data). """
-    return chunk, s3_retrieve(
-        chunk["chunk_path"],
-        Study.objects.get(id=chunk["study_id"]),
-        raw_path=True,
-    )
+def batch_retrieve_s3(chunk: dict, study: Study) -> Tuple[dict, bytes]:
+    """ Data is returned in the form (chunk_object, file_data). The study is passed in so that the
+    thread does not need to make a database query. """
+    file_contents = get_cached_chunk(chunk["chunk_path"], chunk["chunk_hash"])
+    if file_contents is None:
+        file_contents = s3_retrieve(chunk["chunk_path"], study, raw_path=True)
+        cache_chunk(chunk["chunk_path"], chunk["chunk_hash"], file_contents)
+    return chunk, file_contents
+
+
+def batch_retrieve_s3_as_tar_zstd(chunk: dict, study: Study) -> Tuple[dict, bytes]:
+    """ As batch_retrieve_s3, but the file data is returned as a zstd-compressed tar entry. """
+    chunk, file_contents = batch_retrieve_s3(chunk, study)
+    return chunk, tar_zstd_entry(determine_file_name(chunk), file_contents)
+
+
+def tar_zstd_entry(file_name: str, file_contents: bytes) -> bytes:
+    """ A tar header, the file contents, and the padding to the next tar block, compressed as a
+    standalone zstd frame. Concatenated zstd frames are a valid zstd stream, so these can be
+    compressed in parallel and simply be concatenated. """
+    tar_info = tarfile.TarInfo(file_name)
+    tar_info.size = len(file_contents)
+    tar_info.mtime = int(time())
+    padding = b"\0" * ((TAR_BLOCK_SIZE - len(file_contents) % TAR_BLOCK_SIZE) % TAR_BLOCK_SIZE)
+    return zstd.compress(tar_info.tobuf() + file_contents + padding, ZSTD_COMPRESSION_LEVEL)
 
 
 class ZipGenerator:
     """ Pulls in data from S3 in a multithreaded network operation, constructs a zip file of that
     data. This is a generator, advantage is it starts returning data (file by file, but wrapped
     in zip compression) almost immediately.
-    NOTE: does not compress! """
     
-    def __init__(self, files_list: Iterable[str], construct_registry: bool, threads: int = 3):
+    Files are retrieved concurrently but are written to the zip in the order they were provided.
+    Retrievals are only submitted ahead of the consumer while the (approximate, from file_size)
+    amount of retrieved-but-unsent data is under buffer_bytes, so a slow client can't cause an
+    unbounded pile of decrypted files in memory.
+    NOTE: does not compress unless compression is COMPRESSION_DEFLATE. """
+    
+    # the function that runs on the threadpool, (chunk, study) -> (chunk, file data)
+    retrieve_function: Callable[[dict, Study], Tuple[dict, bytes]] = staticmethod(batch_retrieve_s3)
+    
+    def __init__(
+        self,
+        files_list: Iterable[dict],
+        construct_registry: bool,
+        threads: int = DATA_API_DOWNLOAD_THREADS,
+        buffer_bytes: int = DATA_API_DOWNLOAD_BUFFER_MB * 1024 * 1024,
+        compression: str = COMPRESSION_NONE,
+    ):
         self.construct_registry = construct_registry
         self.files_list = files_list
         self.processed_files = set()
         self.duplicate_files = set()  # mostly for debugging
         self.file_registry = {}
-        self.total_bytes = 0
         self.threads = threads
+        self.buffer_bytes = buffer_bytes
+        self.compression = compression
+        # a download is almost always a single study, we only look up each study once.
+        self.studies: Dict[int, Study] = {}
+        
+        # stats
+        self.total_bytes = 0  # bytes of output
+        self.bytes_retrieved = 0  # bytes of file data returned from the threadpool
+        self.files_retrieved = 0
+        self.buffered_bytes = 0
+        self.peak_buffered_bytes = 0
+        self.start_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+    
+    @staticmethod
+    def for_compression(files_list: Iterable[dict], construct_registry: bool, compression: str):
+        """ Instantiates the correct generator class for a compression option. """
+        if compression == COMPRESSION_ZSTD:
+            return TarZstdGenerator(files_list, construct_registry)
+        return ZipGenerator(files_list, construct_registry, compression=compression)
+    
+    @property
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """ Throughput and memory statistics for the download (so far). """
+        if self.start_time is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self.end_time or perf_counter()) - self.start_time
+        return {
+            "files_retrieved": self.files_retrieved,
+            "bytes_retrieved": self.bytes_retrieved,
+            "bytes_output": self.total_bytes,
+            "peak_buffered_bytes": self.peak_buffered_bytes,
+            "seconds": elapsed,
+            "output_bytes_per_second": self.total_bytes / elapsed if elapsed else 0.0,
+        }
+    
+    def get_study(self, study_id: int) -> Study:
+        """ Runs on the main thread, cached so there is one query per study per download. """
+        if study_id not in self.studies:
+            self.studies[study_id] = Study.objects.get(id=study_id)
+        return self.studies[study_id]
+    
+    def retrieve_in_order(self, pool: ThreadPool) -> Generator[Tuple[dict, bytes], None, None]:
+        """ Keeps the pool busy retrieving files ahead of the consumer, within the byte budget, and
+        yields (chunk, file contents) in the order of the files list. """
+        in_flight: Deque[Tuple[int, AsyncResult]] = deque()
+        max_in_flight = self.threads * 4  # handles unknown file sizes, and many tiny files
+        files = iter(self.files_list)
+        files_remaining = True
+        
+        while True:
+            # always keep at least one retrieval in flight, add more while we are under budget.
+            while files_remaining and (
+                not in_flight or
+                (len(in_flight) < max_in_flight and self.buffered_bytes < self.buffer_bytes)
+            ):
+                chunk = next(files, None)
+                if chunk is None:
+                    files_remaining = False
+                    break
+                size = chunk.get("file_size", None) or 0
+                self.buffered_bytes += size
+                self.peak_buffered_bytes = max(self.peak_buffered_bytes, self.buffered_bytes)
+                study = self.get_study(chunk["study_id"])
+                in_flight.append((size, pool.apply_async(self.retrieve_function, (chunk, study))))
+            
+            if not in_flight:
+                return
+            
+            size, result = in_flight.popleft()
+            chunk, file_contents = result.get()
+            self.buffered_bytes -= size
+            self.files_retrieved += 1
+            self.bytes_retrieved += len(file_contents)
+            yield chunk, file_contents
+    
+    ## Archive format specific methods, each returns the bytes to be yielded
+    
+    def open_archive(self):
+        self.zip_output = StreamingBytesIO()
+        compression = ZIP_DEFLATED if self.compression == COMPRESSION_DEFLATE else ZIP_STORED
+        self.zip_input = ZipFile(
+            self.zip_output, mode="w", compression=compression, allowZip64=True
+        )
+    
+    def add_file(self, file_name: str, file_contents: bytes) -> bytes:
+        self.zip_input.writestr(file_name, file_contents)
+        # These can be large, and we don't want them sticking around in memory as we wait
+        # for the yield, and they could be many megabytes and it is about to be duplicated.
+        del file_contents
+        one_file_in_a_zip = self.zip_output.getvalue()
+        self.zip_output.empty()
+        return one_file_in_a_zip
+    
+    def close_archive(self) -> bytes:
+        # close, then return all remaining data in the zip.
+        self.zip_input.close()
+        return self.zip_output.getvalue()
     
     def __iter__(self) -> Generator[bytes, None, None]:
+        sweep_purged_cached_chunks_if_due()
         pool = ThreadPool(self.threads)
-        zip_output = StreamingBytesIO()
-        zip_input = ZipFile(zip_output, mode="w", compression=ZIP_STORED, allowZip64=True)
+        self.open_archive()
+        self.start_time = perf_counter()
         try:
-            # chunks_and_content is a list of tuples, of the chunk and the content of the file.
-            # chunksize (which is a keyword argument of imap, not to be confused with Beiwe Chunks)
-            # is the size of the batches that are handed to the pool. We always want to add the next
-            # file to retrieve to the pool asap, so we want a chunk size of 1.
-            # (In the documentation there are comments about the timeout, it is irrelevant under this construction.)
-            chunks_and_content = pool.imap_unordered(batch_retrieve_s3, self.files_list, chunksize=1)
+            # chunks_and_content is a generator of tuples, of the chunk and the content of the file.
+            # Retrieval is submitted to the pool one file at a time, ahead of this loop.
+            chunks_and_content = self.retrieve_in_order(pool)
             
             for chunk, file_contents in chunks_and_content:
                 if self.construct_registry:
@@ -91,30 +238,23 @@ class ZipGenerator:
                     continue
                 self.processed_files.add(file_name)
                 
-                zip_input.writestr(file_name, file_contents)
-                
-                # These can be large, and we don't want them sticking around in memory as we wait
-                # for the yield, and they could be many megabytes and it is about to be duplicated.
-                del file_contents, chunk
-                
                 # write data to your stream
-                one_file_in_a_zip = zip_output.getvalue()
-                self.total_bytes += len(one_file_in_a_zip)
-                yield one_file_in_a_zip
-                # print "%s: %sK, %sM" % (random_id, total_bytes / 1024, total_bytes / 1024 / 1024)
-                
-                del one_file_in_a_zip
-                zip_output.empty()
+                output = self.add_file(file_name, file_contents)
+                del file_contents, chunk
+                self.total_bytes += len(output)
+                yield output
+                del output
             
             # construct the registry file
             if self.construct_registry:
-                zip_input.writestr("registry", json.dumps(self.file_registry))
-                yield zip_output.getvalue()
-                zip_output.empty()
+                output = self.add_file("registry", json.dumps(self.file_registry).encode())
+                self.total_bytes += len(output)
+                yield output
+                del output
             
-            # close, then yield all remaining data in the zip.
-            zip_input.close()
-            yield zip_output.getvalue()
+            output = self.close_archive()
+            self.total_bytes += len(output)
+            yield output
         
         except DummyError:
             # The try-except-finally block is here to guarantee the Threadpool is closed and terminated.
@@ -126,3 +266,28 @@ class ZipGenerator:
             # and also to print an error to the log if we need to.
             pool.close()
             pool.terminate()
+            self.end_time = perf_counter()
+
+
+class TarZstdGenerator(ZipGenerator):
+    """ As ZipGenerator, but produces a zstd-compressed tar file. Each file is compressed inside
+    the threadpool as a separate zstd frame, so compression does not bottleneck the streaming
+    thread. """
+    
+    retrieve_function = staticmethod(batch_retrieve_s3_as_tar_zstd)
+    
+    def __init__(self, files_list: Iterable[dict], construct_registry: bool, **kwargs):
+        super().__init__(files_list, construct_registry, compression=COMPRESSION_ZSTD, **kwargs)
+    
+    def open_archive(self):
+        pass
+    
+    def add_file(self, file_name: str, file_contents: bytes) -> bytes:
+        # the registry is the only file that is not already a compressed tar entry.
+        if file_name == "registry":
+            return tar_zstd_entry(file_name, file_contents)
+        return file_contents
+    
+    def close_archive(self) -> bytes:
+        # the end of a tar archive is marked by two empty blocks
+        return zstd.compress(b"\0" * TAR_BLOCK_SIZE * 2, ZSTD_COMPRESSION_LEVEL)
@@ -14,8 +14,9 @@ class DowntimeMiddleware:
         self.get_response = get_response
     
     def __call__(self, request: HttpRequest):
-        # if downtime is enabled, return a 503.
-        if GlobalSettings.get_singleton_instance().downtime_enabled:
+        # if downtime is enabled, return a 503. (The cached lookup only hits the database every few
+        # seconds, this runs on every request.)
+        if GlobalSettings.get_cached_singleton_instance().downtime_enabled:
             return HttpResponse(
                 content="This server is currently undergoing maintenance, please try again later.",
                 status=503
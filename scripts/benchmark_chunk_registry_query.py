@@ -0,0 +1,145 @@
+# add the root of the project into the path to allow cd-ing into this folder and running the script.
+from os.path import abspath
+from sys import argv, path
+
+path.insert(0, abspath(__file__).rsplit('/', 2)[0])
+
+import random
+from datetime import timedelta
+from time import perf_counter
+from typing import List, Tuple
+
+from django.db import connection
+from django.utils import timezone
+
+from constants.raw_data_constants import CHUNK_FIELDS
+from database.common_models import generate_objectid_string
+from database.data_access_models import ChunkRegistry
+from database.study_models import DeviceSettings, Study
+from database.user_models_participant import Participant
+
+
+print("""
+This script benchmarks the Data Access API's ChunkRegistry query against a synthetic table. It
+creates a study with many participants and ChunkRegistry rows, times the download query with and
+without the chunk_registry_download_idx index, and with and without resolving patient ids first.
+The synthetic study and its data are deleted at the end.
+
+DO NOT RUN THIS ON A PRODUCTION SERVER, it drops and recreates an index on the ChunkRegistry table.
+
+Usage: python scripts/benchmark_chunk_registry_query.py [number of rows, default 2,000,000]
+""")
+
+NUMBER_OF_ROWS = int(argv[1]) if len(argv) > 1 else 2_000_000
+NUMBER_OF_PARTICIPANTS = 200
+DATA_TYPES = ["accelerometer", "gps", "gyro", "power_state", "wifi", "bluetooth", "identifiers"]
+BATCH_SIZE = 10_000
+REPETITIONS = 5
+
+INDEX = [
+    index for index in ChunkRegistry._meta.indexes if index.name == "chunk_registry_download_idx"
+][0]
+
+
+def create_synthetic_data() -> Tuple[Study, List[str]]:
+    study = Study(
+        name="chunk registry benchmark " + generate_objectid_string(),
+        encryption_key="thequickbrownfoxjumpsoverthelazy",
+        object_id=generate_objectid_string(),
+        timezone_name="UTC",
+    )
+    study.save()
+    participants = Participant.objects.bulk_create(
+        Participant(
+            patient_id=f"bench{i:04}", study=study, os_type="ANDROID", device_id="", password="x"
+        )
+        for i in range(NUMBER_OF_PARTICIPANTS)
+    )
+    participant_ids = [participant.pk for participant in Participant.objects.filter(study=study)]
+
+    start = timezone.now() - timedelta(hours=NUMBER_OF_ROWS)
+    batch = []
+    for i in range(NUMBER_OF_ROWS):
+        batch.append(ChunkRegistry(
+            study=study,
+            participant_id=random.choice(participant_ids),
+            data_type=random.choice(DATA_TYPES),
+            time_bin=start + timedelta(hours=i),
+            chunk_path=f"CHUNKED_DATA/{study.object_id}/{i}.csv",
+            chunk_hash="benchmark",
+            file_size=random.randint(100, 1_000_000),
+            is_chunkable=True,
+        ))
+        if len(batch) == BATCH_SIZE:
+            ChunkRegistry.objects.bulk_create(batch)
+            batch = []
+            print(f"created {i + 1} rows")
+    ChunkRegistry.objects.bulk_create(batch)
+    return study, [participant.patient_id for participant in participants]
+
+
+def old_query(study: Study, patient_ids, data_types, start, end):
+    return ChunkRegistry.objects.filter(
+        study_id=study.pk, participant__patient_id__in=patient_ids, data_type__in=data_types,
+        time_bin__gte=start, time_bin__lte=end,
+    )
+
+
+def new_query(study: Study, patient_ids, data_types, start, end):
+    return ChunkRegistry.get_chunks_time_range(study.pk, patient_ids, data_types, start, end)
+
+
+def time_query(name: str, query_function, *args):
+    timings, row_count = [], 0
+    for _ in range(REPETITIONS):
+        t_start = perf_counter()
+        row_count = sum(1 for _ in query_function(*args).values(*CHUNK_FIELDS).iterator())
+        timings.append(perf_counter() - t_start)
+    print(f"{name}: {row_count} rows, best of {REPETITIONS}: {min(timings) * 1000:.1f}ms")
+    print(query_function(*args).values(*CHUNK_FIELDS).explain())
+    print()
+
+
+def run_benchmarks(study: Study, patient_ids):
+    times = ChunkRegistry.objects.filter(study=study).order_by("time_bin") \
+        .values_list("time_bin", flat=True)
+    start, end = times.first(), times.last()
+    middle = start + (end - start) / 2
+    query_args = [
+        (
+            "one participant, one data type, a month",
+            patient_ids[:1], DATA_TYPES[:1], middle, middle + timedelta(days=30),
+        ),
+        (
+            "ten participants, two data types, all time",
+            patient_ids[:10], DATA_TYPES[:2], start, end,
+        ),
+    ]
+    for description, *args in query_args:
+        print("=" * 80)
+        print(description)
+        print("=" * 80)
+        time_query("join, with index", old_query, study, *args)
+        time_query("resolved pks, with index", new_query, study, *args)
+        with connection.schema_editor() as schema_editor:
+            schema_editor.remove_index(ChunkRegistry, INDEX)
+        try:
+            time_query("join, without index", old_query, study, *args)
+            time_query("resolved pks, without index", new_query, study, *args)
+        finally:
+            with connection.schema_editor() as schema_editor:
+                schema_editor.add_index(ChunkRegistry, INDEX)
+
+
+study, patient_ids = create_synthetic_data()
+try:
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute("ANALYZE database_chunkregistry")
+    run_benchmarks(study, patient_ids)
+finally:
+    print("deleting synthetic data...")
+    ChunkRegistry.objects.filter(study=study).delete()
+    Participant.objects.filter(study=study).delete()
+    DeviceSettings.objects.filter(study=study).delete()
+    study.delete()
@@ -0,0 +1,251 @@
+# add the root of the project into the path to allow cd-ing into this folder and running the script.
+from os.path import abspath
+from sys import argv, path
+
+path.insert(0, abspath(__file__).rsplit('/', 2)[0])
+
+import logging
+from datetime import timedelta
+from time import perf_counter
+from types import SimpleNamespace
+from typing import List
+from unittest.mock import patch
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from firebase_admin.messaging import Message, UnregisteredError
+
+from constants.user_constants import ANDROID_API, IOS_API
+from database.common_models import generate_objectid_string
+from database.schedule_models import AbsoluteSchedule, ArchivedEvent, ScheduledEvent, WeeklySchedule
+from database.study_models import DeviceSettings, Study
+from database.survey_models import Survey, SurveyArchive
+from database.user_models_participant import (Participant, ParticipantActionLog,
+    ParticipantFCMHistory)
+from libs.celery_control import FalseCeleryApp
+from services import celery_push_notifications
+from services.celery_push_notifications import (create_heartbeat_tasks,
+    create_survey_push_notification_tasks, get_surveys_and_schedules, heartbeat_query)
+
+
+print("""
+This script benchmarks the survey and heartbeat push notification pipeline against a synthetic
+study, without Firebase. It creates a study with many participants, FCM tokens, surveys and
+ScheduledEvents (one due event per participant per survey, plus some future events), replaces the
+Firebase send functions with a local fake, and runs celery tasks inline. For both the one-by-one and
+the batch send modes (see PUSH_NOTIFICATION_BATCH_SEND) it reports the wall time and query count of
+get_surveys_and_schedules, heartbeat_query, and the complete survey and heartbeat ticks (queries,
+task dispatch, sending, success and failure handlers), followed by a tick where nothing is due.
+The synthetic study and its data are deleted at the end.
+
+DO NOT RUN THIS ON A PRODUCTION SERVER, it creates (and deletes) a very large number of rows.
+
+Usage: python scripts/benchmark_push_notifications.py [participants, default 10,000] [surveys, default 20]
+""")
+
+NUMBER_OF_PARTICIPANTS = int(argv[1]) if len(argv) > 1 else 10_000
+NUMBER_OF_SURVEYS = int(argv[2]) if len(argv) > 2 else 20
+FUTURE_EVENTS_PER_SURVEY = 3
+UNREGISTERED_TOKEN_EVERY = 100  # 1 in this many participants has a token that Firebase rejects.
+PARTICIPANT_TIMEZONES = ["America/New_York", "America/Los_Angeles", "Europe/London", "Asia/Tokyo"]
+BATCH_SIZE = 10_000
+
+
+class FakeFirebase:
+    """ A local stand-in for firebase_admin.messaging.send and send_each, counts calls and
+    messages, and rejects the tokens of "unregistered" participants. """
+    
+    def __init__(self):
+        self.calls = 0
+        self.messages = 0
+    
+    def get_error(self, message: Message):
+        if message.token.startswith("unregistered"):
+            return UnregisteredError("benchmark unregistered token")
+        return None
+    
+    def send(self, message: Message):
+        self.calls += 1
+        self.messages += 1
+        error = self.get_error(message)
+        if error:
+            raise error
+    
+    def send_each(self, messages: List[Message]):
+        # mimics the firebase BatchResponse, responses are in the order of the messages.
+        self.calls += 1
+        self.messages += len(messages)
+        return SimpleNamespace(responses=[
+            SimpleNamespace(success=error is None, exception=error)
+            for error in map(self.get_error, messages)
+        ])
+
+
+def run_task_inline(a_task_for_a_celery_queue, *args, **kwargs):
+    """ Replaces safe_apply_async, runs the celery task in this process immediately. """
+    if isinstance(a_task_for_a_celery_queue, FalseCeleryApp):
+        function = a_task_for_a_celery_queue.an_function
+    else:
+        function = a_task_for_a_celery_queue.run
+    return function(*kwargs.get("args", []))
+
+
+def create_synthetic_study() -> Study:
+    study = Study(
+        name="push notification benchmark " + generate_objectid_string(),
+        encryption_key="thequickbrownfoxjumpsoverthelazy",
+        object_id=generate_objectid_string(),
+        timezone_name="America/New_York",
+    )
+    study.save()
+    
+    Participant.objects.bulk_create(
+        [
+            Participant(
+                patient_id=f"pushbench{i:05}",
+                study=study,
+                os_type=IOS_API if i % 2 else ANDROID_API,
+                device_id="",
+                password="x",
+                timezone_name=PARTICIPANT_TIMEZONES[i % len(PARTICIPANT_TIMEZONES)],
+                unknown_timezone=False,
+            ) for i in range(NUMBER_OF_PARTICIPANTS)
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    ParticipantFCMHistory.objects.bulk_create(
+        [
+            ParticipantFCMHistory(
+                participant_id=participant_id,
+                token=("unregistered" if i % UNREGISTERED_TOKEN_EVERY == 0 else "token")
+                    + f"-{study.object_id}-{i}",
+            ) for i, participant_id in enumerate(participant_ids(study))
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    
+    for i in range(NUMBER_OF_SURVEYS):
+        survey = Survey(
+            study=study, survey_type=Survey.TRACKING_SURVEY, object_id=generate_objectid_string()
+        )
+        survey.save()
+        WeeklySchedule.objects.create(survey=survey, day_of_week=i % 7, hour=9, minute=0)
+        AbsoluteSchedule.objects.create(
+            survey=survey, date=timezone.now().date() + timedelta(days=1), hour=9, minute=0
+        )
+    return study
+
+
+def participant_ids(study: Study) -> List[int]:
+    return list(study.participants.order_by("pk").values_list("pk", flat=True))
+
+
+def reset_synthetic_study(study: Study):
+    """ Deletes the events, logs and send history of the last run, recreates the ScheduledEvents and
+    makes every participant due for a heartbeat. """
+    ScheduledEvent.objects.filter(survey__study=study).delete()
+    ArchivedEvent.objects.filter(participant__study=study).delete()
+    ParticipantActionLog.objects.filter(participant__study=study).delete()
+    ParticipantFCMHistory.objects.filter(participant__study=study).update(unregistered=None)
+    an_hour_ago = timezone.now() - timedelta(hours=1)
+    study.participants.update(
+        last_upload=an_hour_ago,
+        heartbeat_reference_time=an_hour_ago,
+        last_heartbeat_notification=None,
+        push_notification_unreachable_count=0,
+    )
+    
+    # each survey alternates between a due weekly event (which gets requeued when sent) and a due
+    # absolute event, and has some absolute events in the future that should never be read.
+    now = timezone.now()
+    events = []
+    pks = participant_ids(study)
+    for i, survey in enumerate(study.surveys.all()):
+        weekly_schedule = survey.weekly_schedules.get()
+        absolute_schedule = survey.absolute_schedules.get()
+        for participant_id in pks:
+            events.append(ScheduledEvent(
+                survey=survey,
+                participant_id=participant_id,
+                weekly_schedule=weekly_schedule if i % 2 == 0 else None,
+                absolute_schedule=None if i % 2 == 0 else absolute_schedule,
+                # a day ago is in the past in every participant timezone.
+                scheduled_time=now - timedelta(days=1),
+            ))
+            for day in range(1, FUTURE_EVENTS_PER_SURVEY + 1):
+                events.append(ScheduledEvent(
+                    survey=survey,
+                    participant_id=participant_id,
+                    absolute_schedule=absolute_schedule,
+                    scheduled_time=now + timedelta(days=day),
+                ))
+            if len(events) >= BATCH_SIZE:
+                ScheduledEvent.populate_fire_times(events)
+                ScheduledEvent.objects.bulk_create(events)
+                events = []
+    ScheduledEvent.populate_fire_times(events)
+    ScheduledEvent.objects.bulk_create(events)
+
+
+def measure(name: str, function, *args):
+    with CaptureQueriesContext(connection) as queries:
+        t_start = perf_counter()
+        result = function(*args)
+        elapsed = perf_counter() - t_start
+    print(f"    {name}: {elapsed * 1000:.1f}ms, {len(queries.captured_queries)} queries")
+    return result
+
+
+def run_tick(fake_firebase: FakeFirebase):
+    surveys, _, _ = measure("get_surveys_and_schedules", get_surveys_and_schedules, timezone.now())
+    heartbeats = measure("heartbeat_query", heartbeat_query)
+    print(f"    ({len(surveys)} survey notifications and {len(heartbeats)} heartbeats due)")
+    
+    calls, messages = fake_firebase.calls, fake_firebase.messages
+    measure("survey push notification tick", create_survey_push_notification_tasks)
+    measure("heartbeat tick", create_heartbeat_tasks)
+    print(
+        f"    ({fake_firebase.calls - calls} Firebase calls, "
+        f"{fake_firebase.messages - messages} messages)"
+    )
+
+
+def run_benchmarks(study: Study):
+    fake_firebase = FakeFirebase()
+    with patch.object(celery_push_notifications, "send_notification", fake_firebase.send), \
+            patch.object(celery_push_notifications, "send_notification_batch", fake_firebase.send_each), \
+            patch.object(celery_push_notifications, "check_firebase_instance", lambda: True), \
+            patch.object(celery_push_notifications, "safe_apply_async", run_task_inline):
+        for batch_send in (False, True):
+            print("=" * 80)
+            print(f"PUSH_NOTIFICATION_BATCH_SEND = {batch_send}")
+            print("=" * 80)
+            print("resetting synthetic data...")
+            reset_synthetic_study(study)
+            with patch.object(celery_push_notifications, "PUSH_NOTIFICATION_BATCH_SEND", batch_send):
+                print("  first tick, everything is due:")
+                run_tick(fake_firebase)
+                print("  second tick, nothing is due:")
+                run_tick(fake_firebase)
+            print()
+
+
+# the push notification code logs every due notification.
+logging.getLogger("push_notifications").setLevel(logging.WARNING)
+
+print(f"creating {NUMBER_OF_PARTICIPANTS} participants and {NUMBER_OF_SURVEYS} surveys...")
+study = create_synthetic_study()
+try:
+    run_benchmarks(study)
+finally:
+    print("deleting synthetic data...")
+    ScheduledEvent.objects.filter(survey__study=study).delete()
+    ArchivedEvent.objects.filter(participant__study=study).delete()
+    ParticipantActionLog.objects.filter(participant__study=study).delete()
+    ParticipantFCMHistory.objects.filter(participant__study=study).delete()
+    Participant.objects.filter(study=study).delete()
+    SurveyArchive.objects.filter(survey__study=study).delete()
+    Survey.objects.filter(study=study).delete()
+    DeviceSettings.objects.filter(study=study).delete()
+    study.delete()
@@ -0,0 +1,6 @@
+from libs.chunk_registry_partitions import create_future_partitions
+
+
+# this script runs daily, it does nothing unless the ChunkRegistry table has been partitioned.
+for partition in create_future_partitions():
+    print(f"created ChunkRegistry partition {partition}")
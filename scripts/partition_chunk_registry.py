@@ -0,0 +1,32 @@
+# add the root of the project into the path to allow cd-ing into this folder and running the script.
+from os.path import abspath
+from sys import path
+
+path.insert(0, abspath(__file__).rsplit('/', 2)[0])
+
+from libs.chunk_registry_partitions import (chunk_registry_is_partitioned, get_partition_bounds,
+    partition_chunk_registry)
+
+
+print("""
+This script converts the ChunkRegistry table into a table partitioned by month of time_bin (postgres
+only), see libs/chunk_registry_partitions.py for details. It is safe to run on a live server: the
+index builds and constraint validation do not block reads or writes, and the table swap at the end
+holds a lock for a few seconds. While the constraint is validated, data with time_bins after the end
+of this month (broken device clocks) cannot be inserted, those uploads will be processed on a later
+run. If the conversion fails or is interrupted, run this script again to resume it.
+
+This can take hours on a large server. Run it inside screen or tmux.
+""")
+
+if chunk_registry_is_partitioned():
+    print("The ChunkRegistry table is already partitioned.")
+    partition_chunk_registry()  # finishes a conversion that was interrupted after the swap
+elif input("Convert the ChunkRegistry table to a partitioned table? y/n ") == "y":
+    partition_chunk_registry()
+    print("Done.")
+
+if chunk_registry_is_partitioned():
+    print("\nPartitions:")
+    for name, bounds in get_partition_bounds():
+        print(f"\t{name}: {bounds}")
@@ -0,0 +1,6 @@
+from libs.participant_purge import sweep_purged_cached_chunks
+
+
+# this script runs hourly on every server with a chunk cache (CHUNK_CACHE_FOLDER), it removes the
+# cached data of purged participants. It does nothing when the cache is disabled.
+sweep_purged_cached_chunks()
@@ -5,18 +5,21 @@ import os
 import shutil
 import traceback
 from datetime import date, datetime, timedelta
+from itertools import repeat, zip_longest
 from multiprocessing.pool import ThreadPool
 from os import makedirs
 from os.path import dirname, exists as file_exists, join as path_join
-from time import sleep
-from typing import Dict, Tuple
+from time import perf_counter, sleep
+from typing import Dict, List, Optional, Tuple
 
 from dateutil.tz import UTC
 from django.db import transaction
-from django.db.models import Sum
+from django.db.models import Count, Q, Sum
 from django.utils import timezone
 from pkg_resources import DistributionNotFound, get_distribution
 
+from config.settings import (FOREST_DOWNLOAD_THREADS, FOREST_MAX_CONCURRENT_TASKS,
+    FOREST_NODE_MAX_LOAD, FOREST_NODE_MIN_FREE_DISK_MB)
 from constants.celery_constants import FOREST_QUEUE, ForestTaskStatus
 from constants.common_constants import API_TIME_FORMAT, BEIWE_PROJECT_ROOT, RUNNING_TESTS
 from constants.forest_constants import (CLEANUP_ERROR as CLN_ERR, FOREST_TREE_REQUIRED_DATA_STREAMS,
@@ -28,10 +31,12 @@ from database.forest_models import ForestTask, SummaryStatisticDaily
 from database.system_models import ForestVersion
 from database.user_models_participant import Participant
 from libs.celery_control import forest_celery_app, safe_apply_async
+from libs.chunk_cache import cache_chunk_file, copy_cached_chunk
 from libs.endpoint_helpers.copy_study_helpers import format_study
 from libs.internal_types import ChunkRegistryQuerySet
 from libs.intervention_utils import intervention_survey_data
-from libs.s3 import s3_retrieve
+from libs.participant_purge import sweep_purged_cached_chunks_if_due
+from libs.s3 import s3_retrieve_to_file
 from libs.sentry import make_error_sentry, SentryTypes
 from libs.streaming_zip import determine_file_name
 from libs.utils.date_utils import get_timezone_shortcode, legible_time
@@ -54,6 +59,9 @@ database model. File paths, constants, simple lookups, parameters should go on t
 MIN_TIME = datetime.min.time()
 MAX_TIME = datetime.max.time()
 
+# seconds between updates of the download progress fields on a running ForestTask
+DOWNLOAD_PROGRESS_INTERVAL = 5
+
 logger = logging.getLogger("forest_runner")
 logger.setLevel(logging.ERROR) if RUNNING_TESTS else logger.setLevel(logging.INFO)
 log = logger.info
@@ -90,10 +98,32 @@ def enqueue_forest_task(**kwargs):
 
 
 def create_forest_celery_tasks():
-    """ Basic entrypoint, does what it says """
-    pending_tasks = ForestTask.objects.filter(status=ForestTaskStatus.queued)
+    """ Basic entrypoint, dispatches the queued tasks that can run right now: at most one task per
+    participant and tree (they would block each other), never for a participant and tree with a
+    running task, and at most FOREST_MAX_CONCURRENT_TASKS running and dispatched tasks in total.
+    Tasks that are not dispatched stay queued for the next run. (Celery tasks expire before the next
+    run, so dispatched tasks that no worker picked up are dispatched again.) """
+    running_tasks = ForestTask.objects.filter(status=ForestTaskStatus.running) \
+        .values_list("participant_id", "forest_tree")
+    busy = set(running_tasks)
+    available_slots = FOREST_MAX_CONCURRENT_TASKS - len(running_tasks) \
+        if FOREST_MAX_CONCURRENT_TASKS else None
+    
+    # for each participant and tree the task with the latest data runs first.
+    pending_tasks = ForestTask.objects.filter(status=ForestTaskStatus.queued) \
+        .order_by("-data_date_start", "created_on").select_related("participant__study")
     with make_error_sentry(sentry_type=SentryTypes.data_processing):
         for task in pending_tasks:
+            if available_slots is not None and available_slots <= 0:
+                break
+            if (task.participant_id, task.forest_tree) in busy:
+                continue
+            busy.add((task.participant_id, task.forest_tree))
+            if available_slots is not None:
+                available_slots -= 1
+            
+            # workers use the estimated input size to check that they have enough disk space.
+            task.update_only(total_file_size=estimate_input_size(task))
             # always print
             print(
                 f"Queueing up celery task for {task.participant} on tree {task.forest_tree} "
@@ -102,6 +132,27 @@ def create_forest_celery_tasks():
             enqueue_forest_task(args=[task.id])
 
 
+def estimate_input_size(task: ForestTask) -> Optional[int]:
+    """ The total size of the task's input files (None when there is no data). """
+    return get_task_chunks(task, *get_task_time_range(task)) \
+        .aggregate(Sum('file_size')).get('file_size__sum')
+
+
+def get_node_admission_error(task: ForestTask) -> Optional[str]:
+    """ Whether this server has the CPU and disk budget to run the task now, returns the reason
+    when it does not. """
+    load_per_cpu = os.getloadavg()[0] / (os.cpu_count() or 1)
+    if load_per_cpu > FOREST_NODE_MAX_LOAD:
+        return f"load average per CPU is {load_per_cpu:.2f}"
+    
+    makedirs(ROOT_FOREST_TASK_PATH, exist_ok=True)
+    free_mb = shutil.disk_usage(ROOT_FOREST_TASK_PATH).free / 1024 / 1024
+    required_mb = (task.total_file_size or 0) / 1024 / 1024 + FOREST_NODE_MIN_FREE_DISK_MB
+    if required_mb > free_mb:
+        return f"{free_mb:.0f}MB of free disk space, requires {required_mb:.0f}MB"
+    return None
+
+
 #
 ## The forest task runtime
 #
@@ -118,15 +169,21 @@ def celery_run_forest(forest_task_id):
         tasks = ForestTask.objects.select_for_update() \
                 .filter(participant=participant, forest_tree=task.forest_tree)
         
-        # if any other forest tasks are running, exit.
+        # if any other forest tasks are running, exit. (The dispatcher does not dispatch these, but
+        # a dispatched task can be picked up late.)
         if tasks.filter(status=ForestTaskStatus.running).exists():
             return
         
-        # Get the chronologically earliest task that's queued
-        task: ForestTask = tasks.filter(status=ForestTaskStatus.queued) \
-                .order_by("-data_date_start").first()
+        # The dispatcher picked the task, reload it under the lock, it may have been cancelled.
+        task: ForestTask = tasks.filter(id=forest_task_id, status=ForestTaskStatus.queued).first()
         
-        if task is None:  # Should be unreachable...
+        if task is None:
+            return
+        
+        # if this server is too busy the task stays queued and is dispatched again later.
+        admission_error = get_node_admission_error(task)
+        if admission_error:
+            log(f"not starting task {task.external_id}: {admission_error}")
             return
         
         # We check the distribution (pip) version, with some backups for local development
@@ -139,7 +196,7 @@ def celery_run_forest(forest_task_id):
             status=ForestTaskStatus.running,
             process_start_time=timezone.now(),
             forest_version=version,
-            forest_commit=ForestVersion.get_singleton_instance().git_commit,
+            forest_commit=ForestVersion.get_cached_singleton_instance().git_commit,
         )
     
     # ChunkRegistry "time_bin" hourly chunks are in UTC, with each file containing a discrete hour
@@ -151,8 +208,7 @@ def celery_run_forest(forest_task_id):
     # the hour containing their last fractional offset. Manually entered data streams don't have
     # this issue.)
     # Code: construct two datetimes for the start and end of day in the study's timezone.
-    starttime_midnight = datetime.combine(task.data_date_start, MIN_TIME, task.participant.study.timezone)
-    endtime_11_59pm = datetime.combine(task.data_date_end, MAX_TIME, task.participant.study.timezone)
+    starttime_midnight, endtime_11_59pm = get_task_time_range(task)
     log("starttime_midnight: ", starttime_midnight.isoformat())
     log("endtime_11_59pm: ", endtime_11_59pm.isoformat())
     
@@ -160,15 +216,37 @@ def celery_run_forest(forest_task_id):
     run_forest_task(task, starttime_midnight, endtime_11_59pm)
 
 
+def get_task_time_range(task: ForestTask) -> Tuple[datetime, datetime]:
+    """ Local midnight at the start of the task's data dates to 11:59.59pm at the end. """
+    tz = task.participant.study.timezone
+    return (
+        datetime.combine(task.data_date_start, MIN_TIME, tz),
+        datetime.combine(task.data_date_end, MAX_TIME, tz),
+    )
+
+
 def run_forest_task(task: ForestTask, start: datetime, end: datetime):
     """ Given a time range, downloads all data and executes a tree on that data. """
     ## try-except 1 - the main work block. Download data, run Forest, upload any cache files.
     ## The except block handles reporting errors.
     try:
-        download_data(task, start, end)
-        run_forest(task)
-        upload_cache_files(task)
-        task.update_only(status=ForestTaskStatus.success)
+        dates = get_stale_dates(task, start, end) if task.incremental else None
+        if dates == []:
+            log("incremental task, no new or changed data")
+            task.update_only(
+                stale_date_count=0, stale_date_start=None, stale_date_end=None,
+                status=ForestTaskStatus.success,
+            )
+        else:
+            if dates:
+                # the requested data dates are kept, Forest runs on the range of the stale dates.
+                task.update_only(
+                    stale_date_count=len(dates), stale_date_start=dates[0], stale_date_end=dates[-1]
+                )
+            download_data(task, start, end, dates)
+            run_forest(task, dates)
+            upload_cache_files(task)
+            task.update_only(status=ForestTaskStatus.success)
     except BaseException as e:
         task.update_only(status=ForestTaskStatus.error, stacktrace=traceback.format_exc())
         log("task.stacktrace 1:", task.stacktrace)
@@ -209,7 +287,7 @@ def run_forest_task(task: ForestTask, start: datetime, end: datetime):
     task.update_only(process_end_time=timezone.now())
 
 
-def run_forest(forest_task: ForestTask):
+def run_forest(forest_task: ForestTask, dates: List[date] = None):
     # Run Forest
     params_dict = forest_task.get_params_dict()
     log("params_dict:", params_dict)
@@ -220,20 +298,73 @@ def run_forest(forest_task: ForestTask):
     log("done running:", forest_task.forest_tree)
     
     # Save data
-    forest_task.update_only(forest_output_exists=construct_summary_statistics(forest_task))
+    forest_task.update_only(forest_output_exists=construct_summary_statistics(forest_task, dates))
 
 
-def download_data(forest_task: ForestTask, start: datetime, end: datetime):
-    chunks = ChunkRegistry.objects.filter(
+def get_task_chunks(forest_task: ForestTask, start: datetime, end: datetime) -> ChunkRegistryQuerySet:
+    return ChunkRegistry.objects.filter(
         participant=forest_task.participant,
         time_bin__gte=start,
         time_bin__lte=end,
         data_type__in=FOREST_TREE_REQUIRED_DATA_STREAMS[forest_task.forest_tree]
     )
-    file_size = chunks.aggregate(Sum('file_size')).get('file_size__sum')
+
+
+def get_stale_dates(forest_task: ForestTask, start: datetime, end: datetime) -> List[date]:
+    """ For incremental tasks, the dates in the time range that the tree has to (re)compute: dates
+    with data that no successful task of this tree has computed, or with a ChunkRegistry that was
+    created or updated after the start of the task that last computed them. """
+    tz = forest_task.participant.study.timezone
+    data_last_updated: Dict[date, datetime] = {}
+    chunks = get_task_chunks(forest_task, start, end).values_list("time_bin", "last_updated")
+    for time_bin, last_updated in chunks.iterator():
+        day = time_bin.astimezone(tz).date()
+        if day not in data_last_updated or last_updated > data_last_updated[day]:
+            data_last_updated[day] = last_updated
+    
+    # the task field on SummaryStatisticDaily is the task that last computed the date.
+    computed_at = dict(
+        SummaryStatisticDaily.objects.filter(
+            participant=forest_task.participant,
+            date__gte=forest_task.data_date_start,
+            date__lte=forest_task.data_date_end,
+            **{f"{forest_task.taskname}__status": ForestTaskStatus.success},
+        ).values_list("date", f"{forest_task.taskname}__process_start_time")
+    )
+    return sorted(
+        day for day, last_updated in data_last_updated.items()
+        if computed_at.get(day) is None or last_updated >= computed_at[day]
+    )
+
+
+def dates_to_time_ranges(dates: List[date], tz) -> List[Tuple[datetime, datetime]]:
+    """ Collapses sorted dates into the (start of day, end of day) time ranges of each run of
+    consecutive dates. """
+    ranges = []
+    for day in dates:
+        if ranges and ranges[-1][1] == day - timedelta(days=1):
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return [
+        (datetime.combine(first, MIN_TIME, tz), datetime.combine(last, MAX_TIME, tz))
+        for first, last in ranges
+    ]
+
+
+def download_data(forest_task: ForestTask, start: datetime, end: datetime, dates: List[date] = None):
+    chunks = get_task_chunks(forest_task, start, end)
+    if dates is not None:
+        # incremental tasks only download the dates they compute
+        time_range_filter = Q()
+        for range_start, range_end in dates_to_time_ranges(dates, forest_task.participant.study.timezone):
+            time_range_filter |= Q(time_bin__gte=range_start, time_bin__lte=range_end)
+        chunks = chunks.filter(time_range_filter)
+    totals = chunks.aggregate(Sum('file_size'), Count('id'))
+    file_size = totals['file_size__sum']
     if file_size is None:
         raise NoSentryException(NO_DATA_ERROR)
-    forest_task.update_only(total_file_size=file_size)
+    forest_task.update_only(total_file_size=file_size, download_file_count=totals['id__count'])
     
     # Download data
     download_data_files(forest_task, chunks)
@@ -246,7 +377,7 @@ def download_data(forest_task: ForestTask, start: datetime, end: datetime):
         get_study_config_data(forest_task)
 
 
-def construct_summary_statistics(task: ForestTask):
+def construct_summary_statistics(task: ForestTask, dates: List[date] = None):
     """ Construct summary statistics from forest output, returning whether or not any
         SummaryStatisticDaily has potentially been created or updated. """
     
@@ -259,52 +390,71 @@ def construct_summary_statistics(task: ForestTask):
         log("opened file, parsing...")
         # csv_parse_and_consume returns True if any data was added to the database
         with transaction.atomic():
-            return csv_parse_and_consume(task, csv.DictReader(f))
+            return csv_parse_and_consume(task, csv.DictReader(f), dates)
 
 
-def csv_parse_and_consume(task: ForestTask, csv_reader: csv.DictReader) -> bool:
-    """ Parse a csv file and create/update SummaryStatisticDaily objects.
-        This function can be mocked with a list of dicts for testing. """
+def csv_parse_and_consume(
+    task: ForestTask, csv_reader: csv.DictReader, dates: List[date] = None
+) -> bool:
+    """ Parse a csv file and create/update SummaryStatisticDaily objects. Takes a csv.DictReader,
+        the fieldnames and the underlying csv reader are used directly. When dates are provided
+        (incremental tasks) rows for other dates are ignored, they were computed without their data. """
     blow_up_on_invalid_columns(csv_reader)
-    rows_processed = 0
+    dates = set(dates) if dates is not None else None
     
-    for csv_row in csv_reader:
-        if task.forest_tree == ForestTree.oak:
-            # oak has a different output format, it is a json file.
-            summary_date = date.fromisoformat(csv_row['date'])
-        else:
-            # at the very least jasmine uses this format.
-            summary_date = date(
-                int(float(csv_row['year'])),
-                int(float(csv_row['month'])),
-                int(float(csv_row['day'])),
-            )
-        
+    # Read the file into columns in one pass (transposing the underlying csv.reader's rows), the
+    # column names are looked up once per column instead of once per cell. Like the DictReader,
+    # blank lines are skipped and short rows are padded.
+    column_names = csv_reader.fieldnames
+    rows = filter(None, csv_reader.reader)
+    columns = dict(zip(column_names, zip_longest(*rows, fillvalue="")))
+    if not columns:
+        return False
+    
+    if task.forest_tree == ForestTree.oak:
+        # oak has a different output format, it is a json file.
+        row_dates = list(map(date.fromisoformat, columns['date']))
+    else:
+        # at the very least jasmine uses this format.
+        row_dates = [
+            date(int(float(year)), int(float(month)), int(float(day)))
+            for year, month, day in zip(columns['year'], columns['month'], columns['day'])
+        ]
+    
+    # Extract the desied summary statistics from the csv columns. Most columns in csvs have weird
+    # names, we need to look up what the column name means in TREE_COLUMN_NAMES_TO_SUMMARY_STATISTICS
+    # force Nones on no data fields, not empty strings (db table issue)
+    # we don't need to do any column name checking, that was done in blow_up_on_invalid_columns
+    summary_stat_fields = []
+    summary_stat_columns = []
+    for column_name, column in columns.items():
+        if column_name in TREE_COLUMN_NAMES_TO_SUMMARY_STATISTICS:
+            summary_stat_fields.append(TREE_COLUMN_NAMES_TO_SUMMARY_STATISTICS[column_name])
+            summary_stat_columns.append([value if value != '' else None for value in column])
+    
+    # the timezone abbreviation only depends on the date
+    tz = task.participant.study.timezone
+    timezones = {day: get_timezone_shortcode(day, tz) for day in set(row_dates)}
+    
+    rows_processed = 0
+    values_by_date = {}
+    row_values = zip(*summary_stat_columns) if summary_stat_columns else repeat(())
+    for summary_date, values in zip(row_dates, row_values):
         # if timestamp is outside of desired range, skip (use <=, this is inclusive)
         # (Really the scenario should never occurr where this is false, but we check anyway.)
         if not (task.data_date_start <= summary_date <= task.data_date_end):
             continue
+        if dates is not None and summary_date not in dates:
+            continue
         
-        updates = {
-            task.taskname: task,
-            "timezone": get_timezone_shortcode(summary_date, task.participant.study.timezone),
-        }
-        
-        # Extract the desied summary statistics from the csv row. Most columns in csvs have weird
-        # names, we need to look up what the column name means in TREE_COLUMN_NAMES_TO_SUMMARY_STATISTICS
-        # force Nones on no data fields, not empty strings (db table issue)
-        # we don't need to do any column name checking, that was done in blow_up_on_invalid_columns
-        for column_name, value in csv_row.items():
-            if column_name in TREE_COLUMN_NAMES_TO_SUMMARY_STATISTICS:
-                summary_stat_field = TREE_COLUMN_NAMES_TO_SUMMARY_STATISTICS[column_name]
-                updates[summary_stat_field] = value if value != '' else None
-        
-        # TODO: this is probably slow, can we do a bulk update_or_create?
-        SummaryStatisticDaily.objects.update_or_create(
-            date=summary_date, defaults=updates, participant=task.participant,
-        )
+        updates = dict(zip(summary_stat_fields, values))
+        updates[task.taskname] = task
+        updates["timezone"] = timezones[summary_date]
+        values_by_date[summary_date] = updates
         rows_processed += 1
     
+    # only this tree's columns (and the timezone) are written, in one bulk upsert
+    SummaryStatisticDaily.bulk_upsert(task.participant_id, values_by_date)
     log(f"update {rows_processed} SummaryStatisticDaily rows")
     return rows_processed > 0
 
@@ -337,36 +487,60 @@ def clean_up_files(forest_task: ForestTask):
 
 
 def download_data_files(task: ForestTask, chunks: ChunkRegistryQuerySet) -> None:
-    """ Download only the files needed for the forest task. """
+    """ Download only the files needed for the forest task, FOREST_DOWNLOAD_THREADS at a time.
+    Progress is recorded on the task every DOWNLOAD_PROGRESS_INTERVAL seconds. """
     ensure_folders_exist(task)
+    sweep_purged_cached_chunks_if_due()
+    # every file belongs to the participant's study, look up the encryption key once.
+    encryption_key = task.participant.study.encryption_key.encode()
     # this is an iterable, this is intentional, retain it.
     params = (
-        (task, chunk) for chunk in chunks.values("study__object_id", *CHUNK_FIELDS)
+        (task, encryption_key, chunk) for chunk in chunks.values(*CHUNK_FIELDS)
     )
+    file_count = byte_count = cache_hits = 0
+    last_progress_update = perf_counter()
     # and run!
-    with ThreadPool(4) as pool:
-        for _ in pool.imap_unordered(func=batch_create_file, iterable=params):
-            pass
+    with ThreadPool(FOREST_DOWNLOAD_THREADS) as pool:
+        for file_size, from_cache in pool.imap_unordered(func=batch_create_file, iterable=params):
+            file_count += 1
+            byte_count += file_size
+            cache_hits += from_cache
+            if perf_counter() - last_progress_update > DOWNLOAD_PROGRESS_INTERVAL:
+                task.update_only(
+                    downloaded_file_count=file_count,
+                    downloaded_bytes=byte_count,
+                    download_cache_hits=cache_hits,
+                )
+                last_progress_update = perf_counter()
+    
+    task.update_only(
+        downloaded_file_count=file_count, downloaded_bytes=byte_count, download_cache_hits=cache_hits
+    )
 
 
-def batch_create_file(task_and_chunk_tuple: Tuple[ForestTask, Dict]):
-    """ Wrapper for basic file download operations so that it can be run in a ThreadPool. """
-    # weird unpack of variables, do s3_retrieve.
-    forest_task, chunk = task_and_chunk_tuple
-    contents = s3_retrieve(chunk["chunk_path"], chunk["study__object_id"], raw_path=True)
+def batch_create_file(task_key_and_chunk_tuple: Tuple[ForestTask, bytes, Dict]) -> Tuple[int, bool]:
+    """ Wrapper for basic file download operations so that it can be run in a ThreadPool. Files are
+    decrypted straight to disk, returns the size of the file and whether it came from the cache. """
+    # weird unpack of variables
+    forest_task, encryption_key, chunk = task_key_and_chunk_tuple
     # file ops, sometimes we have to add folder structure (surveys)
     file_name = path_join(forest_task.data_input_path, determine_file_name(chunk))
     makedirs(dirname(file_name), exist_ok=True)
     
     try:
+        if copy_cached_chunk(chunk["chunk_path"], chunk["chunk_hash"], file_name):
+            return os.path.getsize(file_name), True
         with open(file_name, "xb") as f:
-            f.write(contents)
+            file_size = s3_retrieve_to_file(chunk["chunk_path"], encryption_key, f)
+        cache_chunk_file(chunk["chunk_path"], chunk["chunk_hash"], file_name)
+        return file_size, False
     except FileExistsError:
         # While we want information on this exact exception in the specific error is something we
         # can ignore and the running code can continue. (This error occurred in the wild because of
         # an old data bug where b' was present inside the chunk path, underlying cause was in 2019.)
         with make_error_sentry(SentryTypes.data_processing, tags={**forest_task.sentry_tags, "file_name": file_name}):
             raise
+    return 0, False
 
 
 def get_interventions_data(forest_task: ForestTask):
@@ -411,12 +585,23 @@ def generate_report(forest_task: ForestTask):
         # data information
         f.write(f"Data start date: {forest_task.data_date_start}\n")
         f.write(f"Data end date: {forest_task.data_date_end} (inclusive)\n")
+        if forest_task.incremental and forest_task.stale_date_count is not None:
+            f.write(f"Incremental task, dates with new or changed data: {forest_task.stale_date_count}\n")
+        if forest_task.stale_date_start:
+            f.write(f"Computed dates: {forest_task.stale_date_start} to {forest_task.stale_date_end} (inclusive)\n")
         
         ## Everthing after this point is only available if the task was successful.
         # (total_file_size might be available if the task failed)
         if forest_task.total_file_size:
             # file size in megabytes, 2 decimal places
             f.write(f"Total file size: {forest_task.total_file_size / 1024 / 1024:.2f}MB\n")
+        if forest_task.download_file_count:
+            f.write(
+                f"Files downloaded: {forest_task.downloaded_file_count} of "
+                f"{forest_task.download_file_count} ({forest_task.download_cache_hits} from cache)\n"
+            )
+        if forest_task.download_bytes_per_second:
+            f.write(f"Download throughput: {forest_task.download_bytes_per_second / 1024 / 1024:.2f}MB/s\n")
         
         # time information
         p_start = forest_task.process_start_time
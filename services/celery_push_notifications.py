@@ -5,17 +5,18 @@ import random
 from collections import defaultdict
 from datetime import datetime, timedelta
 from functools import reduce
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 from cronutils import null_error_handler
 from cronutils.error_handler import ErrorSentry
-from dateutil.tz import gettz
 from django.db.models import Q
 from django.utils import timezone
 from firebase_admin.messaging import (AndroidConfig, Message, Notification, QuotaExceededError,
-    send as send_notification, SenderIdMismatchError, ThirdPartyAuthError, UnregisteredError)
+    send as send_notification, send_each as send_notification_batch, SenderIdMismatchError,
+    ThirdPartyAuthError, UnregisteredError)
 
-from config.settings import BLOCK_QUOTA_EXCEEDED_ERROR, PUSH_NOTIFICATION_ATTEMPT_COUNT
+from config.settings import (BLOCK_QUOTA_EXCEEDED_ERROR, PUSH_NOTIFICATION_ATTEMPT_COUNT,
+    PUSH_NOTIFICATION_BATCH_SEND)
 from constants import action_log_messages
 from constants.celery_constants import PUSH_NOTIFICATION_SEND_QUEUE
 from constants.common_constants import API_TIME_FORMAT, RUNNING_TESTS
@@ -24,14 +25,14 @@ from constants.schedule_constants import ScheduleTypes
 from constants.security_constants import OBJECT_ID_ALLOWED_CHARS
 from constants.user_constants import ACTIVE_PARTICIPANT_FIELDS, ANDROID_API, IOS_API
 from database.schedule_models import ArchivedEvent, ScheduledEvent
-from database.study_models import Study
+from database.study_models import DeviceSettings, Study
 from database.survey_models import Survey
 from database.user_models_participant import (Participant, ParticipantActionLog,
     ParticipantFCMHistory, PushNotificationDisabledEvent)
 from libs.celery_control import push_send_celery_app, safe_apply_async
 from libs.firebase_config import check_firebase_instance
 from libs.internal_types import DictOfStrStr, DictOfStrToListOfStr
-from libs.schedules import set_next_weekly
+from libs.schedules import bulk_set_next_weekly
 from libs.sentry import make_error_sentry, SentryTypes
 from libs.utils.date_utils import date_is_in_the_past
 
@@ -47,7 +48,13 @@ logw = logger.warning
 loge = logger.error
 logd = logger.debug
 
-UTC = gettz("UTC")
+# The maximum number of messages in a single Firebase send_each call.
+FCM_BATCH_SIZE = 500
+
+
+class BatchRequestFailed(Exception):
+    """ The error of each message of a Firebase batch that failed as a whole, args[0] is the original
+    error. These messages were never sent, they say nothing about the participant. """
 
 #
 ## Somewhat common code (regular survey notifications have extra logic)
@@ -60,36 +67,65 @@ def send_notification_safely(fcm_token:str, os_type: str, logging_tag: str, mess
     modified from the Survey Push Notifcation logic, which has special cases because those
     notifications recur on known schedules, this function is more for one-off type of notifications.
     (Though we do log the events outside of the scopes of this function.) """
-    # for full documentation of these errors see celery_send_survey_push_notification.
     try:
         _send_notification(fcm_token, os_type, message)
         return True
-    except UnregisteredError:
+    except Exception as e:
+        handle_notification_send_error(fcm_token, logging_tag, e)
+        return False
+
+
+def handle_notification_send_error(fcm_token: str, logging_tag: str, error: Exception):
+    """ Handles an error from sending a one-off notification, raises the error if it is not one of
+    the failure modes we have seen over time. """
+    # for full documentation of these errors see handle_survey_send_error.
+    if isinstance(error, UnregisteredError):
         # this is the only "real" error we handle here because we may as well update the fcm
         # token as invalid as soon as we know.
         log(f"\n{logging_tag} - UnregisteredError\n")
         ParticipantFCMHistory.objects.filter(token=fcm_token).update(unregistered=timezone.now())
         # DON'T raise the error, this is normal behavior.
-        return False
     
-    except ThirdPartyAuthError as e:
+    elif isinstance(error, ThirdPartyAuthError):
         logw(f"\n{logging_tag} - ThirdPartyAuthError\n")
-        if str(e) != "Auth error from APNS or Web Push Service":
-            raise
-        return False
+        if str(error) != "Auth error from APNS or Web Push Service":
+            raise error
     
-    except ValueError as e:
+    elif isinstance(error, ValueError):
         logw(f"\n{logging_tag} - ValueError\n")
-        if "The default Firebase app does not exist" not in str(e):
-            raise
-        return False
+        if "The default Firebase app does not exist" not in str(error):
+            raise error
     
-    except (SenderIdMismatchError, QuotaExceededError):
-        return False
+    elif not isinstance(error, (SenderIdMismatchError, QuotaExceededError)):
+        raise error
+
+
+def send_notifications_batch(messages: List[Message]) -> List[Optional[Exception]]:
+    """ Sends the messages in batches of up to FCM_BATCH_SIZE messages, returns the error for each
+    message, or None if it was sent. An error for a whole batch (e.g. the default Firebase app does
+    not exist, or the server credentials are rejected) becomes a BatchRequestFailed for every
+    message in that batch, callers must not count those against the participants. """
+    errors = []
+    for i in range(0, len(messages), FCM_BATCH_SIZE):
+        batch = messages[i:i + FCM_BATCH_SIZE]
+        try:
+            batch_response = send_notification_batch(batch)
+        except Exception as e:
+            errors.extend([BatchRequestFailed(e)] * len(batch))
+            continue
+        errors.extend(
+            None if response.success else response.exception
+            for response in batch_response.responses
+        )
+    return errors
 
 
 def _send_notification(fcm_token: str, os_type: str, message: str):
     """ our wrapper around the firebase send_notification function. Raises errors. """
+    send_notification(_build_notification_message(fcm_token, os_type, message))
+
+
+def _build_notification_message(fcm_token: str, os_type: str, message: str) -> Message:
     # we need a nonce because duplicate notifications won't be delivered.
     data_kwargs = {
         # trunk-ignore(bandit/B311)
@@ -104,7 +140,7 @@ def _send_notification(fcm_token: str, os_type: str, message: str):
         message = Message(
             data=data_kwargs, token=fcm_token, notification=Notification(title="Beiwe", body=message)
         )
-    send_notification(message)
+    return message
 
 
 def get_stopped_study_ids() -> List[int]:
@@ -229,6 +265,25 @@ def heartbeat_query() -> List[Tuple[int, str, str, str]]:
     # (operator.or_ is the same as |, it is the bitwise or operator) (reduce just applies it)
     any_activity_field_gt_one_week_ago = reduce(operator.or_, activity_qs)
     
+    # Each participant's heartbeat_reference_time is the most recent of their activity fields and
+    # last_heartbeat_notification, a heartbeat is due heartbeat_timer_minutes after it. Timers are
+    # per-study so we group studies by timer, each group is a range on the indexed field. We offset
+    # by one minute due to periodicity of the task, this should fix off-by-six-minutes bugs.
+    study_ids_by_timer = defaultdict(list)
+    query = DeviceSettings.objects.exclude(study_id__in=get_stopped_study_ids()) \
+        .values_list("study_id", "heartbeat_timer_minutes")
+    for study_id, heartbeat_minutes in query:
+        study_ids_by_timer[heartbeat_minutes].append(study_id)
+    if not study_ids_by_timer:
+        return []
+    
+    heartbeat_is_due = reduce(operator.or_, [
+        Q(
+            participant__study_id__in=study_ids,
+            participant__heartbeat_reference_time__lt=now - timedelta(minutes=heartbeat_minutes - 1),
+        ) for heartbeat_minutes, study_ids in study_ids_by_timer.items()
+    ])
+    
     # Get fcm tokens and participant pk for all participants, filter for only participants with
     # ACTIVE_PARTICIPANT_FIELDS that were updated in the last week, exclude deleted and
     # permanently_retired participants, exclude partipcants that do not have heartbeat enabled,
@@ -238,67 +293,27 @@ def heartbeat_query() -> List[Tuple[int, str, str, str]]:
     # require a race condition in the endpoint where fcm tokens are set, and ... its just a push
     # notification.
     query = ParticipantFCMHistory.objects.filter(
+            heartbeat_is_due,
             any_activity_field_gt_one_week_ago,
+            # any recent activity field implies a recent reference time, this bounds the range scan.
+            participant__heartbeat_reference_time__gte=one_week_ago,
             
             participant__deleted=False,                # no deleted participants
             participant__permanently_retired=False,    # should be rendundant with deleted.
             unregistered=None,                         # this is fcm-speak for non-retired fcm token
             participant__os_type__in=[ANDROID_API, IOS_API],  # participants need to _have an OS_.
-        ).exclude(
-            participant__study_id__in=get_stopped_study_ids()  # no stopped studies
         ).values_list(
             "participant_id",
             "token",
             "participant__os_type",
             "participant__study__device_settings__heartbeat_message",
-            "participant__study__device_settings__heartbeat_timer_minutes",
-            # only send one notification per participant per heartbeat period.
-            "participant__last_heartbeat_notification",
-            # These are the ACTIVE_PARTICIPANT_FIELDS in query form
-            'participant__last_upload',
-            'participant__last_get_latest_surveys',
-            'participant__last_set_password',
-            'participant__last_set_fcm_token',
-            'participant__last_get_latest_device_settings',
-            'participant__last_register_user',
-            "participant__last_heartbeat_checkin",
         )\
         .order_by("?")  # cover for some slowness by at least not making it predictable... (dumb)
-        # .exclude(participant__id__in=participant_ids_with_recent_heartbeats)
     
     # We used to use the AppHeartbeats table inside a clever query, but when we added customizeable
-    # per-study heartbeat timers that query became too complex. Now we filter out participants that
-    # have ACTIVE_PARTICIPANT_FIELDS that are too recent manually in python. All of the information
-    # is contained within a single query, which is much more performant than running extra queries
-    # in the push notification celery task. This performance should be adequate up to thousands of
-    # participants taking seconds, not minutes.
-    
-    # check if the time to send the next notification has passed, if so, add to the return list.
-    # t1 - t8 are all of the fields we check for activity by getting the most recent one.
-    ret = []
-    for participant_id, token, os_type, message, heartbeat_minutes, t1, t2, t3, t4, t5, t6, t7, t8 in query:
-        # need to filter out Nones
-        most_recent_time_field = max(t for t in (t1, t2, t3, t4, t5, t6, t7, t8) if t)
-        
-        # We offset by one minute due to periodicity of the task, this should fix off-by-six-minutes bugs.
-        point_at_which_to_send_next_notification = \
-            most_recent_time_field + timedelta(minutes=heartbeat_minutes - 1)
-        # debugging code
-        # log("heartbeat_minutes:", heartbeat_minutes)
-        # log("last_heartbeat_notification:", t1)
-        # log("last_upload:", t2)
-        # log("last_get_latest_surveys:", t3)
-        # log("last_set_password:", t4)
-        # log("last_set_fcm_token:", t5)
-        # log("last_get_latest_device_settings:", t6)
-        # log("last_register_user:", t7)
-        # log("last_heartbeat_checkin:", t8)
-        # log("most_recent_time_field:", most_recent_time_field)
-        # log("point_at_which_to_send_next_notification:", point_at_which_to_send_next_notification)
-        if now > point_at_which_to_send_next_notification:
-            ret.append((participant_id, token, os_type, message))
-    
-    return ret
+    # per-study heartbeat timers that query became too complex, and then we filtered every active
+    # participant in python. Now the database only returns participants that are due.
+    return list(query)
 
 
 def create_heartbeat_tasks():
@@ -315,8 +330,21 @@ def create_heartbeat_tasks():
     log(f"Sending heartbeats to {len(push_notification_data)} "
         "participants considered active in the past week.")
     
+    if PUSH_NOTIFICATION_BATCH_SEND:
+        for i in range(0, len(push_notification_data), FCM_BATCH_SIZE):
+            safe_apply_async(
+                celery_heartbeat_send_push_notification_batch,
+                args=[push_notification_data[i:i + FCM_BATCH_SIZE]],
+                max_retries=0,
+                expires=expiry,
+                task_track_started=True,
+                task_publish_retry=False,
+                retry=False,
+            )
+        return
+    
     # dispatch the push notifications celery tasks
-    for participant_id, fcm_token, os_type, message in heartbeat_query():
+    for participant_id, fcm_token, os_type, message in push_notification_data:
         safe_apply_async(
             celery_heartbeat_send_push_notification,
             args=[participant_id, fcm_token, os_type, message],
@@ -339,7 +367,9 @@ def celery_heartbeat_send_push_notification(participant_id: int, fcm_token: str,
         
         if send_notification_safely(fcm_token, os_type, "Heartbeat", message):
             # update the last heartbeat time using minimal database operations, create log entry.
-            Participant.objects.filter(pk=participant_id).update(last_heartbeat_notification=now)
+            Participant.objects.filter(pk=participant_id).update(
+                last_heartbeat_notification=now, heartbeat_reference_time=now
+            )
             ParticipantActionLog.objects.create(
                 participant_id=participant_id,
                 action=action_log_messages.HEARTBEAT_PUSH_NOTIFICATION_SENT,
@@ -347,6 +377,50 @@ def celery_heartbeat_send_push_notification(participant_id: int, fcm_token: str,
             )
 
 
+@push_send_celery_app.task(queue=PUSH_NOTIFICATION_SEND_QUEUE)
+def celery_heartbeat_send_push_notification_batch(heartbeats: List[Tuple[int, str, str, str]]):
+    """ The batch-send version of celery_heartbeat_send_push_notification, takes a list of
+    (participant id, fcm token, os type, message). """
+    with make_error_sentry(sentry_type=SentryTypes.data_processing):
+        now = timezone.now()
+        if not check_firebase_instance():
+            loge("Heartbeat - Firebase credentials are not configured.")
+            return
+        
+        errors = send_notifications_batch([
+            _build_notification_message(fcm_token, os_type, message)
+            for _, fcm_token, os_type, message in heartbeats
+        ])
+        
+        # errors are handled per-token, the first unknown error is raised after the rest of the
+        # batch has been handled. Participants in a failed batch get their heartbeat next time.
+        sent_participant_ids = []
+        unknown_error = None
+        for (participant_id, fcm_token, _, _), error in zip(heartbeats, errors):
+            if error is None:
+                sent_participant_ids.append(participant_id)
+                continue
+            if isinstance(error, BatchRequestFailed):
+                unknown_error = unknown_error or error.args[0]
+                continue
+            try:
+                handle_notification_send_error(fcm_token, "Heartbeat", error)
+            except Exception as e:
+                unknown_error = unknown_error or e
+        
+        Participant.objects.filter(pk__in=sent_participant_ids) \
+            .update(last_heartbeat_notification=now, heartbeat_reference_time=now)
+        ParticipantActionLog.objects.bulk_create(
+            ParticipantActionLog(
+                participant_id=participant_id,
+                action=action_log_messages.HEARTBEAT_PUSH_NOTIFICATION_SENT,
+                timestamp=now,
+            ) for participant_id in sent_participant_ids
+        )
+        if unknown_error:
+            raise unknown_error
+
+
 ####################################################################################################
 ################################### SURVEY PUSH NOTIFICATIONS ######################################
 ####################################################################################################
@@ -358,15 +432,13 @@ def get_surveys_and_schedules(now: datetime, **filter_kwargs) -> Tuple[DictOfStr
     a mapping of fcm tokens to patient ids """
     log(f"\nChecking for scheduled events that are in the past (before {now})")
     
-    # we need to find all possible events and convert them on a per-participant-timezone basis.
-    # The largest timezone offset is +14?, but we will do one whole day and manually filter.
-    tomorrow = now + timedelta(days=1)
-    
-    # get: schedule time is in the past for participants that have fcm tokens.
+    # fire_time is the scheduled time already shifted into the participant's timezone, so this only
+    # reads the (indexed) undeleted events that are due, future events are never touched.
+    # get: fire time is in the past for participants that have fcm tokens.
     # need to filter out unregistered fcms, database schema sucks for that, do it in python. its fine.
     query = ScheduledEvent.objects.filter(
         # core
-        scheduled_time__lte=tomorrow,
+        fire_time__lte=now,
         participant__fcm_tokens__isnull=False,
         # safety
         participant__deleted=False,
@@ -382,15 +454,12 @@ def get_surveys_and_schedules(now: datetime, **filter_kwargs) -> Tuple[DictOfStr
         survey__study_id__in=get_stopped_study_ids()  # no stopped studies
     ) \
     .values_list(
-        "scheduled_time",
+        "fire_time",
         "survey__object_id",
-        "survey__study__timezone_name",
         "participant__fcm_tokens__token",
         "pk",
         "participant__patient_id",
         "participant__fcm_tokens__unregistered",
-        "participant__timezone_name",
-        "participant__unknown_timezone",
     )
     
     # we need a mapping of fcm tokens (a proxy for participants) to surveys and schedule ids (pks)
@@ -405,50 +474,22 @@ def get_surveys_and_schedules(now: datetime, **filter_kwargs) -> Tuple[DictOfStr
     fcm: str  # fcm token
     patient_id: str
     survey_obj_id: str
-    scheduled_time: datetime  # in UTC
+    fire_time: datetime  # in UTC
     schedule_id: int
-    study_tz_name: str
-    participant_tz_name: str
-    participant_has_bad_tz: bool
-    for scheduled_time, survey_obj_id, study_tz_name, fcm, schedule_id, patient_id, unregistered, participant_tz_name, participant_has_bad_tz in query:
+    for fire_time, survey_obj_id, fcm, schedule_id, patient_id, unregistered in query:
         logd("\nchecking scheduled event:")
         logd("unregistered:", unregistered)
         logd("fcm:", fcm)
         logd("patient_id:", patient_id)
         logd("survey_obj_id:", survey_obj_id)
-        logd("scheduled_time:", scheduled_time)
+        logd("fire_time:", fire_time)
         logd("schedule_id:", schedule_id)
-        logd("study_tz_name:", study_tz_name)
-        logd("participant_tz_name:", participant_tz_name)
-        logd("participant_has_bad_tz:", participant_has_bad_tz)
         
         # case: this instance has an outdated FCM credential, skip it.
         if unregistered:
             logd("nope, unregistered fcm token")
             continue
         
-        # The participant and study timezones REALLY SHOULD be valid timezone names. If they aren't
-        # valid then gettz's behavior is to return None; if gettz receives None or the empty string
-        # then it returns UTC. In order to at-least-be-consistent we will coerce no timezone to UTC.
-        # (At least gettz caches, so performance should be fine without adding complexity.)
-        participant_tz = gettz(study_tz_name) if participant_has_bad_tz else gettz(participant_tz_name)
-        participant_tz = participant_tz or UTC
-        study_tz = gettz(study_tz_name) or UTC
-        
-        # ScheduledEvents are created in the study's timezone, and in the database they are
-        # normalized to UTC. Convert it to the study timezone time - we'll call that canonical time
-        # - which will be the time of day assigned on the survey page. Then time-shift that into the
-        # participant's timezone, and check if That value is in the past.
-        canonical_time = scheduled_time.astimezone(study_tz)
-        participant_time = canonical_time.replace(tzinfo=participant_tz)
-        logd("canonical_time:", canonical_time)
-        logd("participant_time:", participant_time)
-        if participant_time > now:
-            logd("nope, participant time is considered in the future")
-            logd(f"{now} > {participant_time}")
-            continue
-        logd("yup, participant time is considered in the past")
-        logd(f"{now} <= {participant_time}")
         surveys[fcm].append(survey_obj_id)
         schedules[fcm].append(schedule_id)
         patient_ids[fcm] = patient_id
@@ -472,6 +513,25 @@ def create_survey_push_notification_tasks():
         
         # surveys and schedules are guaranteed to have the same keys, assembling the data structures
         # is a pain, so it is factored out. sorry, but not sorry. it was a mess.
+        if PUSH_NOTIFICATION_BATCH_SEND:
+            fcm_tokens = list(surveys.keys())
+            for i in range(0, len(fcm_tokens), FCM_BATCH_SIZE):
+                notifications = [
+                    [fcm_token, surveys[fcm_token], schedules[fcm_token]]
+                    for fcm_token in fcm_tokens[i:i + FCM_BATCH_SIZE]
+                ]
+                log(f"Queueing up a batch of {len(notifications)} survey push notifications")
+                safe_apply_async(
+                    celery_send_survey_push_notification_batch,
+                    args=[notifications],
+                    max_retries=0,
+                    expires=expiry,
+                    task_track_started=True,
+                    task_publish_retry=False,
+                    retry=False,
+                )
+            return
+        
         for fcm_token in surveys.keys():
             log(f"Queueing up push notification for user {patient_ids[fcm_token]} for {surveys[fcm_token]}")
             safe_apply_async(
@@ -590,66 +650,146 @@ def do_send_survey_push_notification(
             send_survey_push_notification(
                 participant, reference_schedule, survey_obj_ids, fcm_token
             )
-        # error types are documented at firebase.google.com/docs/reference/fcm/rest/v1/ErrorCode
-        except UnregisteredError:
-            log("\nUnregisteredError\n")
-            # Is an internal 404 http response, it means the token that was used has been disabled.
-            # Mark the fcm history as out of date, return early.
-            ParticipantFCMHistory.objects.filter(token=fcm_token).update(unregistered=timezone.now())
+        except Exception as e:
+            handle_survey_send_error(participant, fcm_token, e, schedules, debug)
             return
         
-        except QuotaExceededError as e:
-            # Limits are very high, this should be impossible. Reraise because this requires
-            # sysadmin attention and probably new development to allow multiple firebase
-            # credentials. Read comments in settings.py if toggling.
-            if BLOCK_QUOTA_EXCEEDED_ERROR:
-                failed_send_handler(participant, fcm_token, str(e), schedules, debug)
-                return
-            else:
-                raise
-        
-        except ThirdPartyAuthError as e:
-            loge("\nThirdPartyAuthError\n")
-            failed_send_handler(participant, fcm_token, str(e), schedules, debug)
-            # This means the credentials used were wrong for the target app instance.  This can occur
-            # both with bad server credentials, and with bad device credentials.
-            # We have only seen this error statement, error name is generic so there may be others.
-            if str(e) != "Auth error from APNS or Web Push Service":
-                raise
+        success_send_handler(participant, fcm_token, schedules)
+
+
+@push_send_celery_app.task(queue=PUSH_NOTIFICATION_SEND_QUEUE)
+def celery_send_survey_push_notification_batch(notifications: List[Tuple[str, List[str], List[int]]]):
+    """ Passthrough for the batch survey push notification function, just a wrapper for celery. """
+    do_send_survey_push_notification_batch(
+        notifications, make_error_sentry(sentry_type=SentryTypes.data_processing)
+    )
+
+
+def do_send_survey_push_notification_batch(
+    notifications: List[Tuple[str, List[str], List[int]]], error_handler: ErrorSentry
+):
+    """ The batch-send version of do_send_survey_push_notification, takes a list of (fcm token,
+    survey object ids, schedule pks). The database lookups are a few queries for the whole batch,
+    each notification's result is handled exactly like do_send_survey_push_notification. """
+    
+    with error_handler:
+        if not check_firebase_instance():
+            loge("Surveys - Firebase credentials are not configured.")
             return
         
-        except SenderIdMismatchError as e:
-            # In order to enhance this section we will need exact text of error messages to handle
-            # similar error cases. (but behavior shouldn't be broken anymore, failed_send_handler
-            # executes.)
-            loge("\nSenderIdMismatchError:\n")
-            loge(e)
-            failed_send_handler(participant, fcm_token, str(e), schedules, debug)
-            return
+        fcm_tokens = [fcm_token for fcm_token, _, _ in notifications]
+        participant_ids = dict(
+            ParticipantFCMHistory.objects.filter(token__in=fcm_tokens)
+            .values_list("token", "participant_id")
+        )
+        participants = Participant.objects.in_bulk(participant_ids.values())
+        schedules_by_pk = ScheduledEvent.objects.select_related("survey__study").in_bulk(
+            {schedule_pk for _, _, schedule_pks in notifications for schedule_pk in schedule_pks}
+        )
         
-        except ValueError as e:
-            loge("\nValueError\n")
-            # This case occurs ever? is tested for in check_firebase_instance... weird race
-            # condition? Error should be transient, and like all other cases we enqueue the next
-            # weekly surveys regardless.
-            if "The default Firebase app does not exist" in str(e):
-                enqueue_weekly_surveys(participant, schedules)
-                return
-            else:
-                raise
+        # (participant, fcm token, schedules) of each message
+        recipients: List[Tuple[Participant, str, List[ScheduledEvent]]] = []
+        messages: List[Message] = []
+        for fcm_token, survey_obj_ids, schedule_pks in notifications:
+            with error_handler:
+                participant = participants[participant_ids[fcm_token]]
+                survey_obj_ids = list(set(survey_obj_ids))  # Dedupe-dedupe
+                log(f"Sending push notification to {participant.patient_id} for {survey_obj_ids}...")
+                
+                schedules = [
+                    schedules_by_pk[schedule_pk] for schedule_pk in set(schedule_pks)
+                    if schedule_pk in schedules_by_pk
+                ]
+                # use the earliest timed schedule as our reference for the sent_time parameter.
+                reference_schedule = min(schedules, key=lambda schedule: schedule.scheduled_time)
+                messages.append(build_survey_push_notification_message(
+                    participant, reference_schedule, survey_obj_ids, fcm_token
+                ))
+                recipients.append((participant, fcm_token, schedules))
         
-        except Exception as e:
-            failed_send_handler(participant, fcm_token, str(e), schedules, debug)
-            raise
+        # each notification's errors are reported separately, one failure doesn't stop the batch.
+        # The schedules of a failed batch are untouched and will be sent on a later run.
+        errors = send_notifications_batch(messages)
+        successes = []
+        batch_error = None
+        for recipient, error in zip(recipients, errors):
+            if error is None:
+                successes.append(recipient)
+                continue
+            if isinstance(error, BatchRequestFailed):
+                batch_error = batch_error or error.args[0]
+                continue
+            with error_handler:
+                participant, fcm_token, schedules = recipient
+                handle_survey_send_error(participant, fcm_token, error, schedules, False)
         
-        success_send_handler(participant, fcm_token, schedules)
+        success_send_handler_bulk(successes)
+        if batch_error:
+            raise batch_error
+
+
+def handle_survey_send_error(
+    participant: Participant,
+    fcm_token: str,
+    error: Exception,
+    schedules: List[ScheduledEvent],
+    debug: bool,
+):
+    """ Handles an error from sending a survey push notification, raises the error if it requires
+    attention. """
+    # error types are documented at firebase.google.com/docs/reference/fcm/rest/v1/ErrorCode
+    if isinstance(error, UnregisteredError):
+        log("\nUnregisteredError\n")
+        # Is an internal 404 http response, it means the token that was used has been disabled.
+        # Mark the fcm history as out of date, return early.
+        ParticipantFCMHistory.objects.filter(token=fcm_token).update(unregistered=timezone.now())
+    
+    elif isinstance(error, QuotaExceededError):
+        # Limits are very high, this should be impossible. Reraise because this requires
+        # sysadmin attention and probably new development to allow multiple firebase
+        # credentials. Read comments in settings.py if toggling.
+        if BLOCK_QUOTA_EXCEEDED_ERROR:
+            failed_send_handler(participant, fcm_token, str(error), schedules, debug)
+        else:
+            raise error
+    
+    elif isinstance(error, ThirdPartyAuthError):
+        loge("\nThirdPartyAuthError\n")
+        failed_send_handler(participant, fcm_token, str(error), schedules, debug)
+        # This means the credentials used were wrong for the target app instance.  This can occur
+        # both with bad server credentials, and with bad device credentials.
+        # We have only seen this error statement, error name is generic so there may be others.
+        if str(error) != "Auth error from APNS or Web Push Service":
+            raise error
+    
+    elif isinstance(error, SenderIdMismatchError):
+        # In order to enhance this section we will need exact text of error messages to handle
+        # similar error cases. (but behavior shouldn't be broken anymore, failed_send_handler
+        # executes.)
+        loge("\nSenderIdMismatchError:\n")
+        loge(error)
+        failed_send_handler(participant, fcm_token, str(error), schedules, debug)
+    
+    elif isinstance(error, ValueError):
+        loge("\nValueError\n")
+        # This case occurs ever? is tested for in check_firebase_instance... weird race
+        # condition? Error should be transient, and like all other cases we enqueue the next
+        # weekly surveys regardless.
+        if "The default Firebase app does not exist" in str(error):
+            enqueue_weekly_surveys(participant, schedules)
+        else:
+            raise error
+    
+    else:
+        failed_send_handler(participant, fcm_token, str(error), schedules, debug)
+        raise error
 
 
 def get_or_mock_schedule(schedule_pks: List[str], debug: bool) -> Tuple[ScheduledEvent, List[ScheduledEvent]]:
     # in debug mode we need to mock a schedule object, in production we need to get the earliest one.
     if not debug:
         # use the earliest timed schedule as our reference for the sent_time parameter.
-        schedules = ScheduledEvent.objects.filter(pk__in=schedule_pks)
+        schedules = ScheduledEvent.objects.filter(pk__in=schedule_pks).select_related("survey__study")
         reference_schedule = schedules.order_by("scheduled_time").first()
         return reference_schedule, schedules
     else:
@@ -663,8 +803,17 @@ def get_or_mock_schedule(schedule_pks: List[str], debug: bool) -> Tuple[Schedule
 def send_survey_push_notification(
     participant: Participant, reference_schedule: ScheduledEvent, survey_obj_ids: List[str],
     fcm_token: str
-) -> str:
+):
     """ Contains the body of the code to send a notification  """
+    send_notification(build_survey_push_notification_message(
+        participant, reference_schedule, survey_obj_ids, fcm_token
+    ))
+
+
+def build_survey_push_notification_message(
+    participant: Participant, reference_schedule: ScheduledEvent, survey_obj_ids: List[str],
+    fcm_token: str
+) -> Message:
     # we include a nonce in case of notification deduplication, and a schedule_uuid to for the
     #  checkin after the push notification is sent.
     data_kwargs = {
@@ -685,25 +834,39 @@ def send_survey_push_notification(
             token=fcm_token,
             notification=Notification(title="Beiwe", body=display_message),
         )
-    send_notification(message)
+    return message
 
 
 def success_send_handler(participant: Participant, fcm_token: str, schedules: List[ScheduledEvent]):
+    success_send_handler_bulk([(participant, fcm_token, schedules)])
+
+
+def success_send_handler_bulk(recipients: List[Tuple[Participant, str, List[ScheduledEvent]]]):
+    """ Handles successful sends for a list of (participant, fcm token, schedules), a fixed number
+    of queries regardless of the number of recipients. """
     # If the query was successful archive the schedules.  Clear the fcm unregistered flag
     # if it was set (this shouldn't happen. ever. but in case we hook in a ui element we need it.)
-    log(f"Survey push notification send succeeded for {participant.patient_id}.")
+    for participant, _, _ in recipients:
+        log(f"Survey push notification send succeeded for {participant.patient_id}.")
     
     # this condition shouldn't occur.  Leave in, this case would be super stupid to diagnose.
-    fcm_hist: ParticipantFCMHistory = ParticipantFCMHistory.objects.get(token=fcm_token)
-    if fcm_hist.unregistered is not None:
-        fcm_hist.unregistered = None
-        fcm_hist.save()
-    
-    participant.push_notification_unreachable_count = 0
-    participant.save()
+    ParticipantFCMHistory.objects.filter(
+        token__in=[fcm_token for _, fcm_token, _ in recipients], unregistered__isnull=False
+    ).update(unregistered=None)
+    
+    participant_ids = [participant.pk for participant, _, _ in recipients]
+    Participant.objects.filter(pk__in=participant_ids, push_notification_unreachable_count__gt=0) \
+        .update(push_notification_unreachable_count=0)
+    for participant, _, _ in recipients:
+        participant.push_notification_unreachable_count = 0
     
-    create_archived_events(schedules, status=MESSAGE_SEND_SUCCESS)
-    enqueue_weekly_surveys(participant, schedules)
+    create_archived_events(
+        [schedule for _, _, schedules in recipients for schedule in schedules],
+        status=MESSAGE_SEND_SUCCESS,
+    )
+    enqueue_weekly_surveys_bulk(
+        [(participant, schedule) for participant, _, schedules in recipients for schedule in schedules]
+    )
 
 
 def failed_send_handler(
@@ -718,9 +881,7 @@ def failed_send_handler(
     
     if participant.push_notification_unreachable_count >= PUSH_NOTIFICATION_ATTEMPT_COUNT:
         now = timezone.now()
-        fcm_hist: ParticipantFCMHistory = ParticipantFCMHistory.objects.get(token=fcm_token)
-        fcm_hist.unregistered = now
-        fcm_hist.save()
+        ParticipantFCMHistory.objects.filter(token=fcm_token).update(unregistered=now)
         
         PushNotificationDisabledEvent(
             participant=participant, timestamp=now,
@@ -728,15 +889,18 @@ def failed_send_handler(
         ).save()
         
         # disable the credential
+        Participant.objects.filter(pk=participant.pk).update(push_notification_unreachable_count=0)
         participant.push_notification_unreachable_count = 0
-        participant.save()
         
         logd(f"Participant {participant.patient_id} has had push notifications "
               f"disabled after {PUSH_NOTIFICATION_ATTEMPT_COUNT} failed attempts to send.")
     
     else:
         now = None
-        participant.save()
+        # (this writes the count from before the increment, as participant.save() did.)
+        Participant.objects.filter(pk=participant.pk).update(
+            push_notification_unreachable_count=participant.push_notification_unreachable_count
+        )
         participant.push_notification_unreachable_count += 1
         logd(f"Participant {participant.patient_id} has had push notifications failures "
               f"incremented to {participant.push_notification_unreachable_count}.")
@@ -754,19 +918,27 @@ def create_archived_events(schedules: List[ScheduledEvent], status: str, created
     # TODO: We are currently blindly deleting after sending, this will be changed after the app is
     #  updated to provide uuid checkins on the download surveys endpoint. (maybe)
     mark_as_deleted = status == MESSAGE_SEND_SUCCESS
-    for scheduled_event in schedules:
-        scheduled_event.archive(self_delete=mark_as_deleted, status=status, created_on=created_on)
+    ScheduledEvent.bulk_archive(list(schedules), mark_as_deleted, status, created_on)
 
 
 def enqueue_weekly_surveys(participant: Participant, schedules: List[ScheduledEvent]):
-    # set_next_weekly is idempotent until the next weekly event passes.
+    enqueue_weekly_surveys_bulk([(participant, schedule) for schedule in schedules])
+
+
+def enqueue_weekly_surveys_bulk(participants_and_schedules: List[Tuple[Participant, ScheduledEvent]]):
+    # bulk_set_next_weekly is idempotent until the next weekly event passes.
     # its perfectly safe (commit time) to have many of the same weekly survey be scheduled at once.
-    for schedule in schedules:
-        if schedule.get_schedule_type() == ScheduleTypes.weekly:
-            set_next_weekly(participant, schedule.survey)
+    participant_ids_and_surveys = [
+        (participant.pk, schedule.survey) for participant, schedule in participants_and_schedules
+        if schedule.get_schedule_type() == ScheduleTypes.weekly
+    ]
+    if participant_ids_and_surveys:
+        bulk_set_next_weekly(participant_ids_and_surveys)
 
 
 # can't be factored out easily because it requires the celerytask function object.
 # 2024-1-13 - it's not clear anymore if this is required .
 celery_send_survey_push_notification.max_retries = 0
 celery_heartbeat_send_push_notification.max_retries = 0
+celery_send_survey_push_notification_batch.max_retries = 0
+celery_heartbeat_send_push_notification_batch.max_retries = 0
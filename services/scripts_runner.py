@@ -146,3 +146,19 @@ def celery_purge_invalid_time_data():
         print("running script upload_logs.")
         from scripts import purge_1970_chunks
         ImportRepeater.ensure_run(purge_1970_chunks)
+
+
+#
+## Create upcoming ChunkRegistry partitions - does nothing unless the table has been partitioned.
+#
+def create_task_create_chunk_registry_partitions():
+    with SCRIPT_ERROR_SENTRY:
+        queue_script(celery_create_chunk_registry_partitions, DAILY)
+
+
+@scripts_celery_app.task(queue=SCRIPTS_QUEUE)
+def celery_create_chunk_registry_partitions():
+    with SCRIPT_ERROR_SENTRY:
+        print("running script create_chunk_registry_partitions.")
+        from scripts import create_chunk_registry_partitions
+        ImportRepeater.ensure_run(create_chunk_registry_partitions)
@@ -18,8 +18,10 @@ from authentication.tableau_authentication import X_ACCESS_KEY_ID, X_ACCESS_KEY_
 from constants.testing_constants import ALL_ROLE_PERMUTATIONS, REAL_ROLES, ResearcherRole
 from database.security_models import ApiKey
 from database.study_models import Study
+from database.system_models import SingletonModel
 from database.user_models_participant import Participant
 from database.user_models_researcher import Researcher, StudyRelation
+from libs.endpoint_helpers.device_download_helpers import clear_device_download_caches
 from libs.internal_types import ResponseOrRedirect, StrOrBytes
 from libs.utils.security_utils import generate_easy_alphanumeric_string
 from tests.helpers import DatabaseHelperMixin, render_test_html_file
@@ -89,6 +91,11 @@ class CommonTestCase(TestCase, DatabaseHelperMixin):
         messages.warning = self.monkeypatch_messages(messages.warning)
         messages.error = self.monkeypatch_messages(messages.error)
         
+        # singletons and device download payloads are cached per-process, test database rollbacks
+        # don't clear those caches.
+        SingletonModel.clear_singleton_cache()
+        clear_device_download_caches()
+        
         if VERBOSE_2_OR_3:
             print("\n==")
         return super().setUp()
@@ -760,6 +760,9 @@ class DummyThreadPool():
         # does not use kwargs
         return map(func, iterable)
     
+    def apply_async(self, func, args=(), kwds={}):
+        return DummyAsyncResult(func(*args, **kwds))
+    
     # @staticmethod
     def terminate(self):
         pass
@@ -769,6 +772,15 @@ class DummyThreadPool():
         pass
 
 
+class DummyAsyncResult():
+    """ the return of DummyThreadPool.apply_async, the function has already run. """
+    def __init__(self, value) -> None:
+        self.value = value
+    
+    def get(self, timeout=None):
+        return self.value
+
+
 def render_test_html_file(response: HttpResponse, url: str):
     print("\nwriting url:", url)
     
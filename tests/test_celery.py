@@ -7,14 +7,17 @@ from django.utils import timezone
 from firebase_admin.messaging import (QuotaExceededError, SenderIdMismatchError,
     ThirdPartyAuthError, UnregisteredError)
 
-from constants.message_strings import DEFAULT_HEARTBEAT_MESSAGE
+from constants.message_strings import DEFAULT_HEARTBEAT_MESSAGE, MESSAGE_SEND_SUCCESS
+from constants.schedule_constants import ScheduleTypes
 from constants.testing_constants import (THURS_OCT_6_NOON_2022_NY, THURS_OCT_13_NOON_2022_NY,
     THURS_OCT_20_NOON_2022_NY)
 from constants.user_constants import ACTIVE_PARTICIPANT_FIELDS, ANDROID_API
-from database.schedule_models import ScheduledEvent
+from database.schedule_models import ArchivedEvent, ScheduledEvent
 from database.user_models_participant import Participant, ParticipantFCMHistory
-from services.celery_push_notifications import (create_heartbeat_tasks, get_surveys_and_schedules,
-    heartbeat_query)
+from libs.schedules import bulk_set_next_weekly
+from services.celery_push_notifications import (create_heartbeat_tasks,
+    create_survey_push_notification_tasks, get_surveys_and_schedules, heartbeat_query,
+    success_send_handler_bulk)
 from tests.common import CommonTestCase
 
 
@@ -127,6 +130,37 @@ class TestGetSurveysAndSchedules(TestCelery):
         self.default_participant.try_set_timezone('America/New_York')
         self.validate_basics(schedule)
     
+    @time_machine.travel(THURS_OCT_13_NOON_2022_NY)
+    def test_fire_time_is_shifted_into_participant_timezone(self):
+        self.default_study.update_only(timezone_name='America/New_York')
+        self.default_participant.try_set_timezone('America/Los_Angeles')
+        with time_machine.travel(THURS_OCT_6_NOON_2022_NY):
+            schedule, _ = self.generate_a_real_weekly_schedule_event_with_schedule(4, 12, 0)
+        # noon in New York becomes noon in Los Angeles, which is 3 hours later.
+        self.assertEqual(schedule.fire_time, THURS_OCT_13_NOON_2022_NY + timedelta(hours=3))
+        
+        self.default_participant.try_set_timezone('America/New_York')
+        schedule.refresh_from_db()
+        self.assertEqual(schedule.fire_time, THURS_OCT_13_NOON_2022_NY)
+    
+    def test_bulk_created_events_have_fire_times(self):
+        self.default_participant.try_set_timezone('America/Chicago')
+        self.generate_weekly_schedule(self.default_survey, 4, 12, 0)
+        bulk_set_next_weekly([(self.default_participant.pk, self.default_survey)])
+        schedule = ScheduledEvent.objects.get()
+        self.assertEqual(
+            schedule.fire_time,
+            schedule.scheduled_time.replace(tzinfo=gettz('America/Chicago')),  # study is UTC
+        )
+    
+    def test_event_with_no_fire_time_is_not_due(self):
+        self.populate_default_fcm_token
+        schedule = self.generate_easy_absolute_schedule_event_with_schedule(
+            timezone.now() - timedelta(days=5)
+        )
+        ScheduledEvent.objects.filter(pk=schedule.pk).update(fire_time=None)
+        self.validate_no_schedules()
+    
     # using weekly as a base we now test situations where it shouldn't return schedules
     @time_machine.travel(THURS_OCT_6_NOON_2022_NY)
     def test_deleted_hidden_study(self):
@@ -378,6 +412,35 @@ class TestHeartbeatQuery(TestCelery):
         self.assertEqual(len(heartbeat_query()), 1)
         self.assertListEqual(list(heartbeat_query()), self.default_participant_response)
     
+    def test_heartbeat_reference_time_follows_activity_fields(self):
+        now = timezone.now()
+        self.default_participant.update_only(last_upload=now - timedelta(minutes=90))
+        self.default_participant.refresh_from_db()
+        self.assertEqual(
+            self.default_participant.heartbeat_reference_time, now - timedelta(minutes=90)
+        )
+        self.default_participant.update_only(last_heartbeat_checkin=now)
+        self.default_participant.refresh_from_db()
+        self.assertEqual(self.default_participant.heartbeat_reference_time, now)
+    
+    def test_query_uses_study_heartbeat_timer(self):
+        self.set_working_heartbeat_notification_fully_valid  # last upload was 61 minutes ago
+        self.assertEqual(len(heartbeat_query()), 1)
+        self.default_study.device_settings.update(heartbeat_timer_minutes=120)
+        self.assertEqual(len(heartbeat_query()), 0)
+        self.default_participant.update(last_upload=timezone.now() - timedelta(minutes=121))
+        self.assertEqual(len(heartbeat_query()), 1)
+    
+    @patch("services.celery_push_notifications.heartbeat_query")
+    @patch("services.celery_push_notifications.check_firebase_instance")
+    def test_heartbeat_query_runs_once(
+        self, check_firebase_instance: MagicMock, heartbeat_query: MagicMock,
+    ):
+        check_firebase_instance.return_value = True
+        heartbeat_query.return_value = []
+        create_heartbeat_tasks()
+        heartbeat_query.assert_called_once()
+    
     def test_query_multiple_participants_with_both_valid(self):
         self.set_working_heartbeat_notification_fully_valid
         p2 = self.generate_participant(self.default_study)
@@ -534,3 +597,173 @@ class TestHeartbeatQuery(TestCelery):
         self.default_participant.refresh_from_db()
         self.assertIsNone(self.default_participant.last_heartbeat_notification)
         self.assertIsInstance(self.default_participant.fcm_tokens.first().unregistered, datetime)
+
+
+class TestBatchPushNotifications(TestCelery):
+    # FalseCeleryApps run the batch tasks synchronously, see TestHeartbeatQuery.
+    
+    @staticmethod
+    def batch_response(messages, errors_by_token):
+        # mimics the BatchResponse of firebase send_each, responses are in the order of the messages.
+        return MagicMock(responses=[
+            MagicMock(
+                success=message.token not in errors_by_token,
+                exception=errors_by_token.get(message.token, None),
+            ) for message in messages
+        ])
+    
+    def two_heartbeat_participants(self) -> Participant:
+        for participant in (self.default_participant, self.generate_participant(self.default_study)):
+            participant.update(
+                deleted=False, permanently_retired=False,
+                last_upload=timezone.now() - timedelta(minutes=61),
+            )
+        self.populate_default_fcm_token
+        p2 = Participant.objects.exclude(pk=self.default_participant.pk).get()
+        self.generate_fcm_token(p2, None)
+        return p2
+    
+    @patch("services.celery_push_notifications.PUSH_NOTIFICATION_BATCH_SEND", True)
+    @patch("services.celery_push_notifications.send_notification_batch")
+    @patch("services.celery_push_notifications.send_notification")
+    @patch("services.celery_push_notifications.check_firebase_instance")
+    def test_heartbeat_batch_per_token_errors(
+        self, check_firebase_instance: MagicMock, send_notification: MagicMock,
+        send_notification_batch: MagicMock,
+    ):
+        check_firebase_instance.return_value = True
+        p2 = self.two_heartbeat_participants()
+        p2_token = p2.fcm_tokens.get().token
+        send_notification_batch.side_effect = lambda messages: self.batch_response(
+            messages, {p2_token: UnregisteredError("test")}
+        )
+        
+        create_heartbeat_tasks()
+        send_notification.assert_not_called()
+        send_notification_batch.assert_called_once()
+        self.assertEqual(len(send_notification_batch.call_args[0][0]), 2)
+        self.default_participant.refresh_from_db()
+        p2.refresh_from_db()
+        self.assertIsInstance(self.default_participant.last_heartbeat_notification, datetime)
+        self.assertIsNone(p2.last_heartbeat_notification)
+        self.assertIsNone(self.default_participant.fcm_tokens.get().unregistered)
+        self.assertIsInstance(p2.fcm_tokens.get().unregistered, datetime)
+    
+    @patch("services.celery_push_notifications.PUSH_NOTIFICATION_BATCH_SEND", True)
+    @patch("services.celery_push_notifications.send_notification_batch")
+    @patch("services.celery_push_notifications.check_firebase_instance")
+    def test_heartbeat_batch_unknown_error_raised_after_batch(
+        self, check_firebase_instance: MagicMock, send_notification_batch: MagicMock,
+    ):
+        check_firebase_instance.return_value = True
+        p2 = self.two_heartbeat_participants()
+        p2_token = p2.fcm_tokens.get().token
+        send_notification_batch.side_effect = lambda messages: self.batch_response(
+            messages, {p2_token: ValueError("test")}
+        )
+        
+        self.assertRaises(ValueError, create_heartbeat_tasks)
+        self.default_participant.refresh_from_db()
+        p2.refresh_from_db()
+        self.assertIsInstance(self.default_participant.last_heartbeat_notification, datetime)
+        self.assertIsNone(p2.last_heartbeat_notification)
+        self.assertIsNone(p2.fcm_tokens.get().unregistered)
+    
+    @patch("services.celery_push_notifications.PUSH_NOTIFICATION_BATCH_SEND", True)
+    @patch("services.celery_push_notifications.send_notification_batch")
+    @patch("services.celery_push_notifications.check_firebase_instance")
+    def test_survey_batch_success(
+        self, check_firebase_instance: MagicMock, send_notification_batch: MagicMock,
+    ):
+        check_firebase_instance.return_value = True
+        self.populate_default_fcm_token
+        schedule = self.generate_easy_absolute_schedule_event_with_schedule(
+            timezone.now() - timedelta(days=1)
+        )
+        send_notification_batch.side_effect = lambda messages: self.batch_response(messages, {})
+        
+        create_survey_push_notification_tasks()
+        send_notification_batch.assert_called_once()
+        schedule.refresh_from_db()
+        self.assertTrue(schedule.deleted)
+        self.assertEqual(ArchivedEvent.objects.get().status, MESSAGE_SEND_SUCCESS)
+    
+    @patch("services.celery_push_notifications.PUSH_NOTIFICATION_BATCH_SEND", True)
+    @patch("services.celery_push_notifications.send_notification_batch")
+    @patch("services.celery_push_notifications.check_firebase_instance")
+    def test_survey_batch_failure(
+        self, check_firebase_instance: MagicMock, send_notification_batch: MagicMock,
+    ):
+        check_firebase_instance.return_value = True
+        self.populate_default_fcm_token
+        schedule = self.generate_easy_absolute_schedule_event_with_schedule(
+            timezone.now() - timedelta(days=1)
+        )
+        send_notification_batch.side_effect = lambda messages: self.batch_response(
+            messages, {self.DEFAULT_FCM_TOKEN: SenderIdMismatchError("test")}
+        )
+        
+        create_survey_push_notification_tasks()
+        schedule.refresh_from_db()
+        self.default_participant.refresh_from_db()
+        self.assertFalse(schedule.deleted)
+        self.assertEqual(ArchivedEvent.objects.get().status, "test")
+    
+    @patch("services.celery_push_notifications.PUSH_NOTIFICATION_BATCH_SEND", True)
+    @patch("services.celery_push_notifications.send_notification_batch")
+    @patch("services.celery_push_notifications.check_firebase_instance")
+    def test_survey_batch_request_failure_is_not_a_participant_failure(
+        self, check_firebase_instance: MagicMock, send_notification_batch: MagicMock,
+    ):
+        check_firebase_instance.return_value = True
+        self.populate_default_fcm_token
+        schedule = self.generate_easy_absolute_schedule_event_with_schedule(
+            timezone.now() - timedelta(days=1)
+        )
+        send_notification_batch.side_effect = ConnectionError("test")
+        
+        self.assertRaises(ConnectionError, create_survey_push_notification_tasks)
+        schedule.refresh_from_db()
+        self.default_participant.refresh_from_db()
+        self.assertFalse(schedule.deleted)
+        self.assertFalse(ArchivedEvent.objects.exists())
+        self.assertEqual(self.default_participant.push_notification_unreachable_count, 0)
+    
+    @patch("services.celery_push_notifications.PUSH_NOTIFICATION_BATCH_SEND", True)
+    @patch("services.celery_push_notifications.send_notification_batch")
+    @patch("services.celery_push_notifications.check_firebase_instance")
+    def test_heartbeat_batch_request_failure_is_not_a_participant_failure(
+        self, check_firebase_instance: MagicMock, send_notification_batch: MagicMock,
+    ):
+        check_firebase_instance.return_value = True
+        p2 = self.two_heartbeat_participants()
+        send_notification_batch.side_effect = ConnectionError("test")
+        
+        self.assertRaises(ConnectionError, create_heartbeat_tasks)
+        p2.refresh_from_db()
+        self.assertIsNone(p2.last_heartbeat_notification)
+        self.assertIsNone(p2.fcm_tokens.get().unregistered)
+        self.assertEqual(p2.push_notification_unreachable_count, 0)
+    
+    def test_success_send_handler_bulk_archives_and_requeues_weekly(self):
+        self.populate_default_fcm_token
+        event, _ = self.generate_a_real_weekly_schedule_event_with_schedule(day_of_week=3, hour=12)
+        p2 = self.generate_participant(self.default_study)
+        self.assertEqual(bulk_set_next_weekly([(p2.pk, self.default_survey)]), 1)
+        p2_event = ScheduledEvent.objects.select_related("survey__study").get(participant=p2)
+        
+        with self.assertNumQueries(7):
+            success_send_handler_bulk([
+                (self.default_participant, self.DEFAULT_FCM_TOKEN, [event]),
+                (p2, "not a real token", [p2_event]),
+            ])
+        event.refresh_from_db()
+        self.assertTrue(event.deleted)
+        self.assertEqual(event.most_recent_event.status, MESSAGE_SEND_SUCCESS)
+        self.assertEqual(event.most_recent_event.schedule_type, ScheduleTypes.weekly)
+        self.assertEqual(ArchivedEvent.objects.count(), 2)
+        # the next weekly events already exist (they are the events that were archived)
+        self.assertEqual(ScheduledEvent.objects.count(), 2)
+        self.assertEqual(
+            bulk_set_next_weekly([(self.default_participant.pk, self.default_survey)]), 0
+        )
@@ -1,11 +1,24 @@
 import csv
-from datetime import date
+import os
+import shutil
+from datetime import date, datetime, timedelta
 from io import StringIO
-from typing import Dict, List
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+from unittest.mock import MagicMock, patch
 
+from dateutil.tz import UTC
+from django.utils import timezone
+
+from constants.celery_constants import ForestTaskStatus
+from constants.data_stream_constants import GPS
 from constants.forest_constants import ForestTree
 from database.forest_models import ForestTask, SummaryStatisticDaily
-from services.celery_forest import BadForestField, csv_parse_and_consume
+from database.data_access_models import ChunkRegistry
+from services.celery_forest import (BadForestField, celery_run_forest, create_forest_celery_tasks,
+    csv_parse_and_consume, dates_to_time_ranges, download_data_files, get_node_admission_error,
+    get_stale_dates, MAX_TIME, MIN_TIME, run_forest_task)
 from tests.common import CommonTestCase
 
 
@@ -14,7 +27,9 @@ class NopeBadCSV(Exception): pass
 
 class TestFileConsumption(CommonTestCase):
     
-    def call_csv_parse_and_consume(self, task: ForestTask, csv_dict_rows: List[Dict]):
+    def call_csv_parse_and_consume(
+        self, task: ForestTask, csv_dict_rows: List[Dict], dates: List[date] = None
+    ):
         """ We need to test with a real dictreader, this function converts a list of dictionaries to
         an in-memory csv file and then calls csv_parse_and_consume on it. """
         if len(csv_dict_rows) < 1:
@@ -35,7 +50,7 @@ class TestFileConsumption(CommonTestCase):
             )
         
         # shove the csv string into a file-like object and call.
-        return csv_parse_and_consume(task, csv.DictReader(StringIO(csv_string)))
+        return csv_parse_and_consume(task, csv.DictReader(StringIO(csv_string)), dates)
     
     def one_jasmine_row(self, day: date):
         # keep this list ordered to match the order of the matching columns in the
@@ -82,6 +97,62 @@ class TestFileConsumption(CommonTestCase):
         self.call_csv_parse_and_consume(self.default_forest_task, csv_dict_rows)
         self.assertEqual(SummaryStatisticDaily.objects.count(), 2)
     
+    def test_csv_parse_and_consume_jasmine_only_dates(self):
+        # incremental tasks only consume the dates they computed
+        self.default_forest_task.update(
+            data_date_start=date(2020, 1, 5),
+            data_date_end=date(2020, 1, 7),
+            forest_tree=ForestTree.jasmine,
+        )
+        csv_dict_rows = [self.one_jasmine_row(date(2020, 1, day)) for day in (5, 6, 7)]
+        self.call_csv_parse_and_consume(self.default_forest_task, csv_dict_rows, [date(2020, 1, 6)])
+        self.assertEqual(
+            list(SummaryStatisticDaily.objects.values_list("date", flat=True)), [date(2020, 1, 6)]
+        )
+    
+    def test_csv_parse_and_consume_blank_lines_and_duplicate_dates(self):
+        self.default_forest_task.update(
+            data_date_start=date(2020, 1, 5),
+            data_date_end=date(2020, 1, 7),
+            forest_tree=ForestTree.jasmine,
+        )
+        first_row = self.one_jasmine_row(date(2020, 1, 5))
+        second_row = {**first_row, "diameter": 2.0}
+        third_row = self.one_jasmine_row(date(2020, 1, 6))
+        csv_string = ",".join(first_row) + "\n\n" + "\n\n".join(
+            ",".join(str(value) for value in row.values()) for row in (first_row, second_row, third_row)
+        ) + "\n"
+        
+        with patch("services.celery_forest.get_timezone_shortcode", return_value="EST") as shortcode:
+            csv_parse_and_consume(self.default_forest_task, csv.DictReader(StringIO(csv_string)))
+        # timezones are computed once per date, the last row for a date wins
+        self.assertEqual(shortcode.call_count, 2)
+        self.assertEqual(SummaryStatisticDaily.objects.count(), 2)
+        self.assertEqual(
+            SummaryStatisticDaily.objects.get(date=date(2020, 1, 5)).jasmine_distance_diameter, 2.0
+        )
+    
+    def test_csv_parse_and_consume_only_updates_its_own_columns(self):
+        self.default_forest_task.update(
+            data_date_start=date(2020, 1, 3),
+            data_date_end=date(2020, 1, 10),
+            forest_tree=ForestTree.jasmine,
+        )
+        existing = self.generate_summary_statistic_daily(date(2020, 1, 5))
+        self.call_csv_parse_and_consume(
+            self.default_forest_task,
+            [self.one_jasmine_row(date(2020, 1, 5)), self.one_jasmine_row(date(2020, 1, 6))],
+        )
+        self.assertEqual(SummaryStatisticDaily.objects.count(), 2)
+        updated = SummaryStatisticDaily.objects.get(date=date(2020, 1, 5))
+        self.assertEqual(updated.pk, existing.pk)
+        self.assertEqual(updated.jasmine_distance_diameter, 0.0)
+        self.assertEqual(updated.jasmine_task_id, self.default_forest_task.pk)
+        self.assertEqual(updated.beiwe_gps_bytes, existing.beiwe_gps_bytes)
+        self.assertEqual(updated.willow_incoming_text_count, existing.willow_incoming_text_count)
+        new = SummaryStatisticDaily.objects.get(date=date(2020, 1, 6))
+        self.assertIsNone(new.beiwe_gps_bytes)
+    
     def one_willow_row(self, day: date):
         return {
             'year': day.year,                        # ! year - int
@@ -248,3 +319,252 @@ class TestFileConsumption(CommonTestCase):
     #     with self.assertRaises(BadForestField):
     #         self.call_csv_parse_and_consume(self.default_forest_task, csv_dict_rows)
     #     self.assertEqual(SummaryStatisticDaily.objects.count(), 0)
+
+
+def fake_s3_retrieve_to_file(key_path: str, encryption_key: bytes, file_obj) -> int:
+    contents = ("decrypted contents of " + key_path).encode()
+    file_obj.write(contents)
+    return len(contents)
+
+
+@patch("services.celery_forest.s3_retrieve_to_file", side_effect=fake_s3_retrieve_to_file)
+class TestDownloadDataFiles(CommonTestCase):
+    
+    def setUp(self) -> None:
+        super().setUp()
+        self.cache_dir = TemporaryDirectory()
+        self.cache_patches = [
+            patch("libs.chunk_cache.CHUNK_CACHE_FOLDER", self.cache_dir.name),
+            patch("libs.chunk_cache._cache_size", None),
+        ]
+        self.tasks = []
+    
+    def tearDown(self) -> None:
+        for task in self.tasks:
+            shutil.rmtree(task.root_path_for_task, ignore_errors=True)
+        self.cache_dir.cleanup()
+        return super().tearDown()
+    
+    def generate_chunks(self, count: int):
+        for hour in range(count):
+            self.generate_chunkregistry(
+                self.session_study,
+                self.default_participant,
+                GPS,
+                path=f"CHUNKED_DATA/{self.session_study.object_id}/gps/{hour}.csv",
+                time_bin=datetime(2024, 1, 1, hour, tzinfo=UTC),
+            )
+    
+    def download(self) -> ForestTask:
+        task = self.generate_forest_task()
+        self.tasks.append(task)
+        download_data_files(task, self.default_participant.chunk_registries.all())
+        task.refresh_from_db()
+        return task
+    
+    def input_files(self, task: ForestTask) -> Dict[str, bytes]:
+        files = {}
+        for folder, _, file_names in os.walk(task.data_input_path):
+            for file_name in file_names:
+                with open(os.path.join(folder, file_name), "rb") as f:
+                    files[file_name] = f.read()
+        return files
+    
+    def test_files_are_written_and_progress_is_recorded(self, s3_retrieve_to_file: MagicMock):
+        self.generate_chunks(3)
+        task = self.download()
+        
+        files = self.input_files(task)
+        self.assertEqual(len(files), 3)
+        self.assertIn(b"decrypted contents of CHUNKED_DATA/", files["2024-01-01 00_00_00+00_00.csv"])
+        self.assertEqual(task.downloaded_file_count, 3)
+        self.assertEqual(task.downloaded_bytes, sum(len(contents) for contents in files.values()))
+        self.assertEqual(task.download_cache_hits, 0)
+        # the study's key is passed in, it is not looked up per file
+        for call in s3_retrieve_to_file.call_args_list:
+            self.assertEqual(call.args[1], self.session_study.encryption_key.encode())
+    
+    def test_cache_is_shared_between_tasks(self, s3_retrieve_to_file: MagicMock):
+        self.generate_chunks(3)
+        for p in self.cache_patches:
+            p.start()
+            self.addCleanup(p.stop)
+        
+        first_task = self.download()
+        self.assertEqual(s3_retrieve_to_file.call_count, 3)
+        second_task = self.download()
+        self.assertEqual(s3_retrieve_to_file.call_count, 3)
+        self.assertEqual(second_task.download_cache_hits, 3)
+        self.assertEqual(second_task.downloaded_bytes, first_task.downloaded_bytes)
+        self.assertEqual(self.input_files(first_task), self.input_files(second_task))
+
+
+class TestIncrementalTasks(CommonTestCase):
+    
+    def generate_chunk(self, day: date, last_updated: datetime):
+        chunk = self.generate_chunkregistry(
+            self.session_study,
+            self.default_participant,
+            GPS,
+            time_bin=datetime.combine(day, MIN_TIME, self.session_study.timezone) + timedelta(hours=12),
+        )
+        ChunkRegistry.objects.filter(pk=chunk.pk).update(last_updated=last_updated)
+    
+    def get_time_range(self, task: ForestTask) -> Tuple[datetime, datetime]:
+        tz = self.session_study.timezone
+        return (
+            datetime.combine(task.data_date_start, MIN_TIME, tz),
+            datetime.combine(task.data_date_end, MAX_TIME, tz),
+        )
+    
+    def get_stale_dates(self, task: ForestTask) -> List[date]:
+        return get_stale_dates(task, *self.get_time_range(task))
+    
+    def test_get_stale_dates(self):
+        day_1, day_2, day_3, day_4 = (date(2024, 1, i) for i in range(1, 5))
+        previous_run = datetime(2024, 2, 1, tzinfo=UTC)
+        previous_task = self.generate_forest_task(data_date_start=day_1, data_date_end=day_4)
+        previous_task.update_only(status=ForestTaskStatus.success, process_start_time=previous_run)
+        # days 1 and 2 were computed by the previous task, day 3 was not (forest output nothing),
+        # day 4 has no data.
+        for day in (day_1, day_2, day_4):
+            self.generate_summary_statistic_daily(a_date=day)
+        SummaryStatisticDaily.objects.update(jasmine_task=previous_task)
+        self.generate_chunk(day_1, previous_run - timedelta(days=1))
+        self.generate_chunk(day_2, previous_run - timedelta(days=1))
+        self.generate_chunk(day_2, previous_run + timedelta(days=1))  # new data
+        self.generate_chunk(day_3, previous_run - timedelta(days=1))
+        
+        task = self.generate_forest_task(data_date_start=day_1, data_date_end=day_4, incremental=True)
+        self.assertEqual(self.get_stale_dates(task), [day_2, day_3])
+        
+        # outputs of failed tasks are never trusted
+        previous_task.update_only(status=ForestTaskStatus.error)
+        self.assertEqual(self.get_stale_dates(task), [day_1, day_2, day_3])
+    
+    @patch("services.celery_forest.clean_up_files")
+    @patch("services.celery_forest.upload_cache_files")
+    @patch("services.celery_forest.run_forest")
+    @patch("services.celery_forest.download_data")
+    def test_run_forest_task_narrows_to_stale_dates(
+        self, download_data: MagicMock, run_forest: MagicMock, *_: MagicMock
+    ):
+        task = self.generate_forest_task(
+            data_date_start=date(2024, 1, 1), data_date_end=date(2024, 1, 31), incremental=True
+        )
+        # nothing to do
+        run_forest_task(task, *self.get_time_range(task))
+        download_data.assert_not_called()
+        task.refresh_from_db()
+        self.assertEqual(task.status, ForestTaskStatus.success)
+        self.assertEqual(task.stale_date_count, 0)
+        
+        self.generate_chunk(date(2024, 1, 10), timezone.now())
+        self.generate_chunk(date(2024, 1, 12), timezone.now())
+        run_forest_task(task, *self.get_time_range(task))
+        stale_dates = [date(2024, 1, 10), date(2024, 1, 12)]
+        self.assertEqual(download_data.call_args.args[3], stale_dates)
+        self.assertEqual(run_forest.call_args.args[1], stale_dates)
+        task.refresh_from_db()
+        self.assertEqual(task.stale_date_count, 2)
+        # the requested dates are kept, Forest runs on the stale dates
+        self.assertEqual(task.data_date_start, date(2024, 1, 1))
+        self.assertEqual(task.data_date_end, date(2024, 1, 31))
+        self.assertEqual(task.stale_date_start, date(2024, 1, 10))
+        self.assertEqual(task.stale_date_end, date(2024, 1, 12))
+        params = {}
+        task.handle_tree_specific_date_params(params)
+        self.assertEqual(params["time_start"][:3], [2024, 1, 10])
+        self.assertEqual(params["time_end"][:3], [2024, 1, 13])
+    
+    def test_dates_to_time_ranges(self):
+        tz = self.session_study.timezone
+        dates = [date(2024, 1, 1), date(2024, 1, 2), date(2024, 1, 3), date(2024, 1, 5)]
+        self.assertEqual(
+            dates_to_time_ranges(dates, tz),
+            [
+                (datetime(2024, 1, 1, tzinfo=tz), datetime.combine(date(2024, 1, 3), MAX_TIME, tz)),
+                (datetime(2024, 1, 5, tzinfo=tz), datetime.combine(date(2024, 1, 5), MAX_TIME, tz)),
+            ]
+        )
+
+
+@patch("services.celery_forest.enqueue_forest_task")
+class TestForestDispatcher(CommonTestCase):
+    
+    def dispatched_task_ids(self, enqueue_forest_task: MagicMock) -> List[int]:
+        return [call.kwargs["args"][0] for call in enqueue_forest_task.call_args_list]
+    
+    def test_one_task_per_participant_and_tree(self, enqueue_forest_task: MagicMock):
+        other_participant = self.generate_participant(self.session_study)
+        older = self.generate_forest_task(data_date_start=date(2024, 1, 1), data_date_end=date(2024, 1, 1))
+        newer = self.generate_forest_task(data_date_start=date(2024, 2, 1), data_date_end=date(2024, 2, 1))
+        willow = self.generate_forest_task(forest_tree=ForestTree.willow)
+        other = self.generate_forest_task(participant=other_participant)
+        blocked = self.generate_forest_task(participant=other_participant, forest_tree=ForestTree.willow)
+        self.generate_forest_task(participant=other_participant, forest_tree=ForestTree.willow) \
+            .update_only(status=ForestTaskStatus.running)
+        
+        create_forest_celery_tasks()
+        dispatched = self.dispatched_task_ids(enqueue_forest_task)
+        self.assertCountEqual(dispatched, [newer.id, willow.id, other.id])
+        self.assertNotIn(older.id, dispatched)
+        self.assertNotIn(blocked.id, dispatched)
+    
+    def test_max_concurrent_tasks(self, enqueue_forest_task: MagicMock):
+        for tree in (ForestTree.jasmine, ForestTree.willow, ForestTree.oak):
+            self.generate_forest_task(forest_tree=tree)
+        self.generate_forest_task(forest_tree=ForestTree.sycamore).update_only(status=ForestTaskStatus.running)
+        with patch("services.celery_forest.FOREST_MAX_CONCURRENT_TASKS", 3):
+            create_forest_celery_tasks()
+        self.assertEqual(enqueue_forest_task.call_count, 2)
+    
+    def test_input_size_estimate(self, enqueue_forest_task: MagicMock):
+        task = self.generate_forest_task(data_date_start=date(2024, 1, 1), data_date_end=date(2024, 1, 1))
+        for file_size in (100, 200):
+            self.generate_chunkregistry(
+                self.session_study,
+                self.default_participant,
+                GPS,
+                time_bin=datetime.combine(date(2024, 1, 1), MIN_TIME, self.session_study.timezone),
+                file_size=file_size,
+            )
+        create_forest_celery_tasks()
+        task.refresh_from_db()
+        self.assertEqual(task.total_file_size, 300)
+    
+    @patch("services.celery_forest.shutil.disk_usage")
+    @patch("services.celery_forest.os.getloadavg")
+    @patch("services.celery_forest.os.cpu_count", return_value=4)
+    def test_node_admission(
+        self, cpu_count: MagicMock, getloadavg: MagicMock, disk_usage: MagicMock, _: MagicMock
+    ):
+        task = self.default_forest_task
+        task.update_only(total_file_size=1024 * 1024 * 1024)
+        getloadavg.return_value = (4.0, 0, 0)
+        disk_usage.return_value = SimpleNamespace(free=10 * 1024 * 1024 * 1024)
+        with patch("services.celery_forest.FOREST_NODE_MAX_LOAD", 2.0), \
+                patch("services.celery_forest.FOREST_NODE_MIN_FREE_DISK_MB", 1024):
+            self.assertIsNone(get_node_admission_error(task))
+            getloadavg.return_value = (12.0, 0, 0)
+            self.assertIn("load average", get_node_admission_error(task))
+            getloadavg.return_value = (4.0, 0, 0)
+            disk_usage.return_value = SimpleNamespace(free=1.5 * 1024 * 1024 * 1024)
+            self.assertIn("free disk space", get_node_admission_error(task))
+    
+    @patch("services.celery_forest.run_forest_task")
+    @patch("services.celery_forest.get_node_admission_error", return_value="too busy")
+    def test_busy_node_leaves_task_queued(
+        self, get_node_admission_error: MagicMock, run_forest_task: MagicMock, _: MagicMock
+    ):
+        task = self.default_forest_task
+        celery_run_forest.an_function(task.id)
+        run_forest_task.assert_not_called()
+        task.refresh_from_db()
+        self.assertEqual(task.status, ForestTaskStatus.queued)
+        
+        get_node_admission_error.return_value = None
+        celery_run_forest.an_function(task.id)
+        run_forest_task.assert_called_once()
+        task.refresh_from_db()
+        self.assertEqual(task.status, ForestTaskStatus.running)
@@ -482,6 +482,14 @@ class TestDowntime(BasicSessionTestCase):
             raise
         finally:
             logging.getLogger("django.request").setLevel(previous_logging_level)
+    
+    def test_downtime_setting_is_cached(self):
+        GlobalSettings.get_cached_singleton_instance()
+        with self.assertNumQueries(0):
+            self.assertFalse(GlobalSettings.get_cached_singleton_instance().downtime_enabled)
+        # saving in this process clears the cache
+        GlobalSettings.get_singleton_instance().update(downtime_enabled=True)
+        self.assertTrue(GlobalSettings.get_cached_singleton_instance().downtime_enabled)
 
 
 class TestResearcherRedirectionLogic(BasicSessionTestCase):
@@ -12,6 +12,7 @@ from constants.message_strings import (API_KEY_IS_DISABLED, MFA_CODE_6_DIGITS, M
 from constants.security_constants import MFA_CREATED
 from constants.testing_constants import ADMIN_ROLES
 from constants.user_constants import ALL_RESEARCHER_TYPES, EXPIRY_NAME, ResearcherRole
+from database.data_access_models import DataDownloadSession
 from database.profiling_models import DataAccessRecord
 from database.security_models import ApiKey
 from database.study_models import Study
@@ -448,7 +449,7 @@ class TestAdministratorDeleteResearcher(ResearcherSessionTest):
         # first assert that this is actually all the relations:
         self.assertEqual(
             [obj.related_model.__name__ for obj in Researcher._meta.related_objects],
-            ['StudyRelation', 'ResearcherSession', 'DataAccessRecord', 'ApiKey']
+            ['StudyRelation', 'ResearcherSession', 'DataAccessRecord', 'DataDownloadSession', 'ApiKey']
         )
         # we need the test to succeed...
         self.set_session_study_relation(ResearcherRole.site_admin)
@@ -464,6 +465,10 @@ class TestAdministratorDeleteResearcher(ResearcherSessionTest):
         record = DataAccessRecord.objects.create(
             researcher=r2, query_params="test_junk", username=r2.username
         )
+        DataDownloadSession.objects.create(
+            researcher=r2, study=self.default_study, total_files=0, total_bytes=0,
+            sync_cursor=timezone.now(), expires_on=timezone.now(),
+        )
         # for tests after deletion
         relation_id = r2.study_relations.get().id
         default_study_id = self.default_study.id
@@ -477,6 +482,8 @@ class TestAdministratorDeleteResearcher(ResearcherSessionTest):
         # and assert that the DataAccessRecord is still there with a null researcher and a username.
         self.assertTrue(DataAccessRecord.objects.filter(id=record.id).exists())
         self.assertTrue(ApiKey.objects.exists())
+        # download sessions are deleted
+        self.assertFalse(DataDownloadSession.objects.exists())
         record.refresh_from_db()
         self.assertIsNone(record.researcher)
         self.assertEqual(record.username, r2.username)
@@ -6,6 +6,8 @@ from unittest.mock import MagicMock, patch
 
 import time_machine
 from dateutil import tz
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from constants.common_constants import BEIWE_PROJECT_ROOT
@@ -16,6 +18,7 @@ from constants.study_constants import (ABOUT_PAGE_TEXT, CONSENT_FORM_TEXT, DEFAU
 from constants.testing_constants import MIDNIGHT_EVERY_DAY, THURS_OCT_6_NOON_2022_NY
 from database.data_access_models import FileToProcess
 from database.schedule_models import AbsoluteSchedule, ScheduledEvent, WeeklySchedule
+from database.survey_models import Survey
 from database.system_models import GenericEvent
 from database.user_models_participant import AppHeartbeats, AppVersionHistory, ParticipantFCMHistory
 from libs.rsa import get_RSA_cipher
@@ -218,6 +221,48 @@ class TestGetLatestSurveys(ParticipantSessionTest):
         output_survey = json.loads(resp.content.decode())
         self.assertEqual(output_survey, reference_output)
     
+    def test_survey_payload_cache_invalidated_by_survey_edits(self):
+        self.default_survey
+        resp = self.smart_post_status_code(200)
+        self.assertEqual(json.loads(resp.content.decode()), self.BASIC_SURVEY_CONTENT)
+        # the cached payload must reflect new weekly schedules and survey saves
+        WeeklySchedule.create_weekly_schedules(MIDNIGHT_EVERY_DAY(), self.default_survey)
+        self.default_survey.update(name="a new name")
+        reference_output = self.BASIC_SURVEY_CONTENT
+        reference_output[0]["timings"] = MIDNIGHT_EVERY_DAY()
+        reference_output[0]["name"] = "a new name"
+        resp = self.smart_post_status_code(200)
+        self.assertEqual(json.loads(resp.content.decode()), reference_output)
+        # and deleting the survey removes it
+        self.default_survey.update(deleted=True)
+        resp = self.smart_post_status_code(200)
+        self.assertEqual(resp.content, b"[]")
+    
+    @time_machine.travel(THURS_OCT_6_NOON_2022_NY)
+    def test_query_count_does_not_scale_with_surveys(self):
+        def add_survey_with_absolute_schedule_event():
+            survey = self.generate_survey(self.default_study, Survey.TRACKING_SURVEY)
+            self.generate_absolute_schedule(timezone.now().date(), survey=survey, hour=14)
+            repopulate_absolute_survey_schedule_events(survey, self.default_participant)
+        
+        def count_queries():
+            self.smart_post_status_code(200)  # populates the study-level cache
+            with CaptureQueriesContext(connection) as queries:
+                resp = self.smart_post_status_code(200)
+            return len(queries.captured_queries), json.loads(resp.content.decode())
+        
+        add_survey_with_absolute_schedule_event()
+        one_survey_query_count, surveys = count_queries()
+        self.assertEqual(len(surveys), 1)
+        for _ in range(9):
+            add_survey_with_absolute_schedule_event()
+        ten_surveys_query_count, surveys = count_queries()
+        self.assertEqual(len(surveys), 10)
+        self.assertEqual(one_survey_query_count, ten_surveys_query_count)
+        # thursday is day index 4, 2pm is 50400 seconds into the day.
+        for survey in surveys:
+            self.assertEqual(survey["timings"][4], [50400])
+    
     @time_machine.travel(THURS_OCT_6_NOON_2022_NY)
     def test_absolute_schedule_basics(self):
         # test for absolute surveys that they show up regardless of the day of the week they fall on,
@@ -617,6 +662,13 @@ class TestGetLatestDeviceSettings(ParticipantSessionTest):
         self.assertIsNotNone(p.last_get_latest_device_settings)
         self.assertIsInstance(p.last_get_latest_device_settings, datetime)
     
+    def test_cached_device_settings_invalidated_by_save(self):
+        response = self.smart_post_status_code(200)
+        self.assertTrue(json.loads(response.content.decode())["gps"])
+        self.default_study.device_settings.update(gps=False)
+        response = self.smart_post_status_code(200)
+        self.assertFalse(json.loads(response.content.decode())["gps"])
+    
     def test_deleted_participant(self):
         self.INJECT_DEVICE_TRACKER_PARAMS = False
         self.default_participant.update(deleted=True)
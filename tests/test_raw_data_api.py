@@ -1,13 +1,25 @@
 import json
+import tarfile
+import time
+from datetime import timedelta
+from io import BytesIO
+from typing import List, Tuple
 from unittest.mock import MagicMock, patch
+from zipfile import ZIP_DEFLATED, ZipFile
+
+import zstd
 
 from django.http.response import FileResponse
+from django.utils import timezone
 
 from constants.data_stream_constants import ALL_DATA_STREAMS, SURVEY_TIMINGS
 from constants.testing_constants import EMPTY_ZIP, SIMPLE_FILE_CONTENTS
 from constants.user_constants import ResearcherRole
-from database.data_access_models import ChunkRegistry
+from database.data_access_models import ChunkRegistry, DataDownloadSession
 from database.profiling_models import DataAccessRecord
+from endpoints.raw_data_api import SYNC_CURSOR_HEADER
+from libs.streaming_zip import (COMPRESSION_DEFLATE, COMPRESSION_ZSTD, determine_file_name,
+    TarZstdGenerator, ZipGenerator)
 from tests.common import CommonTestCase, DataApiTest
 from tests.helpers import DummyThreadPool
 
@@ -18,14 +30,14 @@ from tests.helpers import DummyThreadPool
 
 class TestGetData(DataApiTest):
     """ WARNING: there are heisenbugs in debugging the download data api endpoint.
-
+    
     There is a generator that is conditionally present (`handle_database_query`), it can swallow
     errors. As a generater iterating over it consumes it, so printing it breaks the code.
     
     You Must Patch libs.streaming_zip.ThreadPool
         The database connection breaks throwing errors on queries that should succeed.
         The iterator inside the zip file generator generally fails, and the zip file is empty.
-
+    
     You Must Patch libs.streaming_zip.s3_retrieve
         Otherwise s3_retrieve will fail due to the patch is tests.common.
     """
@@ -120,6 +132,54 @@ class TestGetData(DataApiTest):
         threadpool.return_value = DummyThreadPool()
         self._test_data_streams()
     
+    @patch("libs.streaming_zip.ThreadPool")
+    def test_compression(self, threadpool: MagicMock):
+        threadpool.return_value = DummyThreadPool()
+        self.set_session_study_relation(ResearcherRole.researcher)
+        self.smart_post_status_code(400, study_pk=self.session_study.id, compression="bogus")
+        
+        resp: FileResponse = self.smart_post(study_pk=self.session_study.id, compression="zstd")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp["Content-Type"], "application/zstd")
+        self.assertIn("data.tar.zst", resp["Content-Disposition"])
+        tar_bytes = zstd.decompress(b"".join(resp.streaming_content))
+        with tarfile.open(fileobj=BytesIO(tar_bytes)) as tar:
+            self.assertEqual(tar.extractfile("registry").read(), b"{}")
+    
+    @patch("libs.streaming_zip.ThreadPool")
+    @patch("libs.streaming_zip.s3_retrieve")
+    def test_registry_and_sync_cursor(self, s3_retrieve: MagicMock, threadpool: MagicMock):
+        threadpool.return_value = DummyThreadPool()
+        s3_retrieve.return_value = SIMPLE_FILE_CONTENTS
+        self.set_session_study_relation(ResearcherRole.researcher)
+        unchanged = self.generate_chunkregistry(
+            self.session_study, self.default_participant, "accelerometer", path="a.csv"
+        )
+        changed = self.generate_chunkregistry(
+            self.session_study, self.default_participant, "gps", path="b.csv"
+        )
+        registry = {unchanged.chunk_path: unchanged.chunk_hash, changed.chunk_path: "old hash"}
+        
+        def download(**post_params) -> Tuple[FileResponse, List[str]]:
+            resp: FileResponse = self.smart_post(study_pk=self.session_study.id, **post_params)
+            self.assertEqual(resp.status_code, 200)
+            names = ZipFile(BytesIO(b"".join(resp.streaming_content))).namelist()
+            return resp, names
+        
+        # only the changed file is downloaded
+        resp, names = download(registry=json.dumps(registry))
+        self.assertEqual(len(names), 2)
+        self.assertIn("/gps/", names[0])
+        
+        # the cursor is from before the download, and works as the updated_since parameter
+        cursor = resp[SYNC_CURSOR_HEADER]
+        _, names = download(updated_since=cursor)
+        self.assertEqual(len(names), 3)
+        ChunkRegistry.objects.update(last_updated=timezone.now() - timedelta(days=1))
+        _, names = download(updated_since=cursor)
+        self.assertEqual(names, ["registry"])
+        self.smart_post_status_code(400, study_pk=self.session_study.id, updated_since="bogus")
+    
     # but don't patch ThreadPool for this one
     def test_downloads_and_file_naming_heisenbug(self):
         # As far as I can tell the ThreadPool seems to screw up the connection to the test
@@ -452,3 +512,221 @@ class TestGetData(DataApiTest):
         # database cleanup has to be after the iteration over the file contents
         ChunkRegistry.objects.all().delete()
         return b"".join(bytes_list)
+
+
+class TestZipGenerator(CommonTestCase):
+    """ The ZipGenerator's threads only do s3 retrievals, the study lookup happens on the calling
+    thread, so these tests can use a real ThreadPool. """
+    
+    def chunk_dicts(self, count: int, file_size: int = 100):
+        return [
+            {
+                "pk": i,
+                "participant_id": self.default_participant.id,
+                "data_type": "accelerometer",
+                "chunk_path": f"{i}.csv",
+                "time_bin": f"2020-10-05 {i:02}:00:00+00:00",
+                "chunk_hash": "hash",
+                "participant__patient_id": self.default_participant.patient_id,
+                "study_id": self.session_study.id,
+                "survey_id": None,
+                "survey__object_id": None,
+                "file_size": file_size,
+            } for i in range(count)
+        ]
+    
+    @patch("libs.streaming_zip.s3_retrieve")
+    def test_ordered_output_single_study_lookup_and_buffer(self, s3_retrieve: MagicMock):
+        # later files are retrieved faster, output must still be in order.
+        def fake_retrieve(key_path, study, raw_path):
+            time.sleep((24 - int(key_path.split(".")[0])) / 2000)
+            return key_path.encode() * 10
+        s3_retrieve.side_effect = fake_retrieve
+        
+        chunks = self.chunk_dicts(24)
+        generator = ZipGenerator(chunks, construct_registry=False, threads=4, buffer_bytes=300)
+        with self.assertNumQueries(1):
+            zip_bytes = b"".join(generator)
+        
+        names = ZipFile(BytesIO(zip_bytes)).namelist()
+        self.assertEqual(names, [determine_file_name(chunk) for chunk in chunks])
+        # one file may be submitted past the budget
+        self.assertLessEqual(generator.peak_buffered_bytes, 400)
+        stats = generator.stats
+        self.assertEqual(stats["files_retrieved"], 24)
+        self.assertEqual(stats["bytes_retrieved"], sum(len(f"{i}.csv") * 10 for i in range(24)))
+        self.assertEqual(stats["bytes_output"], len(zip_bytes))
+    
+    @patch("libs.streaming_zip.s3_retrieve")
+    def test_deflate_compression(self, s3_retrieve: MagicMock):
+        s3_retrieve.side_effect = lambda key_path, study, raw_path: key_path.encode() * 100
+        chunks = self.chunk_dicts(5)
+        generator = ZipGenerator.for_compression(chunks, True, compression=COMPRESSION_DEFLATE)
+        zip_file = ZipFile(BytesIO(b"".join(generator)))
+        
+        self.assertEqual(
+            zip_file.namelist(), [determine_file_name(chunk) for chunk in chunks] + ["registry"]
+        )
+        for chunk, info in zip(chunks, zip_file.infolist()):
+            self.assertEqual(info.compress_type, ZIP_DEFLATED)
+            self.assertLess(info.compress_size, info.file_size)
+            self.assertEqual(zip_file.read(info), chunk["chunk_path"].encode() * 100)
+    
+    @patch("libs.streaming_zip.s3_retrieve")
+    def test_zstd_compression(self, s3_retrieve: MagicMock):
+        # 513 bytes is one byte over a tar block, exercises the padding.
+        s3_retrieve.side_effect = lambda key_path, study, raw_path: key_path.encode()[:1] * 513
+        chunks = self.chunk_dicts(5)
+        generator = ZipGenerator.for_compression(chunks, True, compression=COMPRESSION_ZSTD)
+        self.assertIsInstance(generator, TarZstdGenerator)
+        output = b"".join(generator)
+        self.assertEqual(generator.stats["bytes_output"], len(output))
+        
+        with tarfile.open(fileobj=BytesIO(zstd.decompress(output))) as tar:
+            self.assertEqual(
+                tar.getnames(), [determine_file_name(chunk) for chunk in chunks] + ["registry"]
+            )
+            for chunk in chunks:
+                file_contents = tar.extractfile(determine_file_name(chunk)).read()
+                self.assertEqual(file_contents, chunk["chunk_path"].encode()[:1] * 513)
+            registry = json.loads(tar.extractfile("registry").read())
+        self.assertEqual(registry, {chunk["chunk_path"]: "hash" for chunk in chunks})
+
+
+class TestCreateDataDownloadSession(DataApiTest):
+    ENDPOINT_NAME = "raw_data_api.create_data_download_session"
+    
+    def test_manifest_and_segments(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        chunks = [
+            self.generate_chunkregistry(
+                self.session_study, self.default_participant, "accelerometer", file_size=10
+            ) for _ in range(5)
+        ]
+        registry = json.dumps({chunks[0].chunk_path: chunks[0].chunk_hash})
+        
+        with patch("endpoints.raw_data_api.DOWNLOAD_SESSION_SEGMENT_FILES", 3):
+            resp = self.smart_post_status_code(
+                200, study_pk=self.session_study.id, registry=registry
+            )
+        manifest = json.loads(resp.content)
+        self.assertEqual(manifest["total_files"], 4)
+        self.assertEqual(manifest["total_bytes"], 40)
+        self.assertEqual(
+            manifest["segments"],
+            [{"segment": 0, "files": 3, "bytes": 30}, {"segment": 1, "files": 1, "bytes": 10}],
+        )
+        
+        session = DataDownloadSession.objects.get()
+        self.assertEqual(str(session.session_id), manifest["session_id"])
+        self.assertEqual(
+            list(session.segments.order_by("segment").values_list("first_pk", "last_pk")),
+            [(chunks[1].pk, chunks[3].pk), (chunks[4].pk, chunks[4].pk)],
+        )
+        # only the registry entries that excluded a chunk are kept
+        self.assertEqual(json.loads(session.registry), json.loads(registry))
+        self.assertEqual(DataAccessRecord.objects.count(), 1)
+    
+    def test_empty_session(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        resp = self.smart_post_status_code(200, study_pk=self.session_study.id)
+        manifest = json.loads(resp.content)
+        self.assertEqual(manifest["segments"], [])
+        self.assertEqual(manifest["total_files"], 0)
+    
+    def test_bad_query(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        self.smart_post_status_code(400, study_pk=self.session_study.id, registry="[]")
+        self.assertFalse(DataDownloadSession.objects.exists())
+
+
+class TestGetDataDownloadSessionSegment(DataApiTest):
+    ENDPOINT_NAME = "raw_data_api.get_data_download_session_segment"
+    
+    def create_session(self, segments: List[Tuple[int, int]], **kwargs) -> DataDownloadSession:
+        session = DataDownloadSession.objects.create(
+            study=self.session_study,
+            researcher=self.session_researcher,
+            data_types=json.dumps(kwargs.get("data_types", [])),
+            registry=json.dumps(kwargs.get("registry", {})),
+            total_files=0,
+            total_bytes=0,
+            sync_cursor=timezone.now(),
+            expires_on=kwargs.get("expires_on", timezone.now() + timedelta(days=1)),
+        )
+        for i, (first_pk, last_pk) in enumerate(segments):
+            session.segments.create(segment=i, first_pk=first_pk, last_pk=last_pk, files=0, bytes=0)
+        return session
+    
+    @patch("libs.streaming_zip.ThreadPool")
+    @patch("libs.streaming_zip.s3_retrieve")
+    def test_segments(self, s3_retrieve: MagicMock, threadpool: MagicMock):
+        threadpool.return_value = DummyThreadPool()
+        s3_retrieve.return_value = SIMPLE_FILE_CONTENTS
+        self.set_session_study_relation(ResearcherRole.researcher)
+        chunks = [
+            self.generate_chunkregistry(
+                self.session_study, self.default_participant, "accelerometer",
+                time_bin=timezone.now() - timedelta(hours=i),
+            ) for i in range(3)
+        ]
+        session = self.create_session([(chunks[0].pk, chunks[1].pk), (chunks[2].pk, chunks[2].pk)])
+        
+        # segments can be downloaded repeatedly and in any order
+        for segment, expected_chunks in [(1, [chunks[2]]), (0, chunks[:2]), (1, [chunks[2]])]:
+            resp: FileResponse = self.smart_post(
+                study_pk=self.session_study.id, session_id=str(session.session_id), segment=segment
+            )
+            self.assertEqual(resp.status_code, 200)
+            zip_file = ZipFile(BytesIO(b"".join(resp.streaming_content)))
+            self.assertEqual(len(zip_file.namelist()), len(expected_chunks) + 1)
+            self.assertEqual(
+                json.loads(zip_file.read("registry")),
+                {chunk.chunk_path: chunk.chunk_hash for chunk in expected_chunks},
+            )
+    
+    @patch("libs.streaming_zip.ThreadPool")
+    @patch("libs.streaming_zip.s3_retrieve")
+    def test_segment_applies_query_and_registry(self, s3_retrieve: MagicMock, threadpool: MagicMock):
+        threadpool.return_value = DummyThreadPool()
+        s3_retrieve.return_value = SIMPLE_FILE_CONTENTS
+        self.set_session_study_relation(ResearcherRole.researcher)
+        registered, included = [
+            self.generate_chunkregistry(
+                self.session_study, self.default_participant, "accelerometer",
+                time_bin=timezone.now() - timedelta(hours=i),
+            ) for i in range(2)
+        ]
+        # in the pk range, but not in the query
+        self.generate_chunkregistry(self.session_study, self.default_participant, "gps")
+        session = self.create_session(
+            [(registered.pk, ChunkRegistry.objects.latest("pk").pk)],
+            data_types=["accelerometer"],
+            registry={registered.chunk_path: registered.chunk_hash},
+        )
+        resp: FileResponse = self.smart_post(
+            study_pk=self.session_study.id, session_id=str(session.session_id), segment=0
+        )
+        self.assertEqual(resp.status_code, 200)
+        zip_file = ZipFile(BytesIO(b"".join(resp.streaming_content)))
+        self.assertEqual(
+            json.loads(zip_file.read("registry")), {included.chunk_path: included.chunk_hash}
+        )
+    
+    def test_bad_sessions_and_segments(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        session = self.create_session([(0, 0)])
+        expired = self.create_session([(0, 0)], expires_on=timezone.now() - timedelta(seconds=1))
+        session_id = str(session.session_id)
+        self.smart_post_status_code(400, study_pk=self.session_study.id, session_id="abc", segment=0)
+        self.smart_post_status_code(
+            404, study_pk=self.session_study.id, session_id=str(expired.session_id), segment=0
+        )
+        self.smart_post_status_code(400, study_pk=self.session_study.id, session_id=session_id)
+        self.smart_post_status_code(
+            404, study_pk=self.session_study.id, session_id=session_id, segment=1
+        )
+        self.smart_post_status_code(
+            400, study_pk=self.session_study.id, session_id=session_id, segment=0,
+            compression="bogus"
+        )
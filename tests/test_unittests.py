@@ -1,30 +1,47 @@
 # trunk-ignore-all(ruff/B018)
 # trunk-ignore-all(ruff/E701)
+import os
 import time
 import unittest
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from tempfile import TemporaryDirectory
 from typing import Optional
 from unittest.mock import MagicMock, patch
 
 import dateutil
+from cronutils.error_handler import ErrorHandler
 from dateutil.tz import gettz
 from django.utils import timezone
 
+from constants.data_stream_constants import ACCELEROMETER, GPS
 from constants.schedule_constants import EMPTY_WEEKLY_SURVEY_TIMINGS
 from constants.testing_constants import MIDNIGHT_EVERY_DAY
 from constants.user_constants import ACTIVE_PARTICIPANT_FIELDS
-from database.data_access_models import IOSDecryptionKey
+from database.data_access_models import ChunkRegistry, IOSDecryptionKey
+from database.forest_models import DataQuantityRollup, SummaryStatisticDaily
 from database.profiling_models import EncryptionErrorMetadata, LineEncryptionError, UploadTracking
-from database.schedule_models import BadWeeklyCount, WeeklySchedule
+from database.schedule_models import (AbsoluteSchedule, BadWeeklyCount, ScheduledEvent,
+    WeeklySchedule)
 from database.user_models_participant import (AppHeartbeats, AppVersionHistory,
     DeviceStatusReportHistory, Participant, ParticipantActionLog, ParticipantDeletionEvent,
     PushNotificationDisabledEvent)
+from libs import chunk_cache
+from libs.aes import decrypt_server_stream, encrypt_for_server
+from libs.chunk_cache import (cache_chunk, cache_chunk_file, copy_cached_chunk, discard_cached_chunk,
+    discard_cached_chunks_by_prefix, get_cached_chunk, get_last_sweep_time, set_last_sweep_time)
+from libs.chunk_registry_partitions import (chunk_registry_is_partitioned,
+    create_future_partitions, delete_chunk_registries_by_month, month_start, months_to_partition,
+    next_month, partition_upper_bound)
+from libs.endpoint_helpers.dashboard_helpers import build_dashboard_byte_matrix
 from libs.endpoint_helpers.participant_table_helpers import determine_registered_status
+from libs.file_processing.data_qty_stats import apply_data_quantity_deltas
+from libs.file_processing.file_processing_core import FileProcessingTracker
 from libs.file_processing.utility_functions_simple import BadTimecodeError, binify_from_timecode
 from libs.participant_purge import (confirm_deleted, get_all_file_path_prefixes,
-    run_next_queued_participant_data_deletion)
+    run_next_queued_participant_data_deletion, sweep_purged_cached_chunks)
 from libs.schedules import (export_weekly_survey_timings, get_next_weekly_event_and_schedule,
-    NoSchedulesException)
+    NoSchedulesException, repopulate_absolute_survey_schedule_events,
+    repopulate_weekly_survey_schedule_events)
 from libs.utils.forest_utils import get_forest_git_hash
 from tests.common import CommonTestCase
 
@@ -56,7 +73,7 @@ def data_purge_mock_s3_calls(func):
 
 
 class TestTimingsSchedules(CommonTestCase):
-    
+
     def test_immutable_defaults(self):
         # assert that this variable creates lists anew.
         self.assertIsNot(EMPTY_WEEKLY_SURVEY_TIMINGS(), EMPTY_WEEKLY_SURVEY_TIMINGS())
@@ -153,6 +170,61 @@ class TestTimingsSchedules(CommonTestCase):
         duplicates = WeeklySchedule.create_weekly_schedules(timings, self.default_survey)
         self.assertTrue(duplicates)
         self.assertEqual(WeeklySchedule.objects.count(), 7)
+    
+    def test_create_weekly_schedules_keeps_unchanged_schedules(self):
+        WeeklySchedule.create_weekly_schedules(MIDNIGHT_EVERY_DAY(), self.default_survey)
+        monday = WeeklySchedule.objects.get(day_of_week=1)
+        timings = MIDNIGHT_EVERY_DAY()
+        timings[0] = [3600]
+        WeeklySchedule.create_weekly_schedules(timings, self.default_survey)
+        self.assertEqual(WeeklySchedule.objects.count(), 7)
+        self.assertTrue(WeeklySchedule.objects.filter(pk=monday.pk).exists())
+        self.assertEqual(WeeklySchedule.objects.get(day_of_week=0).hour, 1)
+    
+    def test_repopulate_weekly_keeps_existing_events(self):
+        self.default_participant
+        self.generate_weekly_schedule(self.default_survey, day_of_week=3)
+        repopulate_weekly_survey_schedule_events(self.default_survey)
+        event = ScheduledEvent.objects.get()
+        repopulate_weekly_survey_schedule_events(self.default_survey)
+        self.assertEqual(
+            list(ScheduledEvent.objects.values_list("pk", "uuid")), [(event.pk, event.uuid)]
+        )
+        
+        # a deleted participant's events are removed
+        self.default_participant.update(deleted=True)
+        repopulate_weekly_survey_schedule_events(self.default_survey)
+        self.assertEqual(ScheduledEvent.objects.count(), 0)
+    
+    def test_repopulate_absolute_only_changes_the_difference(self):
+        self.default_participant
+        tomorrow = timezone.now().date() + timedelta(days=1)
+        kept = self.generate_absolute_schedule(tomorrow, hour=10)
+        removed = self.generate_absolute_schedule(tomorrow, hour=11)
+        repopulate_absolute_survey_schedule_events(self.default_survey)
+        kept_event = ScheduledEvent.objects.get(absolute_schedule=kept)
+        self.assertEqual(ScheduledEvent.objects.count(), 2)
+        
+        AbsoluteSchedule.objects.filter(pk=removed.pk).update(hour=12)
+        repopulate_absolute_survey_schedule_events(self.default_survey)
+        self.assertEqual(ScheduledEvent.objects.count(), 2)
+        self.assertTrue(ScheduledEvent.objects.filter(pk=kept_event.pk).exists())
+        self.assertEqual(
+            ScheduledEvent.objects.get(absolute_schedule=removed).scheduled_time.hour, 12
+        )
+    
+    def test_repopulate_absolute_skips_sent_events(self):
+        tomorrow = timezone.now().date() + timedelta(days=1)
+        schedule = self.generate_absolute_schedule(tomorrow, hour=10)
+        self.generate_participant(self.default_study, "patient2")
+        self.generate_archived_event(
+            self.default_survey, self.default_participant, scheduled_time=schedule.event_time
+        )
+        repopulate_absolute_survey_schedule_events(self.default_survey)
+        self.assertEqual(
+            list(ScheduledEvent.objects.values_list("participant__patient_id", flat=True)),
+            ["patient2"],
+        )
 
 
 class TestBinifyFromTimecode(unittest.TestCase):
@@ -183,7 +255,7 @@ class TestBinifyFromTimecode(unittest.TestCase):
 
 
 class TestParticipantDataDeletion(CommonTestCase):
-    
+
     def assert_default_participant_end_state(self):
         self.default_participant.refresh_from_db()
         self.assertEqual(self.default_participant.deleted, True)
@@ -307,7 +379,52 @@ class TestParticipantDataDeletion(CommonTestCase):
         self.assert_confirm_deletion_raises_then_reset_last_updated
         run_next_queued_participant_data_deletion()
         confirm_deleted(self.default_participant_deletion_event)  # errors means test failure
-        
+    
+    @data_purge_mock_s3_calls
+    def test_purge_discards_cached_chunks(self):
+        self.default_participant_deletion_event
+        chunk = self.default_chunkregistry
+        with TemporaryDirectory() as temp_dir, \
+                patch("libs.chunk_cache.CHUNK_CACHE_FOLDER", temp_dir), \
+                patch("libs.chunk_cache._cache_size", None):
+            cache_chunk(chunk.chunk_path, chunk.chunk_hash, b"content")
+            cache_chunk("some/other/chunk", chunk.chunk_hash, b"content")
+            self.assertEqual(get_cached_chunk(chunk.chunk_path, chunk.chunk_hash), b"content")
+            run_next_queued_participant_data_deletion()
+            self.assertIsNone(get_cached_chunk(chunk.chunk_path, chunk.chunk_hash))
+            self.assertEqual(get_cached_chunk("some/other/chunk", chunk.chunk_hash), b"content")
+    
+    @data_purge_mock_s3_calls
+    def test_purge_is_swept_from_the_caches_of_other_servers(self):
+        self.default_participant_deletion_event
+        _, _, chunks_prefix, _ = get_all_file_path_prefixes(self.default_participant)
+        chunk = self.generate_chunkregistry(
+            self.session_study, self.default_participant, GPS, path=chunks_prefix + "gps/1.csv"
+        )
+        with TemporaryDirectory() as this_server, TemporaryDirectory() as other_server, \
+                patch("libs.chunk_cache._cache_size", None):
+            # another server cached the participant's data
+            with patch("libs.chunk_cache.CHUNK_CACHE_FOLDER", other_server):
+                sweep_purged_cached_chunks()  # nothing to do before the purge
+                cache_chunk(chunk.chunk_path, chunk.chunk_hash, b"content")
+                cache_chunk("some/other/chunk", chunk.chunk_hash, b"content")
+            
+            # the purge runs on this server
+            with patch("libs.chunk_cache.CHUNK_CACHE_FOLDER", this_server):
+                run_next_queued_participant_data_deletion()
+            
+            with patch("libs.chunk_cache.CHUNK_CACHE_FOLDER", other_server):
+                self.assertEqual(get_cached_chunk(chunk.chunk_path, chunk.chunk_hash), b"content")
+                sweep_purged_cached_chunks()
+                self.assertIsNone(get_cached_chunk(chunk.chunk_path, chunk.chunk_hash))
+                self.assertEqual(get_cached_chunk("some/other/chunk", chunk.chunk_hash), b"content")
+                
+                # later sweeps only check deletion events updated since the last sweep
+                set_last_sweep_time(timezone.now() + timedelta(hours=1))
+                cache_chunk(chunk.chunk_path, chunk.chunk_hash, b"content")
+                sweep_purged_cached_chunks()
+                self.assertEqual(get_cached_chunk(chunk.chunk_path, chunk.chunk_hash), b"content")
+    
     @data_purge_mock_s3_calls
     def test_confirm_SummaryStatisticDaily(self):
         self.default_summary_statistic_daily
@@ -315,6 +432,14 @@ class TestParticipantDataDeletion(CommonTestCase):
         run_next_queued_participant_data_deletion()
         confirm_deleted(self.default_participant_deletion_event)
     
+    @data_purge_mock_s3_calls
+    def test_confirm_DataQuantityRollup(self):
+        self.default_summary_statistic_daily  # creates the rollups
+        self.assertTrue(self.default_participant.data_quantity_rollups.exists())
+        self.assert_confirm_deletion_raises_then_reset_last_updated
+        run_next_queued_participant_data_deletion()
+        confirm_deleted(self.default_participant_deletion_event)
+    
     @data_purge_mock_s3_calls
     def test_confirm_LineEncryptionError(self):
         LineEncryptionError.objects.create(
@@ -415,7 +540,7 @@ class TestParticipantDataDeletion(CommonTestCase):
         self.assert_confirm_deletion_raises_then_reset_last_updated
         run_next_queued_participant_data_deletion()
         confirm_deleted(self.default_participant_deletion_event)
-        
+    
     @data_purge_mock_s3_calls
     def test_confirm_ParticipantActionLog(self):
         # this test is weird, we create an action log inside the deletion event.
@@ -453,7 +578,7 @@ class TestParticipantDataDeletion(CommonTestCase):
 
 
 class TestParticipantTimeZone(CommonTestCase):
-    
+
     def test_defaults(self):
         # test the default is applied
         self.assertEqual(self.default_participant.timezone_name, "America/New_York")
@@ -530,6 +655,20 @@ class TestParticipantTimeZone(CommonTestCase):
         self.assertIs(p.timezone, gettz("America/Los_Angeles"))
         self.assertEqual(p.unknown_timezone, False)
         self.assertEqual(p.last_updated, last_update)
+    
+    @patch("database.schedule_models.ScheduledEvent.update_fire_times")
+    def test_fire_times_only_updated_when_timezone_changes(self, update_fire_times: MagicMock):
+        p = self.default_participant
+        p.try_set_timezone("America/New_York")  # clears unknown_timezone, a change
+        self.assertEqual(update_fire_times.call_count, 1)
+        p.try_set_timezone("America/New_York")
+        self.assertEqual(update_fire_times.call_count, 1)
+        p.try_set_timezone("America/Los_Angeles")
+        self.assertEqual(update_fire_times.call_count, 2)
+        p.try_set_timezone("a bad string")
+        self.assertEqual(update_fire_times.call_count, 3)
+        p.try_set_timezone("a bad string")
+        self.assertEqual(update_fire_times.call_count, 3)
 
 
 class TestParticipantActive(CommonTestCase):
@@ -610,3 +749,350 @@ class TestForestHash(unittest.TestCase):
     def test_get_forest_git_hash(self):
         hash = get_forest_git_hash()
         self.assertNotEqual(hash, "")
+
+
+class TestChunkCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = TemporaryDirectory()
+        self.patches = [
+            patch("libs.chunk_cache.CHUNK_CACHE_FOLDER", self.temp_dir.name),
+            patch("libs.chunk_cache.CHUNK_CACHE_MAX_MB", 1),
+            patch("libs.chunk_cache._cache_size", None),
+        ]
+        for p in self.patches:
+            p.start()
+        return super().setUp()
+    
+    def tearDown(self) -> None:
+        for p in self.patches:
+            p.stop()
+        self.temp_dir.cleanup()
+        return super().tearDown()
+    
+    def test_disabled(self):
+        with patch("libs.chunk_cache.CHUNK_CACHE_FOLDER", ""):
+            cache_chunk("path", "hash", b"content")
+            self.assertIsNone(get_cached_chunk("path", "hash"))
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+    
+    def test_keyed_by_path_and_hash(self):
+        self.assertIsNone(get_cached_chunk("path", "hash"))
+        cache_chunk("path", "hash", b"content")
+        self.assertEqual(get_cached_chunk("path", "hash"), b"content")
+        # a rewritten chunk has a new hash
+        self.assertIsNone(get_cached_chunk("path", "new/hash+=="))
+        self.assertIsNone(get_cached_chunk("other_path", "hash"))
+        # no hash (e.g. legacy data), no caching
+        cache_chunk("path", "", b"content")
+        self.assertIsNone(get_cached_chunk("path", ""))
+    
+    def test_discard(self):
+        cache_chunk("path", "hash", b"content")
+        cache_chunk("path", "hash2", b"content2")
+        cache_chunk("other_path", "hash", b"content")
+        discard_cached_chunk("path")
+        discard_cached_chunk("never_cached")
+        self.assertIsNone(get_cached_chunk("path", "hash"))
+        self.assertIsNone(get_cached_chunk("path", "hash2"))
+        self.assertEqual(get_cached_chunk("other_path", "hash"), b"content")
+        self.assertEqual(chunk_cache._cache_size, len(b"content"))
+    
+    def test_discard_by_prefix(self):
+        cache_chunk("study/patient1/gps/1.csv", "hash", b"content")
+        cache_chunk("study/patient1/gps/1.csv", "hash2", b"content")
+        cache_chunk("study/patient10/gps/1.csv", "hash", b"content")
+        # a file cached without a record of its chunk path
+        os.makedirs(os.path.join(self.temp_dir.name, "legacy"))
+        with open(os.path.join(self.temp_dir.name, "legacy", "file"), "wb") as f:
+            f.write(b"content")
+        
+        self.assertEqual(discard_cached_chunks_by_prefix(["study/patient1/"]), 3)
+        self.assertIsNone(get_cached_chunk("study/patient1/gps/1.csv", "hash"))
+        self.assertEqual(get_cached_chunk("study/patient10/gps/1.csv", "hash"), b"content")
+        self.assertEqual(os.listdir(os.path.join(self.temp_dir.name, "legacy")), [])
+        # the chunk can be cached again
+        cache_chunk("study/patient1/gps/1.csv", "hash", b"content")
+        self.assertEqual(discard_cached_chunks_by_prefix(["study/patient1/"]), 1)
+    
+    def test_last_sweep_time(self):
+        self.assertIsNone(get_last_sweep_time())
+        now = datetime(2024, 1, 1, 12, tzinfo=dateutil.tz.UTC)
+        set_last_sweep_time(now)
+        self.assertEqual(get_last_sweep_time(), now)
+        # not a cache folder
+        cache_chunk("path", "hash", b"content")
+        self.assertEqual(discard_cached_chunks_by_prefix(["path"]), 1)
+        self.assertEqual(get_last_sweep_time(), now)
+    
+    def test_least_recently_used_eviction(self):
+        contents = b"x" * int(1024 * 1024 * 0.3)
+        cache_chunk("a", "hash", contents)
+        cache_chunk("b", "hash", contents)
+        # set the modification times into the past, then use a, so b is the least recently used.
+        for folder in os.scandir(self.temp_dir.name):
+            for entry in os.scandir(folder.path):
+                os.utime(entry.path, (time.time() - 100, time.time() - 100))
+        get_cached_chunk("a", "hash")
+        cache_chunk("c", "hash", contents)
+        cache_chunk("d", "hash", contents)  # over the limit
+        
+        self.assertIsNone(get_cached_chunk("b", "hash"))
+        for path in ("a", "c", "d"):
+            self.assertEqual(get_cached_chunk(path, "hash"), contents)
+        self.assertLessEqual(chunk_cache._cache_size, 1024 * 1024 * 0.9)
+    
+    def test_file_copies(self):
+        source = os.path.join(self.temp_dir.name, "source")
+        destination = os.path.join(self.temp_dir.name, "destination")
+        with open(source, "wb") as f:
+            f.write(b"content")
+        
+        self.assertFalse(copy_cached_chunk("path", "hash", destination))
+        self.assertFalse(os.path.exists(destination))
+        cache_chunk_file("path", "hash", source)
+        self.assertEqual(get_cached_chunk("path", "hash"), b"content")
+        self.assertEqual(chunk_cache._cache_size, len(b"content"))
+        self.assertTrue(copy_cached_chunk("path", "hash", destination))
+        with open(destination, "rb") as f:
+            self.assertEqual(f.read(), b"content")
+        # never overwrites
+        with self.assertRaises(FileExistsError):
+            copy_cached_chunk("path", "hash", destination)
+
+
+class TestDecryptServerStream(unittest.TestCase):
+    
+    def test_matches_decrypt_server(self):
+        key = b"thequickbrownfoxjumpsoverthelazy"
+        data = os.urandom(10_000)
+        encrypted = encrypt_for_server(data, key)
+        # pieces of every size, including pieces smaller than the initialization vector
+        for piece_size in (1, 7, 16, 17, 1000, len(encrypted)):
+            pieces = (encrypted[i:i + piece_size] for i in range(0, len(encrypted), piece_size))
+            self.assertEqual(b"".join(decrypt_server_stream(pieces, key)), data)
+    
+    def test_too_short(self):
+        with self.assertRaises(ValueError):
+            list(decrypt_server_stream([b"short"], b"thequickbrownfoxjumpsoverthelazy"))
+
+
+class TestChunkRegistryPartitions(CommonTestCase):
+    
+    def test_months(self):
+        dt = datetime(2023, 12, 31, 23, 59, tzinfo=dateutil.tz.UTC)
+        self.assertEqual(month_start(dt), datetime(2023, 12, 1, tzinfo=dateutil.tz.UTC))
+        self.assertEqual(next_month(dt), datetime(2024, 1, 1, tzinfo=dateutil.tz.UTC))
+        # months are in UTC
+        eastern = datetime(2024, 2, 29, 22, tzinfo=gettz("America/New_York"))
+        self.assertEqual(month_start(eastern), datetime(2024, 3, 1, tzinfo=dateutil.tz.UTC))
+        self.assertEqual(next_month(eastern), datetime(2024, 4, 1, tzinfo=dateutil.tz.UTC))
+    
+    def test_months_to_partition(self):
+        utc = dateutil.tz.UTC
+        now = datetime(2024, 7, 15, tzinfo=utc)
+        # right after the conversion the legacy partition covers everything before next month
+        bounds = [
+            ("database_chunkregistry_default", "DEFAULT"),
+            ("database_chunkregistry_legacy", "FOR VALUES FROM (MINVALUE) TO ('2024-08-01 00:00:00+00')"),
+        ]
+        upper_bound = partition_upper_bound(bounds)
+        self.assertEqual(upper_bound, datetime(2024, 8, 1, tzinfo=utc))
+        self.assertEqual(
+            months_to_partition(now, upper_bound, 3),
+            [datetime(2024, 8, 1, tzinfo=utc), datetime(2024, 9, 1, tzinfo=utc),
+             datetime(2024, 10, 1, tzinfo=utc)],
+        )
+        # monthly partitions already exist
+        bounds.append((
+            "database_chunkregistry_y2024m10",
+            "FOR VALUES FROM ('2024-10-01 00:00:00+00') TO ('2024-11-01 00:00:00+00')",
+        ))
+        self.assertEqual(months_to_partition(now, partition_upper_bound(bounds), 3), [])
+        # no partitions, or a conversion long ago, start at this month
+        self.assertEqual(partition_upper_bound([("database_chunkregistry_default", "DEFAULT")]), None)
+        self.assertEqual(
+            months_to_partition(now, None, 1),
+            [datetime(2024, 7, 1, tzinfo=utc), datetime(2024, 8, 1, tzinfo=utc)],
+        )
+        self.assertEqual(
+            months_to_partition(now, datetime(2023, 1, 1, tzinfo=utc), 0),
+            [datetime(2024, 7, 1, tzinfo=utc)],
+        )
+    
+    def test_not_partitioned(self):
+        self.assertFalse(chunk_registry_is_partitioned())
+        self.assertEqual(create_future_partitions(), [])
+    
+    def test_delete_chunk_registries_by_month(self):
+        other_participant = self.generate_participant(self.session_study)
+        for time_bin in (
+            datetime(1970, 1, 1, tzinfo=dateutil.tz.UTC),
+            datetime(2024, 1, 31, 23, tzinfo=dateutil.tz.UTC),
+            datetime(2024, 2, 1, tzinfo=dateutil.tz.UTC),
+            datetime(2024, 2, 15, tzinfo=dateutil.tz.UTC),
+        ):
+            self.generate_chunkregistry(
+                self.session_study, self.default_participant, GPS, time_bin=time_bin
+            )
+            self.generate_chunkregistry(self.session_study, other_participant, GPS, time_bin=time_bin)
+        
+        deleted = delete_chunk_registries_by_month(self.default_participant.chunk_registries.all())
+        self.assertEqual(deleted, 4)
+        self.assertFalse(self.default_participant.chunk_registries.exists())
+        self.assertEqual(ChunkRegistry.objects.filter(participant=other_participant).count(), 4)
+
+
+class TestDataQuantityDeltas(CommonTestCase):
+    
+    def test_apply_data_quantity_deltas(self):
+        existing = self.generate_summary_statistic_daily(date(2024, 3, 1))
+        noon_utc = datetime(2024, 3, 1, 12, tzinfo=dateutil.tz.UTC)
+        apply_data_quantity_deltas(self.default_participant, {
+            (noon_utc, GPS): 50,
+            (noon_utc + timedelta(hours=1), GPS): 25,
+            (noon_utc, ACCELEROMETER): -1_000_000,  # never below zero
+            (noon_utc, "not_a_data_stream"): 10,
+            (noon_utc + timedelta(days=1), GPS): 10,
+        })
+        
+        new = SummaryStatisticDaily.objects.get(date=date(2024, 3, 1))
+        self.assertEqual(new.pk, existing.pk)
+        self.assertEqual(new.beiwe_gps_bytes, existing.beiwe_gps_bytes + 75)
+        self.assertEqual(new.beiwe_accelerometer_bytes, 0)
+        # untouched fields are untouched
+        self.assertEqual(new.beiwe_wifi_bytes, existing.beiwe_wifi_bytes)
+        self.assertEqual(new.jasmine_distance_diameter, existing.jasmine_distance_diameter)
+        
+        next_day = SummaryStatisticDaily.objects.get(date=date(2024, 3, 2))
+        self.assertEqual(next_day.beiwe_gps_bytes, 10)
+        self.assertIsNone(next_day.beiwe_accelerometer_bytes)
+        self.assertEqual(SummaryStatisticDaily.objects.count(), 2)
+    
+    def test_no_deltas(self):
+        apply_data_quantity_deltas(self.default_participant, {})
+        self.assertFalse(SummaryStatisticDaily.objects.exists())
+    
+    def test_stats_error_does_not_replace_upload_error(self):
+        tracker = FileProcessingTracker(self.default_participant)
+        tracker.error_handler = ErrorHandler()
+        with patch.object(tracker, "upload_binified_data", side_effect=ValueError("upload")), \
+                patch.object(tracker, "update_data_quantity_stats", side_effect=KeyError("stats")):
+            with self.assertRaises(ValueError):
+                tracker.do_process_user_file_chunks([])
+        # the stats error is reported too
+        self.assertEqual(len(tracker.error_handler.errors), 1)
+        self.assertIn("KeyError", list(tracker.error_handler.errors)[0])
+
+
+class TestDataQuantityRollup(CommonTestCase):
+    
+    def rollup(self, field_name: str) -> DataQuantityRollup:
+        return DataQuantityRollup.objects.get(
+            participant=self.default_participant, field_name=field_name
+        )
+    
+    def test_rollups_follow_summary_statistics(self):
+        SummaryStatisticDaily.bulk_upsert(self.default_participant.pk, {
+            date(2000, 1, 1): {"timezone": "UTC", "beiwe_gps_bytes": 1},  # junk date
+            date(2024, 1, 1): {"timezone": "UTC", "beiwe_gps_bytes": 10},
+            date(2024, 1, 5): {"timezone": "UTC", "beiwe_gps_bytes": 100, "beiwe_wifi_bytes": 0},
+            date(2024, 1, 9): {"timezone": "UTC", "jasmine_distance_diameter": 1.0},
+        })
+        gps = self.rollup("beiwe_gps_bytes")
+        self.assertEqual(gps.study_id, self.session_study.pk)
+        self.assertEqual(gps.total_bytes, 111)
+        self.assertEqual(gps.first_day, date(2024, 1, 1))
+        self.assertEqual(gps.last_day, date(2024, 1, 5))
+        wifi = self.rollup("beiwe_wifi_bytes")
+        self.assertEqual(
+            (wifi.total_bytes, wifi.first_day, wifi.last_day), (0, date(2024, 1, 5), date(2024, 1, 5))
+        )
+        
+        # a save updates the rollups too
+        summary = SummaryStatisticDaily.objects.get(date=date(2024, 1, 9))
+        summary.update(beiwe_gps_bytes=1000)
+        gps = self.rollup("beiwe_gps_bytes")
+        self.assertEqual((gps.total_bytes, gps.last_day), (1111, date(2024, 1, 9)))
+        
+        SummaryStatisticDaily.objects.all().delete()
+        DataQuantityRollup.refresh([self.default_participant.pk])
+        self.assertFalse(DataQuantityRollup.objects.exists())
+    
+    def test_changes_are_applied_without_reaggregating(self):
+        SummaryStatisticDaily.bulk_upsert(self.default_participant.pk, {
+            date(2024, 1, 1): {"timezone": "UTC", "beiwe_gps_bytes": 10},
+            date(2024, 1, 5): {"timezone": "UTC", "beiwe_gps_bytes": 100},
+        })
+        with patch.object(DataQuantityRollup, "refresh") as refresh:
+            SummaryStatisticDaily.bulk_upsert(self.default_participant.pk, {
+                date(2024, 1, 5): {"beiwe_gps_bytes": 50},
+                date(2024, 1, 9): {"timezone": "UTC", "beiwe_gps_bytes": 1000},
+            })
+            summary = SummaryStatisticDaily.objects.get(date=date(2024, 1, 9))
+            summary.update(beiwe_gps_bytes=2000)
+            refresh.assert_not_called()
+        gps = self.rollup("beiwe_gps_bytes")
+        self.assertEqual(
+            (gps.total_bytes, gps.first_day, gps.last_day), (2060, date(2024, 1, 1), date(2024, 1, 9))
+        )
+    
+    def test_removing_the_first_or_last_day_refreshes(self):
+        SummaryStatisticDaily.bulk_upsert(self.default_participant.pk, {
+            date(2024, 1, 1): {"timezone": "UTC", "beiwe_gps_bytes": 10},
+            date(2024, 1, 5): {"timezone": "UTC", "beiwe_gps_bytes": 100},
+            date(2024, 1, 9): {"timezone": "UTC", "beiwe_gps_bytes": 1000},
+        })
+        SummaryStatisticDaily.bulk_upsert(
+            self.default_participant.pk, {date(2024, 1, 1): {"beiwe_gps_bytes": None}}
+        )
+        gps = self.rollup("beiwe_gps_bytes")
+        self.assertEqual(
+            (gps.total_bytes, gps.first_day, gps.last_day), (1100, date(2024, 1, 5), date(2024, 1, 9))
+        )
+        # moving a day is a removal from the old date
+        summary = SummaryStatisticDaily.objects.get(date=date(2024, 1, 9))
+        summary.update(date=date(2024, 1, 3))
+        gps = self.rollup("beiwe_gps_bytes")
+        self.assertEqual(
+            (gps.total_bytes, gps.first_day, gps.last_day), (1100, date(2024, 1, 3), date(2024, 1, 5))
+        )
+    
+    def test_queryset_deletes_and_updates_refresh(self):
+        SummaryStatisticDaily.bulk_upsert(self.default_participant.pk, {
+            date(2024, 1, 1): {"timezone": "UTC", "beiwe_gps_bytes": 10},
+            date(2024, 1, 5): {"timezone": "UTC", "beiwe_gps_bytes": 100},
+        })
+        SummaryStatisticDaily.objects.filter(date=date(2024, 1, 5)).update(beiwe_gps_bytes=200)
+        gps = self.rollup("beiwe_gps_bytes")
+        self.assertEqual((gps.total_bytes, gps.last_day), (210, date(2024, 1, 5)))
+        
+        SummaryStatisticDaily.objects.filter(date=date(2024, 1, 5)).delete()
+        gps = self.rollup("beiwe_gps_bytes")
+        self.assertEqual((gps.total_bytes, gps.last_day), (10, date(2024, 1, 1)))
+        
+        SummaryStatisticDaily.objects.all().delete()
+        self.assertFalse(DataQuantityRollup.objects.exists())
+
+
+class TestDashboardByteMatrix(CommonTestCase):
+
+    def test_matrix_cells_follow_participants_and_days(self):
+        p1 = self.generate_participant(self.session_study, patient_id="matrixa1")
+        p2 = self.generate_participant(self.session_study, patient_id="matrixa2")
+        days = [date(2024, 1, 1), date(2024, 1, 2), date(2024, 1, 3)]
+        SummaryStatisticDaily.bulk_upsert(p1.pk, {
+            days[0]: {"timezone": "UTC", "beiwe_gps_bytes": 10},
+            days[2]: {"timezone": "UTC", "beiwe_gps_bytes": 30},
+            date(2024, 1, 4): {"timezone": "UTC", "beiwe_gps_bytes": 40},  # outside the range
+        })
+        SummaryStatisticDaily.bulk_upsert(p2.pk, {
+            days[1]: {"timezone": "UTC", "beiwe_wifi_bytes": 20},  # a different stream
+        })
+        participants = Participant.objects.filter(pk__in=[p1.pk, p2.pk]).order_by("patient_id")
+        patient_ids, matrix = build_dashboard_byte_matrix(participants, GPS, days)
+        self.assertEqual(patient_ids, ["matrixa1", "matrixa2"])
+        self.assertEqual(matrix, [[10, 0, 30], [0, 0, 0]])
+        
+        patient_ids, matrix = build_dashboard_byte_matrix(participants, GPS, [])
+        self.assertEqual(matrix, [[], []])
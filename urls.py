@@ -215,6 +215,8 @@ path(
 
 # data access api and other researcher apis
 path("get-data/v1", raw_data_api.get_data)
+path("get-data-session/v1", raw_data_api.create_data_download_session)
+path("get-data-session-segment/v1", raw_data_api.get_data_download_session_segment)
 path("get-studies/v1", data_api_endpoints.get_studies)
 path("get-users/v1", data_api_endpoints.get_participant_ids_in_study)  # deprecated June 2024
 path("get-participant-ids/v1", data_api_endpoints.get_participant_ids_in_study)